@@ -0,0 +1,292 @@
+"""
+Benchmark the computation of stationary_dist.py and the analyses of stationary_dist_joints.py and
+stationary_dist_survivors.py over families of graphs of increasing size.
+Each graph goes through the stages of the computation one at a time: the exploration of the state space, the reduction
+of the chain, the construction of the sparse matrices, the linear solve with solver.inverse(), and the two analyses.
+For each stage, the wall time, the CPU time, the peak memory allocated by Python (with tracemalloc) and the sizes of the
+results (numbers of states and transitions, numbers of polynomial terms) are recorded.
+
+The records are saved as a JSON baseline in the 'data/benchmarks' folder. compare() reports the stages that became
+slower than a baseline, or whose results changed size, and scaling_exponents() fits the growth of the time of each
+stage with the number of states in each family of graphs.
+
+External dependencies: numpy, sympy, solver.py, state_space.py, reduction.py, shared_denominator.py,
+stationary_dist_joints.py, stationary_dist_survivors.py.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy
+import sympy
+import solver
+import state_space
+import reduction
+import shared_denominator
+import stationary_dist_joints
+import stationary_dist_survivors
+
+
+def path_graph(n):
+    "The path with n vertices; the sink vertex is at one end."
+    return [[w for w in (v - 1, v + 1) if 0 <= w < n] for v in range(n)]
+
+
+def cycle_graph(n):
+    "The cycle with n >= 3 vertices."
+    return [sorted([(v - 1) % n, (v + 1) % n]) for v in range(n)]
+
+
+def clique_graph(n):
+    "The complete graph with n vertices."
+    return [[w for w in range(n) if w != v] for v in range(n)]
+
+
+def star_graph(n):
+    "The star with n vertices, with center 0; the sink vertex is a leaf."
+    return [list(range(1, n))] + [[0] for _ in range(1, n)]
+
+
+def grid_graph(rows, cols):
+    "The rows x cols grid; the sink vertex is a corner."
+    def vertex(i, j):
+        return i * cols + j
+
+    a = []
+    for i in range(rows):
+        for j in range(cols):
+            a.append(sorted(vertex(i + di, j + dj) for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1))
+                            if 0 <= i + di < rows and 0 <= j + dj < cols))
+    return a
+
+
+# The graphs of stationary_dist.py.
+NAMED_GRAPHS = {
+    '2-clique': [[1], [0]],
+    '3-path': [[1], [0, 2], [1]],
+    '3-clique': [[1, 2], [0, 2], [0, 1]],
+    '4-path': [[1], [0, 2], [1, 3], [2]],
+    '4-cycle': [[1, 3], [0, 2], [1, 3], [0, 2]],
+    '4-clique': [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]],
+}
+
+
+def standard_suite(max_vertices=4):
+    """
+    List the standard benchmark graphs.
+    With the default max_vertices, the path, star and clique families have 3 sizes, which is the fewest that
+    scaling_exponents() fits; the cycles are only compared with compare(). The 2x2 grid is the 4-cycle, so the grids
+    start at 2x3 and are only in the suite from max_vertices=6 on. Graphs with 5 vertices and 4 symbolic sleep
+    probabilities take minutes each.
+    :param max_vertices: The largest number of vertices (including the sink vertex) in the families.
+    :type max_vertices: A positive integer.
+    :return: The graphs, as tuples (family, name, adjacency list).
+    :rtype: A list of tuples.
+    """
+    suite = [('named', name, a) for name, a in NAMED_GRAPHS.items()]
+    for n in range(2, max_vertices + 1):
+        suite.append(('path', '{}-path'.format(n), path_graph(n)))
+        suite.append(('clique', '{}-clique'.format(n), clique_graph(n)))
+        suite.append(('star', '{}-star'.format(n), star_graph(n)))
+        if n >= 3:
+            suite.append(('cycle', '{}-cycle'.format(n), cycle_graph(n)))
+    for rows in range(2, max_vertices + 1):
+        for cols in range(rows, max_vertices + 1):
+            # The 2x2 grid is the same graph as the 4-cycle.
+            if rows * cols <= max_vertices and (rows, cols) != (2, 2):
+                suite.append(('grid', '{}x{}-grid'.format(rows, cols), grid_graph(rows, cols)))
+    return suite
+
+
+def measure(stage, record, function, trace_memory=True):
+    """
+    Run one stage and add its wall time, CPU time and peak memory to record['stages'][stage].
+    :return: The result of function().
+    """
+    if trace_memory:
+        tracemalloc.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = function()
+    entry = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+    if trace_memory:
+        entry['peak memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record['stages'][stage] = entry
+    return result
+
+
+def poly_terms(polys):
+    "The total number of terms of some polynomials (sympy PolyElement or 0)."
+    return sum(len(p) if hasattr(p, 'terms') else int(p != 0) for p in polys)
+
+
+def benchmark_graph(a, method="field", ordering="mindegree", trace_memory=True):
+    """
+    Run the stages of the computation of the stationary distribution and of its analyses for one graph, with symbolic
+    sleep probabilities q_0, ..., q_{n-1}.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param method, ordering: See stationary_dist.stationary_dist().
+    :param trace_memory: Whether to measure the peak memory of each stage, which slows the stages down.
+    :type trace_memory: Boolean.
+    :return: The measurements.
+    :rtype: A dictionary with the sizes of the graph and of the results, and a dictionary 'stages' with the wall time,
+    CPU time (in seconds) and peak memory (in bytes) of each stage.
+    """
+    n = len(a) - 1
+    sleep_probs = sympy.symbols(['q_{}'.format(x) for x in range(n)])
+    record = {'vertices': len(a), 'edges': sum(len(nbrs) for nbrs in a) // 2, 'stages': {}}
+
+    t, m, t_absorb_idx = measure('explore', record, lambda: state_space.explore(a, sleep_probs), trace_memory)
+    record.update({'states': len(t), 'transitions': len(m), 'stable states': len(t_absorb_idx)})
+
+    t_idx, m, t_absorb_idx, stats = measure('reduce', record, lambda: reduction.reduce_chain(len(t), m, t_absorb_idx),
+                                            trace_memory)
+    record['transient states after reduction'] = stats['transient states after']
+
+    def build():
+        trans_idx, i_minus_q, r = state_space.absorbing_system(len(t_idx), m, t_absorb_idx)
+        ell = len(trans_idx)
+        return (trans_idx, sympy.SparseMatrix(ell, ell, i_minus_q),
+                sympy.SparseMatrix(ell, len(t_absorb_idx), r))
+
+    trans_idx, mat, m_trans_absorb = measure('matrix', record, build, trace_memory)
+    record['matrix nonzeros'] = len(mat.todok()) + len(m_trans_absorb.todok())
+
+    def solve():
+        if 0 not in trans_idx:
+            return sympy.ones(1, len(t_absorb_idx))
+        row = trans_idx.index(0)
+        return solver.inverse(mat, [row], list(range(mat.rows)), method=method, ordering=ordering) * m_trans_absorb
+
+    dist = measure('solve', record, solve, trace_memory)
+    sd = (t.states([t_idx[i] for i in t_absorb_idx]), sympy.Matrix(dist))
+    sd = measure('shared denominator', record,
+                 lambda: shared_denominator.SharedDenominatorDist.from_sd(sd, sleep_probs), trace_memory)
+    record['distribution terms'] = poly_terms(sd.numerators) + poly_terms([sd.denominator])
+
+    def joints():
+        joint_int = stationary_dist_joints.all_joint_intensities(sd)
+        marginals = [joint_int[1 << i] for i in range(n)]
+        return marginals + [joint_int[(1 << i) | (1 << j)] * sd.denominator - marginals[i] * marginals[j]
+                            for i in range(n) for j in range(i + 1, n)]
+
+    record['joints terms'] = poly_terms(measure('joints', record, joints, trace_memory))
+
+    def survivors():
+        hist = stationary_dist_survivors.survivor_histogram(sd)
+        return hist + stationary_dist_survivors.survivor_tails(hist)
+
+    record['survivors terms'] = poly_terms(measure('survivors', record, survivors, trace_memory))
+    return record
+
+
+def run_suite(suite, method="field", ordering="mindegree", trace_memory=True):
+    """
+    Benchmark each graph of a suite, such as standard_suite().
+    :return: The baseline: some information about the environment and one record for each graph.
+    :rtype: A dictionary.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    baseline = {'commit': commit, 'python': platform.python_version(), 'sympy': sympy.__version__,
+                'method': method, 'ordering': ordering, 'records': []}
+    for family, name, a in suite:
+        record = benchmark_graph(a, method, ordering, trace_memory)
+        record.update({'family': family, 'name': name})
+        baseline['records'].append(record)
+        print("Benchmark: " + name + " " + " ".join(
+            stage + " " + "{:.3f}s".format(entry['wall']) for stage, entry in record['stages'].items()))
+    return baseline
+
+
+def save(baseline, path):
+    with open(path, 'w') as out_file:
+        json.dump(baseline, out_file, indent=1)
+
+
+def load(path):
+    with open(path) as in_file:
+        return json.load(in_file)
+
+
+def compare(current, baseline, threshold=1.25, min_time=0.01):
+    """
+    Compare two baselines, graph by graph and stage by stage.
+    :param current, baseline: The baselines, as returned by run_suite().
+    :param threshold: The ratio of wall times above which a stage counts as a regression.
+    :type threshold: A number greater than 1.
+    :param min_time: Stages that take less than this many seconds in both baselines are not compared, since their times
+    are mostly noise.
+    :type min_time: A nonnegative number.
+    :return: The regressions and the changes in the sizes of the results, as readable lines.
+    :rtype: A list of strings.
+    """
+    old = {(record['family'], record['name']): record for record in baseline['records']}
+    report = []
+    for record in current['records']:
+        before = old.get((record['family'], record['name']))
+        if before is None:
+            continue
+        for key, value in record.items():
+            if key not in ('stages', 'family', 'name') and before.get(key) != value:
+                report.append('{}: {} changed from {} to {}'.format(record['name'], key, before.get(key), value))
+        for stage, entry in record['stages'].items():
+            if stage not in before['stages']:
+                continue
+            (new_time, old_time) = (entry['wall'], before['stages'][stage]['wall'])
+            if max(new_time, old_time) >= min_time and new_time > threshold * old_time:
+                report.append('{}: {} is {:.2f} times slower ({:.3f}s, was {:.3f}s)'.format(
+                    record['name'], stage, new_time / old_time, new_time, old_time))
+    return report
+
+
+def scaling_exponents(baseline, size='states'):
+    """
+    Fit wall time ~ C * size^k by least squares on a log-log scale, for each family of graphs and each stage.
+    :param baseline: A baseline, as returned by run_suite().
+    :param size: The measure of the size of a graph, e.g. 'states' or 'vertices'.
+    :type size: A string.
+    :return: The exponents k, for the families and stages with at least 3 graphs of different sizes.
+    :rtype: A dictionary {family: {stage: k}}.
+    """
+    exponents = {}
+    families = sorted(set(record['family'] for record in baseline['records']))
+    for family in families:
+        records = [record for record in baseline['records'] if record['family'] == family]
+        for stage in records[0]['stages']:
+            points = [(record[size], record['stages'][stage]['wall']) for record in records
+                      if record[size] > 0 and record['stages'][stage]['wall'] > 0]
+            if len(set(x for x, _ in points)) < 3:
+                continue
+            x = numpy.log([x for x, _ in points])
+            y = numpy.log([y for _, y in points])
+            exponents.setdefault(family, {})[stage] = float(numpy.polyfit(x, y, 1)[0])
+    return exponents
+
+
+if __name__ == "__main__":
+    label = "current"  # Change the name as necessary
+    compare_to = None  # The label of an earlier baseline, e.g. "baseline"
+    max_vertices = 4
+
+    out_path = os.path.join(os.path.dirname(__file__), 'data', 'benchmarks')
+    os.makedirs(out_path, exist_ok=True)
+    current = run_suite(standard_suite(max_vertices))
+    save(current, os.path.join(out_path, label + '.json'))
+    exponents = scaling_exponents(current)
+    for family, stages in exponents.items():
+        print("Scaling with the number of states, " + family + ": " +
+              ", ".join(stage + " {:.2f}".format(k) for stage, k in stages.items()))
+    too_few = sorted(set(record['family'] for record in current['records']) - set(exponents))
+    if too_few:
+        print("No scaling exponent (fewer than 3 sizes): " + ", ".join(too_few))
+    if compare_to is not None:
+        for line in compare(current, load(os.path.join(out_path, compare_to + '.json'))):
+            print(line)
@@ -0,0 +1,224 @@
+"""
+Compile a stationary distribution into a numpy function of the sleep probabilities, to evaluate the distribution, the
+joint intensities, the pair correlations and the survivor probabilities at many numeric points at once, instead of
+calling subs() or evalf() on sympy expressions.
+The numerators of the probabilities and their common denominator (see shared_denominator.py) are put in Horner form,
+the common subexpressions of all of them are eliminated with sympy.cse(), and the result is written as the source of one
+Python function of numpy arrays, so the denominator is evaluated once for all the states. The joint intensities (see
+stationary_dist_joints.py) and the survivor probabilities (see stationary_dist_survivors.py) are sums of probabilities
+of stable states, so they are evaluated as products of 0/1 matrices with the evaluated distribution.
+The source is cached next to the result store or pickle it is compiled from, e.g. 'data/4-clique-compiled.py' or
+'data/4-clique-compiled-univar.py', together with a digest of that file, and it is only compiled again when the file
+changes.
+
+External dependencies: numpy, sympy, shared_denominator.py, result_store.py.
+"""
+import hashlib
+import os
+import time
+from itertools import combinations
+import numpy
+import sympy
+from sympy.polys.polyfuncs import horner
+import shared_denominator
+import result_store
+
+COMPILED_VERSION = 1
+
+
+def horner_form(p, gens):
+    """
+    Put a polynomial in nested Horner form. Its rational coefficients (and integers too large for a float to represent
+    exactly) become floats, so that the generated code does floating-point arithmetic on numpy arrays.
+    :param p: A polynomial.
+    :type p: sympy PolyElement.
+    :param gens: The variables of the polynomial.
+    :type gens: List of sympy symbols.
+    :return: The Horner form.
+    :rtype: A sympy expression.
+    """
+    if not p:
+        return sympy.Integer(0)
+    expr = horner(p.as_expr(*gens), *gens)
+    return expr.xreplace({c: sympy.Float(c, 17) for c in expr.atoms(sympy.Rational)
+                          if not c.is_Integer or abs(c) > 2 ** 53})
+
+
+def compile_source(sd, digest=''):
+    """
+    Generate the source of a function numerators(v0, v1, ...) of the sleep probabilities that returns the list of the
+    numerators of the probabilities followed by the common denominator.
+    :param sd: The distribution.
+    :type sd: shared_denominator.SharedDenominatorDist.
+    :param digest: A digest of the result that is compiled, written in the first line of the source.
+    :type digest: A string.
+    :return: The source.
+    :rtype: A string.
+    """
+    gens = list(sd.ring.symbols)
+    args = sympy.symbols(['v{}'.format(i) for i in range(len(gens))])
+    exprs = [horner_form(p, gens).xreplace(dict(zip(gens, args))) for p in sd.numerators + [sd.denominator]]
+    replacements, reduced = sympy.cse(exprs, symbols=sympy.numbered_symbols('x'))
+    lines = ['# compiled_dist {} {}'.format(COMPILED_VERSION, digest),
+             'GENS = {!r}'.format(tuple(str(g) for g in gens)),
+             '',
+             '',
+             'def numerators({}):'.format(', '.join(str(v) for v in args))]
+    for symbol, expr in replacements:
+        lines.append('    {} = {}'.format(symbol, sympy.pycode(expr)))
+    lines.append('    return [{}]'.format(', '.join(sympy.pycode(expr) for expr in reduced)))
+    return '\n'.join(lines) + '\n'
+
+
+class CompiledDist:
+    "A stationary distribution compiled into a numpy function of the sleep probabilities."
+
+    def __init__(self, states, source, chunk_size=16384):
+        """
+        :param states: The stable states, in the order of the numerators of the source.
+        :type states: List of lists whose elements are 0 or 's', one for each non-sink vertex.
+        :param source: The source generated by compile_source().
+        :type source: A string.
+        :param chunk_size: The number of points that are evaluated together.
+        :type chunk_size: A positive integer.
+        """
+        namespace = {}
+        exec(compile(source, '<compiled distribution>', 'exec'), namespace)
+        self.states = states
+        self.source = source
+        self.chunk_size = chunk_size
+        self.gens = namespace['GENS']
+        self.function = namespace['numerators']
+        # occupied[s, v] is True if there is a sleeping particle at vertex v in state s.
+        self.occupied = numpy.array([[x != 0 for x in state] for state in states], dtype=bool)
+        self.n = self.occupied.shape[1]
+
+    def __len__(self):
+        return len(self.states)
+
+    def distribution(self, *values):
+        """
+        Evaluate the probabilities of the stable states.
+        :param values: The value of each sleep probability, in the order of self.gens.
+        :type values: Numbers or numpy arrays that can be broadcast together.
+        :return: The probabilities; entry s is the probability of the state self.states[s] at each point.
+        :rtype: A numpy array of shape (len(self), *shape), where shape is the broadcast shape of the values.
+        """
+        if len(values) != len(self.gens):
+            raise ValueError('Expected one value for each of ' + ', '.join(self.gens) + '.')
+        values = numpy.broadcast_arrays(*[numpy.asarray(v, dtype=float) for v in values])
+        shape = values[0].shape
+        flat = [v.reshape(-1) for v in values]
+        out = numpy.empty((len(self), flat[0].size))
+        # The points are evaluated in chunks whose temporary arrays fit in the CPU caches.
+        for start in range(0, flat[0].size, self.chunk_size):
+            chunk = [v[start:start + self.chunk_size] for v in flat]
+            # The constant numerators are broadcast to the shape of the chunk; the last one is the denominator.
+            evaluated = numpy.broadcast_arrays(*self.function(*chunk), chunk[0])[:-1]
+            out[:, start:start + self.chunk_size] = numpy.array(evaluated[:-1]) / evaluated[-1]
+        return out.reshape((len(self),) + shape)
+
+    def _sums(self, weights, values):
+        "The sums of the probabilities of the states with weight 1 in each row of weights."
+        return numpy.tensordot(weights.astype(float), self.distribution(*values), axes=1)
+
+    def joint_intensities(self, k, *values):
+        """
+        Evaluate the k-point joint intensities, in the order of stationary_dist_joints.joint_intensities().
+        :return: The probabilities that each k-vertex subset has all sleeping particles.
+        :rtype: A numpy array of shape (n choose k, *shape).
+        """
+        subsets = list(combinations(range(self.n), k))
+        weights = numpy.array([self.occupied[:, list(c)].all(axis=1) for c in subsets], dtype=bool)
+        return self._sums(weights.reshape(len(subsets), len(self)), values)
+
+    def correlations(self, *values):
+        """
+        Evaluate the pair correlations P(i and j have sleeping particles) - P(i) P(j), in the order of combinations().
+        :rtype: A numpy array of shape (n choose 2, *shape).
+        """
+        marginals = self.joint_intensities(1, *values)
+        pairs = self.joint_intensities(2, *values)
+        return pairs - numpy.array([marginals[i] * marginals[j] for i, j in combinations(range(self.n), 2)])
+
+    def survivor_histogram(self, *values):
+        """
+        Evaluate the probabilities that exactly k particles survive, for k = 0, ..., n.
+        :rtype: A numpy array of shape (n + 1, *shape).
+        """
+        counts = self.occupied.sum(axis=1)
+        return self._sums(counts[None, :] == numpy.arange(self.n + 1)[:, None], values)
+
+    def survivors(self, k, *values):
+        "Evaluate the probability that at least k particles survive, like stationary_dist_survivors.survivors()."
+        return self._sums((self.occupied.sum(axis=1) >= k)[None, :], values)[0]
+
+    def exact_survivors(self, k, *values):
+        "Evaluate the probability that exactly k particles survive, like stationary_dist_survivors.exact_survivors()."
+        return self._sums((self.occupied.sum(axis=1) == k)[None, :], values)[0]
+
+
+def load(path, univariate=None):
+    """
+    Compile the stationary distribution in a result store or a pickle, or read the compiled source from the cache next
+    to it if the file has not changed since.
+    :param path: The path of the result store (.npz) or of the pickle.
+    :type path: A string.
+    :param univariate: A symbol, e.g. q, to compile the univariate distribution where all the sleep probabilities are
+    equal to it, or None.
+    :type univariate: A sympy symbol or None.
+    :return: The compiled distribution.
+    :rtype: CompiledDist.
+    """
+    with open(path, 'rb') as in_file:
+        digest = hashlib.sha256(in_file.read()).hexdigest()[:32]
+    if univariate is not None:
+        digest += ' ' + str(univariate)
+    (base, extension) = os.path.splitext(path)
+    cache_path = (base + '-compiled' + ('-pickle' if extension != '.npz' else '') +
+                  ('-univar' if univariate is not None else '') + '.py')
+    if extension == '.npz':
+        store = result_store.ResultStore(path)
+        states = store.states()
+    else:
+        store = None
+        sd = result_store.load_pickle(path)
+        states = sd[0]
+
+    if os.path.exists(cache_path):
+        with open(cache_path) as in_file:
+            source = in_file.read()
+        if source.split('\n', 1)[0] == '# compiled_dist {} {}'.format(COMPILED_VERSION, digest):
+            return CompiledDist(states, source)
+
+    if store is not None:
+        shared = store.univariate(univariate) if univariate is not None else store.to_shared()
+    else:
+        shared = shared_denominator.SharedDenominatorDist.from_sd(
+            sd, sympy.symbols(['q_{}'.format(x) for x in range(len(states[0]))]))
+        if univariate is not None:
+            shared = shared.specialize(univariate)
+    source = compile_source(shared, digest)
+    with open(cache_path, 'w') as out_file:
+        out_file.write(source)
+    return CompiledDist(states, source)
+
+
+if __name__ == "__main__":
+    graph_name = "4-clique"  # Change the name as necessary
+    points = 10 ** 6
+
+    in_path = os.path.join(os.path.dirname(__file__), 'data/')
+    path = in_path + graph_name + ('.npz' if os.path.exists(in_path + graph_name + '.npz') else '.pickle')
+    t0 = time.perf_counter()
+    compiled = load(path)
+    print("Time to compile (or read from the cache): " + str(time.perf_counter() - t0))
+
+    rng = numpy.random.default_rng(0)
+    values = rng.random((len(compiled.gens), points))
+    t0 = time.perf_counter()
+    dist = compiled.distribution(*values)
+    elapsed = time.perf_counter() - t0
+    print("Evaluated the distribution at {} points per second".format(int(points / elapsed)))
+    print("Largest deviation of the total probability from 1: " + str(numpy.abs(dist.sum(axis=0) - 1).max()))
+    print("Survivor histogram at the first point: " + str(compiled.survivor_histogram(*values[:, 0])))
@@ -0,0 +1,207 @@
+"""
+Factor and render the rational functions that stationary_dist.py, stationary_dist_joints.py and
+stationary_dist_survivors.py write out, in a process pool.
+Every output is a numerator polynomial over a power of the common denominator of a distribution (see
+shared_denominator.py). Instead of calling sympy.factor() on each rational expression, the denominator is factored once,
+each numerator is factored on its own in a worker process, and the common factors are cancelled by comparing the two
+lists of irreducible factors. The factorizations are kept in a FactorCache, so the univariate outputs (all the sleep
+probabilities equal to q) are obtained by setting the variables of each distinct irreducible factor equal to q and
+factoring that much smaller polynomial, instead of factoring every specialized expression again.
+The entries are factored and rendered in batches, so only one batch of pretty strings is in memory at a time, and they
+are written in the order they are given.
+
+External dependencies: sympy, shared_denominator.py.
+"""
+import multiprocessing
+import sympy
+from sympy.core.mul import _keep_coeff
+from sympy.polys.rings import ring
+import shared_denominator
+
+
+def _factor_terms(args):
+    "Factor a polynomial given by its generators and terms; the unit of work sent to the process pool."
+    (gens, terms) = args
+    R = ring(gens, sympy.QQ)[0]
+    coeff, factors = R(terms).factor_list()
+    return coeff, [(dict(f), e) for f, e in factors]
+
+
+def _render(args):
+    "Render a factored form given by its generators and terms as a pretty string; the unit of work of the pool."
+    (gens, (coeff, numer, denom)) = args
+    R = ring(gens, sympy.QQ)[0] if gens else None
+    # Assemble the expression the way sympy.factor() does, so that the text is the same as my_pretty() writes (e.g. a
+    # constant is spread over a numerator that is a single sum).
+    factors = [R(f).as_expr() ** e for f, e in numer] + [R(f).as_expr() ** -e for f, e in denom]
+    expr = _keep_coeff(sympy.QQ.to_sympy(coeff), sympy.Mul(*factors)) if coeff else sympy.Integer(0)
+    (num, den) = sympy.fraction(expr)
+    return sympy.pretty(num) + "\n" + "/\n" + sympy.pretty(den) + "\n\n\n\n\n"
+
+
+class FactorCache:
+    """The factorizations of polynomials into irreducible factors, computed in a process pool and kept for reuse.
+    Use it as a context manager, so that the pool is closed at the end."""
+
+    def __init__(self, processes=None, batch=64):
+        """
+        :param processes: The number of worker processes, or None to factor and render in this process.
+        :type processes: A positive integer or None.
+        :param batch: The number of entries that are factored or rendered together.
+        :type batch: A positive integer.
+        """
+        self.processes = processes
+        self.batch = batch
+        self.factorizations = {}
+        self.pool = None
+
+    def __enter__(self):
+        if self.processes is not None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def map(self, function, tasks):
+        "Apply function to the tasks, one batch at a time, and yield the results in order."
+        for start in range(0, len(tasks), self.batch):
+            chunk = tasks[start:start + self.batch]
+            if self.pool is None:
+                yield from map(function, chunk)
+            else:
+                yield from self.pool.imap(function, chunk)
+
+    def factor_all(self, polys):
+        """
+        Factor the polynomials that are not in the cache yet.
+        :param polys: Polynomials, possibly in different rings.
+        :type polys: List of sympy PolyElement.
+        :return: The factorizations, in the form of PolyElement.factor_list().
+        :rtype: List of tuples (coefficient, [(factor, exponent)]).
+        """
+        missing = list(dict.fromkeys(p for p in polys if p not in self.factorizations))
+        tasks = [(p.ring.symbols, dict(p)) for p in missing]
+        for p, (coeff, factors) in zip(missing, self.map(_factor_terms, tasks)):
+            self.factorizations[p] = (coeff, [(p.ring(f), e) for f, e in factors])
+        return [self.factorizations[p] for p in polys]
+
+
+def _cancel(coeff, numer, denom):
+    "Cancel the common factors of two dictionaries {factor: exponent} and return a factored form."
+    for f in list(numer):
+        if f in denom:
+            e = min(numer[f], denom[f])
+            numer[f] -= e
+            denom[f] -= e
+    return (coeff, [(f, e) for f, e in numer.items() if e], [(f, e) for f, e in denom.items() if e])
+
+
+def factored(cache, sd, numerators, power=1):
+    """
+    Factor numerator / denominator^power for some numerators over the common denominator of a distribution.
+    :param cache: The cache of factorizations.
+    :type cache: FactorCache.
+    :param sd: The distribution, whose denominator is used.
+    :type sd: shared_denominator.SharedDenominatorDist.
+    :param numerators: The numerators, e.g. sd.numerators or the marginals of stationary_dist_joints.py.
+    :type numerators: List of polynomials in sd.ring.
+    :param power: The power of the denominator.
+    :type power: A positive integer.
+    :return: The reduced fractions, as factored forms (coefficient, numerator factors, denominator factors), where the
+    factors are lists of (irreducible polynomial, exponent).
+    :rtype: List of tuples.
+    """
+    numerators = [sd.ring(p) for p in numerators]
+    (dcoeff, dfactors) = cache.factor_all([sd.denominator])[0]
+    factorizations = cache.factor_all([p for p in numerators if p])
+    forms = []
+    k = 0
+    for p in numerators:
+        if not p:
+            forms.append((sympy.QQ.zero, [], []))
+            continue
+        (coeff, factors) = factorizations[k]
+        k += 1
+        forms.append(_cancel(coeff / dcoeff ** power, dict(factors), {f: e * power for f, e in dfactors}))
+    return forms
+
+
+def specialized(cache, forms, symbol):
+    """
+    Set all the sleep probabilities equal to one symbol in factored forms, reusing their factorizations: each distinct
+    irreducible factor is specialized (see shared_denominator.collapse()) and factored once.
+    :param cache: The cache of factorizations.
+    :type cache: FactorCache.
+    :param forms: Factored forms, as returned by factored().
+    :type forms: List of tuples.
+    :param symbol: The symbol, e.g. q.
+    :type symbol: A sympy symbol.
+    :return: The factored forms in QQ[symbol].
+    :rtype: List of tuples.
+    """
+    R = ring([symbol], sympy.QQ)[0]
+    distinct = list(dict.fromkeys(f for (_, numer, denom) in forms for f, _ in numer + denom))
+    collapsed = {f: shared_denominator.collapse(f, R) for f in distinct}
+    factorizations = dict(zip(distinct, cache.factor_all([collapsed[f] for f in distinct])))
+    out = []
+    for (coeff, numer, denom) in forms:
+        if any(not collapsed[f] for f, _ in numer):
+            out.append((sympy.QQ.zero, [], []))
+            continue
+        if any(not collapsed[f] for f, _ in denom):
+            raise ValueError('The denominator vanishes when all the sleep probabilities are equal.')
+        parts = []
+        for factors, sign in ((numer, 1), (denom, -1)):
+            collected = {}
+            for f, e in factors:
+                (c, irreducible) = factorizations[f]
+                coeff *= c ** (sign * e)
+                for g, k in irreducible:
+                    collected[g] = collected.get(g, 0) + k * e
+            parts.append(collected)
+        out.append(_cancel(coeff, parts[0], parts[1]))
+    return out
+
+
+def _encode(form):
+    "Turn a factored form into generators and terms that can be sent to the process pool."
+    (coeff, numer, denom) = form
+    factors = numer + denom
+    gens = factors[0][0].ring.symbols if factors else ()
+    return gens, (coeff, [(dict(f), e) for f, e in numer], [(dict(f), e) for f, e in denom])
+
+
+def render_all(forms, cache):
+    """
+    Render factored forms as pretty strings, in the format of my_pretty() in stationary_dist_joints.py.
+    :param forms: Factored forms, as returned by factored() or specialized().
+    :type forms: List of tuples.
+    :param cache: The cache whose pool renders the forms.
+    :type cache: FactorCache.
+    :return: The strings, in order, rendered one batch at a time.
+    :rtype: A generator of strings.
+    """
+    return cache.map(_render, [_encode(form) for form in forms])
+
+
+def write_pretty(path, forms, cache, label=None):
+    """
+    Render factored forms with render_all() and write them to a file, in order.
+    :param path: The path of the file, which is overwritten.
+    :type path: A string.
+    :param forms: Factored forms, as returned by factored() or specialized().
+    :type forms: List of tuples.
+    :param cache: The cache whose pool renders the forms.
+    :type cache: FactorCache.
+    :param label: If not None, print label + ": finished entry k" after each entry.
+    :type label: A string or None.
+    """
+    with open(path, 'w') as out_file:
+        for k, text in enumerate(render_all(forms, cache)):
+            out_file.write(text)
+            if label is not None:
+                print(label + ": finished entry " + str(k))
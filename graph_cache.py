@@ -0,0 +1,219 @@
+"""
+Cache the stationary distributions computed by stationary_dist.py on disk, keyed by the isomorphism class of the graph.
+A graph is relabeled canonically (with the sink vertex fixed) together with the pattern of its sleep probabilities:
+vertices with the same symbolic sleep probability are in the same class, and numeric sleep probabilities are part of the
+key. Two graphs that differ only by the labels of their non-sink vertices then share one cache entry, and a hit is
+mapped back to the labels and symbols of the graph that was asked for. By the abelian property of the ARW (see
+symmetry.py), the distribution does not depend on the labeling that is used to compute it.
+
+Besides the final distribution (a result store, see result_store.py), the explored state space and the reduced chain
+are kept, so that a run that is interrupted during the linear solve does not have to explore and reduce again. The
+chain is kept under a different name with reduce=False, since it is then not reduced.
+All the cached objects are in canonical labels, with the symbols c_0, c_1, ... for the classes of sleep probabilities.
+
+External dependencies: sympy, state_space.py, reduction.py, result_store.py, stationary_dist.py.
+"""
+import hashlib
+import os
+import pickle
+import sympy
+import state_space
+import reduction
+import result_store
+import stationary_dist as sd_module
+
+CACHE_VERSION = 1
+
+
+def _prob_labels(sleep_probs):
+    """
+    Give each sleep probability an isomorphism-invariant label: ('num', value) for a number and ('sym', size of its
+    class) for a symbolic expression.
+    """
+    sizes = {}
+    for q in sleep_probs:
+        sizes[q] = sizes.get(q, 0) + 1
+    return [('num', str(q)) if sympy.sympify(q).is_number else ('sym', sizes[q]) for q in sleep_probs]
+
+
+def _refine(a, colors):
+    "Refine the vertex colors by the multisets of the colors of the neighbors, until they are stable."
+    n = len(colors)
+    while True:
+        signatures = [(colors[v], tuple(sorted(colors[w] for w in a[v] if w < n))) for v in range(n)]
+        ranks = {sig: k for k, sig in enumerate(sorted(set(signatures)))}
+        refined = [ranks[sig] for sig in signatures]
+        if len(set(refined)) == len(set(colors)):
+            return refined
+        colors = refined
+
+
+def canonical_labeling(a, sleep_probs):
+    """
+    Relabel the non-sink vertices of a graph canonically, so that isomorphic graphs (by an isomorphism that fixes the
+    sink and maps each class of sleep probabilities to a class) get the same canonical graph.
+    The canonical order is the lexicographically smallest sequence of vertex tokens, where the token of the vertex at
+    position i records its color, its adjacency to the vertices at positions 0, ..., i - 1 and to the sink, and its
+    class of sleep probabilities. Only the orderings that are still smallest are extended, one position at a time.
+    Two twins (vertices with the same neighbors apart from each other, and the same sleep probability) are swapped by an
+    automorphism that fixes every other vertex, so an ordering is only extended by the first of the twins that are not
+    in it yet; the other extensions give the same tokens. This keeps the search small on cliques and stars, whose tied
+    orderings would otherwise grow factorially.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex.
+    :type sleep_probs: List of symbolic expressions (or numbers).
+    :return: The canonical positions, the canonical graph and the canonical sleep probabilities.
+    :rtype: A tuple with three elements.
+    The first element is a list p such that vertex v has position p[v].
+    The second element is the adjacency list of the canonical graph, with the sink vertex last.
+    The third element is the list of sleep probabilities of the canonical graph, with the symbol c_k for the kth class
+    of symbolic sleep probabilities (in canonical order) and the numbers unchanged.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    n = len(a) - 1
+    adj = [set(nbrs) for nbrs in a]
+    labels = _prob_labels(sleep_probs)
+    initial = [(v in adj[n], len(adj[v]), labels[v]) for v in range(n)]
+    ranks = {c: k for k, c in enumerate(sorted(set(initial)))}
+    colors = _refine(a, [ranks[c] for c in initial])
+
+    def token(order, v):
+        classes = []
+        for u in order:
+            if labels[u][0] == 'sym' and sleep_probs[u] not in classes:
+                classes.append(sleep_probs[u])
+        if labels[v][0] == 'sym':
+            cls = classes.index(sleep_probs[v]) if sleep_probs[v] in classes else len(classes)
+        else:
+            cls = labels[v][1]
+        return colors[v], tuple(u in adj[v] for u in order), cls
+
+    # twin[v] is the smallest vertex in the class of twins of v. A vertex cannot have both a twin that is adjacent to it
+    # and one that is not, so the classes of open and closed neighborhoods do not overlap.
+    twin = list(range(n))
+    for closed in (False, True):
+        first = {}
+        for v in range(n):
+            if twin[v] == v:
+                key = (frozenset(adj[v] | {v} if closed else adj[v]), labels[v], sleep_probs[v])
+                first.setdefault(key, v)
+                twin[v] = first[key]
+
+    orders = [[]]
+    for _ in range(n):
+        extended = []
+        best = None
+        for order in orders:
+            placed = set(order)
+            skip = set()
+            for v in range(n):
+                if v in placed or twin[v] in skip:
+                    continue
+                skip.add(twin[v])
+                tok = token(order, v)
+                if best is None or tok < best:
+                    best = tok
+                    extended = []
+                if tok == best:
+                    extended.append(order + [v])
+        orders = extended
+    order = orders[0]
+
+    p = [None] * n
+    for i, v in enumerate(order):
+        p[v] = i
+    p_sink = p + [n]
+    ca = [sorted(p_sink[w] for w in a[order[i]]) for i in range(n)] + [sorted(p[w] for w in a[n])]
+    classes = []
+    cprobs = []
+    for v in order:
+        if labels[v][0] == 'sym':
+            if sleep_probs[v] not in classes:
+                classes.append(sleep_probs[v])
+            cprobs.append(sympy.Symbol('c_{}'.format(classes.index(sleep_probs[v]))))
+        else:
+            cprobs.append(sleep_probs[v])
+    return p, ca, cprobs
+
+
+def cache_key(ca, cprobs):
+    "Hash a canonical graph and its canonical sleep probabilities into the name of a cache entry."
+    text = repr((CACHE_VERSION, ca, [str(q) for q in cprobs]))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def _load(path):
+    with open(path, 'rb') as in_file:
+        return pickle.loads(in_file.read())
+
+
+def _save(path, obj):
+    with open(path, 'wb') as out_file:
+        out_file.write(pickle.dumps(obj))
+
+
+def cached_stationary_dist(a, sleep_probs, cache_dir=None, method="field", ordering="mindegree", reduce=True,
+                           params=None, processes=None, progress_callback=None):
+    """
+    Compute the stationary distribution of the ARW like stationary_dist.stationary_dist(), reusing the cached result
+    (or the cached state space and reduced chain) of any isomorphic graph with the same pattern of sleep probabilities.
+    :param a, sleep_probs, method, ordering, reduce, params, processes, progress_callback: See
+    stationary_dist.stationary_dist(). The parameter map is applied before the canonical labeling, so e.g. all the
+    univariate specializations of isomorphic graphs share one cache entry.
+    :param cache_dir: The folder of the cache. By default, 'data/cache'.
+    :type cache_dir: A string, or None.
+    :return: The stable states and the probabilities, as for stationary_dist.stationary_dist(). The stable states are
+    in the order of the canonical graph, which need not be the order of stationary_dist.stationary_dist().
+    :rtype: A tuple with two elements.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(__file__), 'data', 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    sleep_probs = sd_module.specialize(sleep_probs, params)
+    p, ca, cprobs = canonical_labeling(a, sleep_probs)
+    n = len(p)
+    back = {}
+    for v in range(n):
+        if isinstance(cprobs[p[v]], sympy.Symbol):
+            back[cprobs[p[v]]] = sleep_probs[v]
+    gens = sorted(set(q for q in cprobs if isinstance(q, sympy.Symbol)), key=sympy.default_sort_key)
+    prefix = os.path.join(cache_dir, cache_key(ca, cprobs))
+    chain_path = prefix + ('-reduced.pickle' if reduce else '-chain.pickle')
+
+    if os.path.exists(prefix + '.npz'):
+        print("Cache hit: " + prefix)
+        (cstates, cdist) = result_store.ResultStore(prefix + '.npz').to_sd()
+    else:
+        if os.path.exists(chain_path):
+            print("Cache hit for the chain: " + chain_path)
+            (cstates_all, t_idx, m, t_absorb_idx) = _load(chain_path)
+        else:
+            if os.path.exists(prefix + '-explored.pickle'):
+                print("Cache hit for the state space: " + prefix)
+                (t, m, t_absorb_idx) = _load(prefix + '-explored.pickle')
+            else:
+                if processes:
+                    t, m, t_absorb_idx = state_space.explore_parallel(ca, cprobs, processes)
+                else:
+                    t, m, t_absorb_idx = state_space.explore(ca, cprobs)
+                _save(prefix + '-explored.pickle', (t, m, t_absorb_idx))
+            t_idx = list(range(len(t)))
+            if reduce:
+                t_idx, m, t_absorb_idx, _ = reduction.reduce_chain(len(t), m, t_absorb_idx)
+            cstates_all = t.states(t_idx)
+            _save(chain_path, (cstates_all, t_idx, m, t_absorb_idx))
+        # The initial state has index 0 and is kept by the reduction.
+        source = t_idx.index(0)
+        r_idx, r_absorb_idx, dist = sd_module.solve_chain(len(t_idx), m, t_absorb_idx, [source], cprobs, method,
+                                                          ordering, reduce=False,
+                                                          progress_callback=progress_callback, processes=processes)
+        cstates = [cstates_all[r_idx[i]] for i in r_absorb_idx]
+        cdist = dist
+        result_store.save(prefix + '.npz', (cstates, cdist), gens or None)
+
+    # Map the canonical labels and symbols back to the graph that was asked for.
+    states = [[state[p[v]] for v in range(n)] for state in cstates]
+    dist = sympy.Matrix([[sympy.sympify(cdist[s]).xreplace(back) for s in range(len(cstates))]])
+    return states, dist
@@ -0,0 +1,609 @@
+"""
+Compute the probabilities of ending up at each absorbing state of an absorbing chain with symbolic transition
+probabilities by evaluation and interpolation, instead of symbolic elimination.
+The linear system x (I - Q) = e1 is solved at many integer points modulo word-size primes by sparse elimination, which
+involves no expression swell. Each probability is a rational function N / D of the sleep probabilities q, and it is
+reconstructed from its values:
+(1) On a line q = z t + s, the univariate rational function of t is found by rational reconstruction, which also gives
+the degrees of N and D. With the normalization D(s) = 1, the coefficient of t^k in N(z t + s) (and in D) is a
+homogeneous polynomial of degree k in z.
+(2) These homogeneous polynomials are interpolated from their values on a grid of directions z with z_0 = 1, and
+shifted back to give N and D modulo the prime.
+(3) The coefficients for several primes are combined with the Chinese remainder theorem and rational reconstruction,
+until they no longer change, and the result is checked at random points modulo a new prime.
+The evaluations at the points are independent, so they can be spread over a process pool.
+
+External dependencies: sympy, solver.py.
+"""
+import multiprocessing
+import random
+import sympy
+import solver
+
+# The largest prime below 2^31; further primes are found with sympy.prevprime().
+FIRST_PRIME = 2147483647
+# The number of primes for which the reconstruction may fail before giving up.
+MAX_FAILURES = 10
+
+
+def poly_terms(poly, gens):
+    "Return the terms of a polynomial over QQ as a list of (exponents, numerator, denominator)."
+    return [(monom, int(coeff.numerator), int(coeff.denominator)) for monom, coeff in poly.terms()]
+
+
+class ModularSystem:
+    """The systems x (I - Q) = e_i for the sources i of an absorbing chain, ready to be solved together modulo primes at
+    integer points.
+    The entries of I - Q and R are rational functions of the generators, stored as lists of terms of their numerators
+    and denominators."""
+
+    def __init__(self, ell, i_minus_q, r, gens, sources=(0,)):
+        """
+        :param ell: The number of transient states.
+        :type ell: A positive integer.
+        :param i_minus_q: The nonzero entries of I - Q, as returned by state_space.absorbing_system().
+        :type i_minus_q: A dictionary {(row, col): symbolic expression}.
+        :param r: The nonzero entries of R, as returned by state_space.absorbing_system().
+        :type r: A dictionary {(row, col): symbolic expression}.
+        :param gens: The symbols that the entries depend on.
+        :type gens: List of sympy symbols.
+        :param sources: The transient states that the chain starts from.
+        :type sources: A sequence of nonnegative integers.
+        """
+        self.ell = ell
+        self.gens = list(gens)
+        self.sources = list(sources)
+        K = sympy.QQ.frac_field(*self.gens)
+
+        def convert(e):
+            f = K.from_sympy(sympy.sympify(e))
+            return poly_terms(f.numer, self.gens), poly_terms(f.denom, self.gens)
+
+        # rows[j] lists the entries (i, numerator, denominator) of column j of I - Q, i.e. of row j of (I - Q)^T.
+        self.rows = [[] for _ in range(ell)]
+        for (i, j), e in i_minus_q.items():
+            self.rows[j].append((i,) + convert(e))
+        self.num_absorbing = 1 + max((j for (_, j) in r), default=-1)
+        self.num_outputs = len(self.sources) * self.num_absorbing
+        self.r = [(i, j) + convert(e) for (i, j), e in r.items()]
+        # The pivots are taken in a fill-reducing order, on the diagonal when possible.
+        self.order = solver.min_degree_order(ell, i_minus_q)
+        # The coefficients of the terms reduced modulo each prime, as (rows, r) with the same layout as above.
+        self.reduced = {}
+
+    def reduce_mod(self, p):
+        "Return the entries of I - Q and R with their coefficients reduced modulo p."
+        if p not in self.reduced:
+            def terms(ts):
+                return [(monom, num * pow(den, -1, p) % p) for monom, num, den in ts]
+            rows = [[(i, terms(numer), terms(denom)) for (i, numer, denom) in row] for row in self.rows]
+            r = [(i, j, terms(numer), terms(denom)) for (i, j, numer, denom) in self.r]
+            self.reduced = {p: (rows, r)}
+        return self.reduced[p]
+
+    def evaluate(self, p, point):
+        """
+        Compute the absorption probabilities modulo a prime at a point.
+        :param p: The prime.
+        :type p: An integer.
+        :param point: The values of the generators modulo p.
+        :type point: A tuple of integers.
+        :return: The probability of ending up at each absorbing state modulo p, for the first source and then for the
+        next ones, or None if the system (or one of the entries) is singular modulo p at this point.
+        :rtype: A list of integers, or None.
+        """
+        entries, r_entries = self.reduce_mod(p)
+        powers = {}
+
+        def value(terms):
+            total = 0
+            for monom, term in terms:
+                for k, e in enumerate(monom):
+                    if e:
+                        key = (k, e)
+                        if key not in powers:
+                            powers[key] = pow(point[k], e, p)
+                        term = term * powers[key]
+                total += term
+            return total % p
+
+        def entry(numer, denom):
+            d = value(denom)
+            if d == 0:
+                return None
+            return value(numer) * pow(d, -1, p) % p
+
+        # Gaussian elimination on (I - Q)^T x^T = e_i, with the rows as dictionaries {column: entry}. The right-hand
+        # sides for all the sources are eliminated together.
+        rows = []
+        col_rows = [set() for _ in range(self.ell)]
+        for j in range(self.ell):
+            row = {}
+            for (i, numer, denom) in entries[j]:
+                v = entry(numer, denom)
+                if v is None:
+                    return None
+                if v:
+                    row[i] = v
+                    col_rows[i].add(j)
+            rows.append(row)
+        rhs = [[0] * len(self.sources) for _ in range(self.ell)]
+        for k, source in enumerate(self.sources):
+            rhs[source][k] = 1
+
+        pivots = []
+        done = [False] * self.ell
+        for c in self.order:
+            candidates = [j for j in col_rows[c] if not done[j]]
+            if not candidates:
+                return None
+            j = c if c in candidates else min(candidates)
+            done[j] = True
+            pivots.append((c, j))
+            inv = pow(rows[j][c], -1, p)
+            for i in candidates:
+                if i == j:
+                    continue
+                f = rows[i].pop(c) * inv % p
+                col_rows[c].discard(i)
+                for k, v in rows[j].items():
+                    if k == c:
+                        continue
+                    w = (rows[i].get(k, 0) - f * v) % p
+                    if w:
+                        if k not in rows[i]:
+                            col_rows[k].add(i)
+                        rows[i][k] = w
+                    elif k in rows[i]:
+                        del rows[i][k]
+                        col_rows[k].discard(i)
+                rhs[i] = [(u - f * v) % p for u, v in zip(rhs[i], rhs[j])]
+
+        x = [None] * self.ell
+        for c, j in reversed(pivots):
+            acc = list(rhs[j])
+            for k, v in rows[j].items():
+                if k != c:
+                    acc = [u - v * w for u, w in zip(acc, x[k])]
+            inv = pow(rows[j][c], -1, p)
+            x[c] = [u * inv % p for u in acc]
+
+        out = [0] * self.num_outputs
+        for (i, j, numer, denom) in r_entries:
+            v = entry(numer, denom)
+            if v is None:
+                return None
+            for k, u in enumerate(x[i]):
+                out[k * self.num_absorbing + j] = (out[k * self.num_absorbing + j] + u * v) % p
+        return out
+
+    def evaluate_many(self, args):
+        "Evaluate at several points: args is (p, points). This is the unit of work sent to the process pool."
+        p, points = args
+        return [self.evaluate(p, point) for point in points]
+
+
+# The system in each worker process of the pool, set once by init_worker().
+worker_system = None
+
+
+def init_worker(system):
+    global worker_system
+    worker_system = system
+
+
+def evaluate_in_worker(args):
+    return worker_system.evaluate_many(args)
+
+
+def lowest_monomial(poly):
+    "The smallest monomial of a nonzero polynomial {exponents: coefficient}, in graded lexicographic order."
+    return min(poly, key=lambda m: (sum(m), m))
+
+
+def poly_add(f, g, p, scale=1):
+    "Return f + scale * g for polynomials given as dictionaries {exponents: coefficient modulo p}."
+    out = dict(f)
+    for m, c in g.items():
+        v = (out.get(m, 0) + scale * c) % p
+        if v:
+            out[m] = v
+        else:
+            out.pop(m, None)
+    return out
+
+
+def poly_mul(f, g, p):
+    "Return f * g for polynomials given as dictionaries {exponents: coefficient modulo p}."
+    out = {}
+    for m1, c1 in f.items():
+        for m2, c2 in g.items():
+            m = tuple(a + b for a, b in zip(m1, m2))
+            out[m] = (out.get(m, 0) + c1 * c2) % p
+    return {m: c for m, c in out.items() if c}
+
+
+def univariate_interpolate(xs, ys, p):
+    "Return the coefficients (lowest degree first) of the polynomial of degree < len(xs) through the points mod p."
+    n = len(xs)
+    coef = list(ys)
+    for k in range(1, n):
+        for i in range(n - 1, k - 1, -1):
+            coef[i] = (coef[i] - coef[i - 1]) * pow(xs[i] - xs[i - k], -1, p) % p
+    # Convert from the Newton basis to the monomial basis.
+    poly = [0] * n
+    for k in range(n - 1, -1, -1):
+        poly = [(coef[k] if i == 0 else 0) + (poly[i - 1] if i > 0 else 0) - xs[k] * poly[i] for i in range(n)]
+        poly = [c % p for c in poly]
+    return poly
+
+
+def upoly_trim(f):
+    while f and f[-1] == 0:
+        f.pop()
+    return f
+
+
+def upoly_divmod(f, g, p):
+    "Divide univariate polynomials (lists of coefficients mod p, lowest degree first)."
+    f = list(f)
+    q = [0] * max(len(f) - len(g) + 1, 0)
+    inv = pow(g[-1], -1, p)
+    for k in range(len(f) - len(g), -1, -1):
+        c = f[k + len(g) - 1] * inv % p
+        q[k] = c
+        if c:
+            for i, gi in enumerate(g):
+                f[k + i] = (f[k + i] - c * gi) % p
+    return upoly_trim(q), upoly_trim(f[:len(g) - 1])
+
+
+def upoly_sub_mul(f, q, g, p):
+    "Return f - q * g for univariate polynomials mod p."
+    out = list(f) + [0] * max(0, len(q) + len(g) - 1 - len(f))
+    for i, qi in enumerate(q):
+        for j, gj in enumerate(g):
+            out[i + j] = (out[i + j] - qi * gj) % p
+    return upoly_trim(out)
+
+
+def rational_reconstruction(xs, ys, p, degrees=None):
+    """
+    Find a univariate rational function n(t) / d(t) with d(0) = 1 through the points (xs, ys) modulo p.
+    If degrees = (deg n, deg d) is given, the extended Euclidean algorithm stops at the first remainder of degree at
+    most deg n. Otherwise, it returns the pair before the quotient of largest degree (maximal quotient rational
+    reconstruction), which is the right one when there are at least two more points than unknowns.
+    :return: The coefficients of n and d (lowest degree first), or None if there is no such rational function.
+    :rtype: A tuple of two lists, or None.
+    """
+    if all(y % p == 0 for y in ys):
+        return [], [1]
+    m = [1]
+    for x in xs:
+        m = upoly_sub_mul([0] + m, [x], m, p)
+    r0, r1 = m, upoly_trim(univariate_interpolate(xs, ys, p))
+    t0, t1 = [], [1]
+    best = None
+    while r1:
+        if degrees is not None and len(r1) - 1 <= degrees[0]:
+            best = (r1, t1)
+            break
+        q, r = upoly_divmod(r0, r1, p)
+        if degrees is None and (best is None or len(q) > best[0]):
+            best = (len(q), r1, t1)
+        r0, r1 = r1, r
+        t0, t1 = t1, upoly_sub_mul(t0, q, t1, p)
+    if best is None:
+        return None
+    n, d = best[-2:]
+    if degrees is None and best[0] - 1 < 2:
+        return None
+    if degrees is not None and len(d) - 1 > degrees[1]:
+        return None
+    if not d or d[0] % p == 0:
+        return None
+    inv = pow(d[0], -1, p)
+    return [c * inv % p for c in n], [c * inv % p for c in d]
+
+
+def tensor_interpolate(nodes, values, p):
+    """
+    Interpolate a polynomial in several variables from its values on a tensor grid modulo p.
+    :param nodes: The grid values of each variable; there are len(nodes[i]) - 1 as the degree bound in variable i.
+    :type nodes: List of lists of integers.
+    :param values: The values at the grid points, indexed by tuples of node positions.
+    :type values: A dictionary {tuple of integers: integer}.
+    :return: The polynomial as a dictionary {exponents: coefficient}.
+    :rtype: A dictionary.
+    """
+    coeffs = dict(values)
+    for axis, xs in enumerate(nodes):
+        out = {}
+        fibres = {}
+        for idx, v in coeffs.items():
+            fibres.setdefault(idx[:axis] + idx[axis + 1:], {})[idx[axis]] = v
+        for rest, fibre in fibres.items():
+            poly = univariate_interpolate(xs, [fibre.get(k, 0) for k in range(len(xs))], p)
+            for e, c in enumerate(poly):
+                if c:
+                    out[rest[:axis] + (e,) + rest[axis:]] = c
+        coeffs = out
+    return coeffs
+
+
+def shift_back(components, s, p):
+    """
+    Given the homogeneous components H_k(z) of a polynomial F(z t + s) = sum_k t^k H_k(z), return F(q), modulo p.
+    F(q) is the sum of H_k(q - s).
+    """
+    n = len(s)
+    out = {}
+    linear = [{tuple(int(i == v) for i in range(n)): 1, (0,) * n: (-s[v]) % p} for v in range(n)]
+    power_cache = {}
+
+    def power(v, e):
+        if (v, e) not in power_cache:
+            f = {(0,) * n: 1}
+            for _ in range(e):
+                f = poly_mul(f, linear[v], p)
+            power_cache[v, e] = f
+        return power_cache[v, e]
+
+    for h in components:
+        for monom, c in h.items():
+            term = {(0,) * n: c}
+            for v, e in enumerate(monom):
+                if e:
+                    term = poly_mul(term, power(v, e), p)
+            out = poly_add(out, term, p)
+    return out
+
+
+def crt(a, m, b, p):
+    "Return the integer modulo m * p that is a modulo m and b modulo p."
+    return a + m * ((b - a) * pow(m, -1, p) % p)
+
+
+def rational_number(c, m):
+    "Wang's rational reconstruction of c modulo m: a fraction a / b with |a|, |b| <= sqrt(m / 2), or None."
+    bound = int((m // 2) ** 0.5)
+    r0, r1 = m, c % m
+    t0, t1 = 0, 1
+    while r1 > bound:
+        q = r0 // r1
+        r0, r1 = r1, r0 - q * r1
+        t0, t1 = t1, t0 - q * t1
+    if t1 == 0 or abs(t1) > bound:
+        return None
+    return sympy.Rational(r1, t1)
+
+
+class Reconstructor:
+    "Reconstruct all absorption probabilities modulo one prime, by evaluating the system on lines."
+
+    def __init__(self, system, p, evaluate, rng):
+        self.system = system
+        self.p = p
+        self.evaluate = evaluate
+        self.rng = rng
+        self.n = len(system.gens)
+
+    def random_value(self):
+        return self.rng.randrange(1, self.p)
+
+    def line_values(self, lines, s):
+        """Evaluate the system at the points z t + s, for each direction z and each t in ts, where lines is a list of
+        pairs (z, ts). All the points are evaluated in one batch. Points where the system is singular are dropped.
+        Returns a list of pairs (ts, values), one for each line."""
+        p = self.p
+        points = [tuple((zi * t + si) % p for zi, si in zip(z, s)) for z, ts in lines for t in ts]
+        values = iter(self.evaluate(p, points))
+        out = []
+        for z, ts in lines:
+            good_ts, good_values = [], []
+            for t in ts:
+                vals = next(values)
+                if vals is not None:
+                    good_ts.append(t)
+                    good_values.append(vals)
+            out.append((good_ts, good_values))
+        return out
+
+    def degrees(self, s):
+        "Find the degrees of the numerators and denominators on a random line through s, or None if D(s) = 0."
+        z = [1] + [self.random_value() for _ in range(self.n - 1)]
+        num_points = 8
+        ts, values = [], []
+        while True:
+            new_ts = [self.random_value() for _ in range(num_points - len(ts))]
+            [(more_ts, more_values)] = self.line_values([(z, new_ts)], s)
+            ts += more_ts
+            values += more_values
+            result = []
+            for j in range(self.system.num_outputs):
+                rr = rational_reconstruction(ts[:-2], [v[j] for v in values[:-2]], self.p)
+                if rr is None or not self.check(rr, ts[-2:], [v[j] for v in values[-2:]]):
+                    result = None
+                    break
+                result.append((len(rr[0]) - 1, len(rr[1]) - 1))
+            if result is not None:
+                return result
+            if num_points > 4 * (self.system.ell + 2) + 8:
+                return None
+            num_points *= 2
+
+    def check(self, rr, ts, ys):
+        p = self.p
+        n, d = rr
+        for t, y in zip(ts, ys):
+            nv = sum(c * pow(t, k, p) for k, c in enumerate(n)) % p
+            dv = sum(c * pow(t, k, p) for k, c in enumerate(d)) % p
+            if dv == 0 or nv != y * dv % p:
+                return False
+        return True
+
+    def reconstruct(self):
+        """
+        Reconstruct the numerator and denominator of each absorption probability modulo p.
+        :return: A list of pairs (N, D) of polynomials as dictionaries {exponents: coefficient}, normalized so that the
+        coefficient of the smallest monomial of D (in graded lexicographic order) is 1, or None if this prime fails.
+        """
+        p = self.p
+        s = [0] * self.n
+        degs = self.degrees(s)
+        attempts = 0
+        while degs is None:
+            attempts += 1
+            if attempts > 3:
+                return None
+            s = [self.random_value() for _ in range(self.n)]
+            degs = self.degrees(s)
+
+        top = max(max(dn, dd) for dn, dd in degs)
+        num_ts = max(dn + dd for dn, dd in degs) + 2
+        nodes = [sorted(self.rng.sample(range(1, p), top + 1)) for _ in range(self.n - 1)]
+        grid = [()]
+        for v in range(self.n - 1):
+            grid = [g + (k,) for g in grid for k in range(top + 1)]
+
+        # comps[j][0][k] and comps[j][1][k] map each grid index to the coefficient of t^k in the numerator and the
+        # denominator of the jth probability.
+        comps = [([{} for _ in range(dn + 1)], [{} for _ in range(dd + 1)]) for dn, dd in degs]
+        lines = [([1] + [nodes[v][k] for v, k in enumerate(idx)], [self.random_value() for _ in range(num_ts)])
+                 for idx in grid]
+        for idx, (ts, values) in zip(grid, self.line_values(lines, s)):
+            for j, (dn, dd) in enumerate(degs):
+                rr = rational_reconstruction(ts, [v[j] for v in values], p, (dn, dd))
+                if rr is None:
+                    return None
+                for part in range(2):
+                    for k in range(len(comps[j][part])):
+                        comps[j][part][k][idx] = rr[part][k] if k < len(rr[part]) else 0
+
+        result = []
+        for j in range(len(degs)):
+            pair = []
+            for part in range(2):
+                homogeneous = []
+                for k, values in enumerate(comps[j][part]):
+                    dehomogenized = tensor_interpolate(nodes, values, p)
+                    h = {}
+                    for monom, c in dehomogenized.items():
+                        if sum(monom) > k:
+                            return None
+                        h[(k - sum(monom),) + monom] = c
+                    homogeneous.append(h)
+                pair.append(shift_back(homogeneous, s, p))
+            numer, denom = pair
+            if not denom:
+                return None
+            lowest = lowest_monomial(denom)
+            inv = pow(denom[lowest], -1, p)
+            result.append(({m: c * inv % p for m, c in numer.items()}, {m: c * inv % p for m, c in denom.items()}))
+        return result
+
+
+def absorption_probabilities(ell, i_minus_q, r, gens, sources=(0,), processes=None, seed=0, verbose=True):
+    """
+    Compute the probabilities of ending up at each absorbing state by modular evaluation and interpolation.
+    :param ell: The number of transient states.
+    :type ell: A positive integer.
+    :param i_minus_q: The nonzero entries of I - Q, as returned by state_space.absorbing_system().
+    :type i_minus_q: A dictionary {(row, col): symbolic expression}.
+    :param r: The nonzero entries of R, as returned by state_space.absorbing_system().
+    :type r: A dictionary {(row, col): symbolic expression}.
+    :param gens: The symbols that the entries depend on.
+    :type gens: List of sympy symbols.
+    :param sources: The transient states that the chain starts from. The systems for all of them are solved together.
+    :type sources: A sequence of nonnegative integers.
+    :param processes: The number of worker processes for the evaluations, or None to evaluate in this process.
+    :type processes: A positive integer or None.
+    :param seed: The seed for the random evaluation points.
+    :type seed: An integer.
+    :param verbose: Whether to print the progress prime by prime.
+    :type verbose: Boolean.
+    :return: For each source, the probability of ending up at each absorbing state, as a reduced fraction.
+    :rtype: List of lists of symbolic expressions.
+    """
+    gens = list(gens) if gens else [sympy.Dummy()]
+    system = ModularSystem(ell, i_minus_q, r, gens, sources)
+    rng = random.Random(seed)
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(system,)) if processes else None
+
+    def evaluate(p, points):
+        if pool is None:
+            return system.evaluate_many((p, points))
+        chunk = max(1, -(-len(points) // (4 * processes)))
+        chunks = [(p, points[k:k + chunk]) for k in range(0, len(points), chunk)]
+        return [v for part in pool.map(evaluate_in_worker, chunks) for v in part]
+
+    try:
+        p = FIRST_PRIME
+        modulus = 1
+        residues = None
+        previous = None
+        failures = 0
+        while True:
+            result = Reconstructor(system, p, evaluate, rng).reconstruct()
+            if result is not None and residues is not None and any(
+                    lowest_monomial(new[1]) != lowest_monomial(old[1]) for new, old in zip(result, residues)):
+                # The denominators are normalized differently, because a coefficient vanishes modulo this prime (or
+                # an earlier one).
+                result = None
+            if result is None:
+                failures += 1
+                if failures > MAX_FAILURES:
+                    raise Exception("modular reconstruction failed for " + str(failures) + " primes")
+                if verbose:
+                    print("Modular reconstruction: prime " + str(p) + " failed")
+                p = sympy.prevprime(p)
+                continue
+            if residues is None:
+                residues = result
+            else:
+                residues = [tuple({m: crt(old[part].get(m, 0), modulus, new[part].get(m, 0), p)
+                                   for m in set(old[part]) | set(new[part])} for part in range(2))
+                            for old, new in zip(residues, result)]
+            modulus *= p
+            current = [tuple({m: rational_number(c, modulus) for m, c in pair[part].items()} for part in range(2))
+                       for pair in residues]
+            if verbose:
+                print("Modular reconstruction: " + str(len(str(modulus))) + " digit modulus")
+            p = sympy.prevprime(p)
+            ok = all(c is not None for pair in current for part in pair for c in part.values())
+            if ok and current == previous and verify(system, current, p, evaluate, rng):
+                break
+            previous = current if ok else None
+    finally:
+        if pool is not None:
+            pool.close()
+
+    out = []
+    for numer, denom in current:
+        n_expr = sum((c * sympy.prod([g ** e for g, e in zip(gens, m)]) for m, c in numer.items()), sympy.Integer(0))
+        d_expr = sum((c * sympy.prod([g ** e for g, e in zip(gens, m)]) for m, c in denom.items()), sympy.Integer(0))
+        out.append(sympy.cancel(n_expr / d_expr))
+    return [out[k:k + system.num_absorbing] for k in range(0, len(out), system.num_absorbing)]
+
+
+def verify(system, candidate, p, evaluate, rng, num_points=3):
+    "Check the candidate fractions against the system at random points modulo the prime p."
+    n = len(system.gens)
+    points = [tuple(rng.randrange(p) for _ in range(n)) for _ in range(num_points)]
+
+    def value(poly, point):
+        total = 0
+        for m, c in poly.items():
+            term = c.p * pow(c.q, -1, p)
+            for x, e in zip(point, m):
+                term = term * pow(x, e, p) % p
+            total += term
+        return total % p
+
+    for point, vals in zip(points, evaluate(p, points)):
+        if vals is None:
+            continue
+        for (numer, denom), v in zip(candidate, vals):
+            if value(numer, point) != v * value(denom, point) % p:
+                return False
+    return True
@@ -0,0 +1,297 @@
+"""
+Explore the state space of the ARW on disk, for graphs whose states and transitions do not fit in memory.
+The breadth-first search proceeds one level at a time. The states of each level are appended to a file of fixed-width
+packed keys (see state_space.py), sorted within the level, and the transitions are appended to a file of fixed-width
+records. The successors found in a level are deduplicated by an external sort-merge: they are sorted in runs that fit
+in the memory budget, the runs are merged, and the merged keys are looked up in the (sorted) earlier levels with a
+binary search on the memory-mapped key file. At the end, the transitions are resolved from keys to indices with the
+same kind of lookup in a sorted copy of all the keys.
+
+The resulting DiskChain reads everything through memory-mapped arrays. It can build the sparse matrices for the
+numeric solve of stationary_dist_numeric.py chunk by chunk, or stream the transitions to reduction.py and
+stationary_dist.py. The symbolic reduction and solve then hold the chain in memory, so only the exploration and the
+numeric solve are bounded by the memory budget.
+The states are numbered level by level, and by key within a level, which is not the order of state_space.explore();
+the initial state has index 0 either way.
+
+External dependencies: numpy, scipy, state_space.py.
+"""
+import heapq
+import itertools
+import json
+import os
+import numpy
+import scipy.sparse
+import state_space
+
+# The transitions on disk. kind is 0 when the probability is the sleep probability of the firing vertex ('stay' or
+# 'sleep' in state_space.successors()) and 1 when it is (1 - sleep probability) / degree ('jump').
+PENDING = numpy.dtype([('row', '<i8'), ('key', '<u8'), ('vertex', '<i2'), ('kind', '<i1')])
+TRANSITION = numpy.dtype([('row', '<i8'), ('col', '<i8'), ('vertex', '<i2'), ('kind', '<i1')])
+# The smallest number of records in a chunk, whatever the memory budget.
+MIN_CHUNK = 1024
+
+
+def _append(path, array):
+    with open(path, 'ab') as out_file:
+        array.tofile(out_file)
+
+
+def _memmap(path, dtype):
+    "Map a file of records, which may be empty."
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r')
+
+
+def _blocks(array, size):
+    for start in range(0, len(array), size):
+        yield array[start:start + size]
+
+
+def _merge_unique(runs, size):
+    "Merge sorted files of keys into one sorted stream without duplicates, reading each file size keys at a time."
+    def read(path):
+        for block in _blocks(_memmap(path, numpy.uint64), size):
+            yield from block.tolist()
+
+    previous = None
+    for key in heapq.merge(*[read(path) for path in runs]):
+        if key != previous:
+            yield key
+            previous = key
+
+
+def _in_sorted(keys, sorted_keys):
+    "Return a mask of the keys that occur in an array of sorted keys."
+    if len(sorted_keys) == 0:
+        return numpy.zeros(len(keys), dtype=bool)
+    pos = numpy.searchsorted(sorted_keys, keys)
+    pos[pos == len(sorted_keys)] = 0
+    return sorted_keys[pos] == keys
+
+
+def explore_out_of_core(a, path, initial_state=None, bits=2, memory_budget=2 ** 28):
+    """
+    Explore all states of the ARW that are reachable from an initial state, keeping the states and transitions on disk.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param path: The folder for the files. It is created if necessary, and the files of an earlier exploration in it
+    are overwritten.
+    :type path: A string.
+    :param initial_state: The initial state. By default, one active particle at each non-sink vertex.
+    :type initial_state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    :param bits: The number of bits used for each vertex in the packed states. The packed keys must fit in 64 bits.
+    :type bits: A positive integer.
+    :param memory_budget: The approximate number of bytes of records held in memory at once.
+    :type memory_budget: A positive integer.
+    :return: The explored chain.
+    :rtype: DiskChain.
+    """
+    n = len(a) - 1
+    if bits * n > 64:
+        raise ValueError('The packed states of {} vertices with {} bits do not fit in 64 bits.'.format(n, bits))
+    chunk = max(MIN_CHUNK, memory_budget // (4 * PENDING.itemsize))
+    os.makedirs(path, exist_ok=True)
+    files = {name: os.path.join(path, name + '.bin') for name in
+             ('keys', 'pending', 'transitions', 'absorbing', 'sorted-keys', 'sorted-index')}
+    for name in files.values():
+        if os.path.exists(name):
+            os.remove(name)
+
+    start = state_space.encode_state([1] * n if initial_state is None else initial_state, bits)
+    _append(files['keys'], numpy.array([start], dtype=numpy.uint64))
+    levels = [(0, 1)]  # (first index, number of states) of each level
+    num_states = 1
+    while True:
+        (first, count) = levels[-1]
+        keys = _memmap(files['keys'], numpy.uint64)
+        runs = []
+        records = []
+        successor_keys = []
+        absorbing = []
+
+        def flush_runs():
+            if successor_keys:
+                runs.append(os.path.join(path, 'run-{}.bin'.format(len(runs))))
+                numpy.unique(numpy.array(successor_keys, dtype=numpy.uint64)).tofile(runs[-1])
+                successor_keys.clear()
+
+        def flush_records():
+            if records:
+                _append(files['pending'], numpy.array(records, dtype=PENDING))
+                records.clear()
+
+        # Expand the states of the level, in blocks.
+        for offset, block in enumerate(_blocks(keys[first:first + count], chunk)):
+            for j, key in enumerate(block.tolist()):
+                idx = first + offset * chunk + j
+                v = state_space.firing_vertex(key, n, bits)
+                if v is None:
+                    absorbing.append(idx)
+                    continue
+                for new_key, kind in state_space.successors(key, v, a, bits):
+                    records.append((idx, new_key, v, 1 if kind == 'jump' else 0))
+                    successor_keys.append(new_key)
+                if len(records) >= chunk:
+                    flush_records()
+                if len(successor_keys) >= chunk:
+                    flush_runs()
+        flush_records()
+        flush_runs()
+        if absorbing:
+            _append(files['absorbing'], numpy.array(absorbing, dtype=numpy.int64))
+
+        # Deduplicate the successors against each other and against the levels found so far.
+        new_count = 0
+        merged = _merge_unique(runs, max(1, chunk // (len(runs) + 1)))
+        while True:
+            block = numpy.array(list(itertools.islice(merged, chunk)), dtype=numpy.uint64)
+            if len(block) == 0:
+                break
+            seen = numpy.zeros(len(block), dtype=bool)
+            for (level_first, level_count) in levels:
+                seen |= _in_sorted(block, keys[level_first:level_first + level_count])
+            fresh = block[~seen]
+            _append(files['keys'], fresh)
+            new_count += len(fresh)
+        for run in runs:
+            os.remove(run)
+        if new_count == 0:
+            break
+        levels.append((num_states, new_count))
+        num_states += new_count
+
+    # Sort all the keys, with their indices, by merging the levels.
+    keys = _memmap(files['keys'], numpy.uint64)
+    size = max(1, chunk // (len(levels) + 1))
+
+    def level_items(level_first, level_count):
+        for offset, block in enumerate(_blocks(keys[level_first:level_first + level_count], size)):
+            yield from zip(block.tolist(), range(level_first + offset * size, level_first + offset * size + len(block)))
+
+    merged = heapq.merge(*[level_items(f, c) for (f, c) in levels])
+    while True:
+        items = list(itertools.islice(merged, chunk))
+        if not items:
+            break
+        _append(files['sorted-keys'], numpy.array([k for k, _ in items], dtype=numpy.uint64))
+        _append(files['sorted-index'], numpy.array([i for _, i in items], dtype=numpy.int64))
+
+    # Resolve the successors from keys to indices.
+    sorted_keys = _memmap(files['sorted-keys'], numpy.uint64)
+    sorted_index = _memmap(files['sorted-index'], numpy.int64)
+    for block in _blocks(_memmap(files['pending'], PENDING), chunk):
+        out = numpy.empty(len(block), dtype=TRANSITION)
+        out['row'] = block['row']
+        out['col'] = sorted_index[numpy.searchsorted(sorted_keys, block['key'])]
+        out['vertex'] = block['vertex']
+        out['kind'] = block['kind']
+        _append(files['transitions'], out)
+    os.remove(files['pending'])
+
+    with open(os.path.join(path, 'meta.json'), 'w') as out_file:
+        json.dump({'n': n, 'bits': bits, 'degrees': [len(a[v]) for v in range(n)], 'num_states': num_states},
+                  out_file)
+    return DiskChain(path)
+
+
+class DiskChain:
+    """An absorbing chain explored by explore_out_of_core(), read through memory-mapped arrays. It can be opened again
+    from its folder without exploring again."""
+
+    def __init__(self, path):
+        """
+        :param path: The folder of the files written by explore_out_of_core().
+        :type path: A string.
+        """
+        with open(os.path.join(path, 'meta.json')) as in_file:
+            meta = json.load(in_file)
+        self.path = path
+        self.n = meta['n']
+        self.bits = meta['bits']
+        self.degrees = numpy.array(meta['degrees'], dtype=float)
+        self.num_states = meta['num_states']
+        self.keys = _memmap(os.path.join(path, 'keys.bin'), numpy.uint64)
+        self.transitions = _memmap(os.path.join(path, 'transitions.bin'), TRANSITION)
+        self.absorbing = _memmap(os.path.join(path, 'absorbing.bin'), numpy.int64)
+        self.sorted_keys = _memmap(os.path.join(path, 'sorted-keys.bin'), numpy.uint64)
+        self.sorted_index = _memmap(os.path.join(path, 'sorted-index.bin'), numpy.int64)
+
+    def __len__(self):
+        return self.num_states
+
+    def state(self, idx):
+        "Return the state with index idx as a list."
+        return state_space.decode_state(int(self.keys[idx]), self.n, self.bits)
+
+    def states(self, indices=None):
+        "Return the states with the given indices (by default, all of them) as lists."
+        if indices is None:
+            indices = range(self.num_states)
+        return [self.state(i) for i in indices]
+
+    def find(self, state):
+        "Return the index of a state given as a list, or None if it was not explored."
+        key = state_space.encode_state(state, self.bits)
+        pos = int(numpy.searchsorted(self.sorted_keys, numpy.uint64(key)))
+        if pos < len(self.sorted_keys) and int(self.sorted_keys[pos]) == key:
+            return int(self.sorted_index[pos])
+        return None
+
+    def iter_transitions(self, sleep_probs, chunk=2 ** 16):
+        """
+        Generate the transitions (row, col, prob) with the given sleep probabilities, reading chunk records at a time.
+        :param sleep_probs: The sleep probabilities at each non-sink vertex.
+        :type sleep_probs: List of symbolic expressions (or numbers).
+        """
+        jump_probs = [(1 - sleep_probs[v]) / int(self.degrees[v]) for v in range(self.n)]
+        probs = (sleep_probs, jump_probs)
+        for block in _blocks(self.transitions, chunk):
+            for (row, col, v, kind) in zip(block['row'].tolist(), block['col'].tolist(), block['vertex'].tolist(),
+                                           block['kind'].tolist()):
+                yield row, col, probs[kind][v]
+
+    def transition_list(self, sleep_probs):
+        "Return the transitions as a list, in the format of state_space.explore(), e.g. for reduction.reduce_chain()."
+        return list(self.iter_transitions(sleep_probs))
+
+    def numeric_system(self, sleep_probs, chunk=2 ** 20):
+        """
+        Build the matrices I - Q and R for numeric sleep probabilities, as stationary_dist_numeric.sparse_system() does,
+        from the records on disk, chunk records at a time.
+        :param sleep_probs: The sleep probabilities at each non-sink vertex.
+        :type sleep_probs: List of numbers in [0, 1).
+        :return: The transient states, I - Q (in CSC format) and R (in CSR format).
+        :rtype: A tuple with three elements.
+        """
+        q = numpy.array([float(p) for p in sleep_probs])
+        jump = (1 - q) / self.degrees
+        is_absorbing = numpy.zeros(self.num_states, dtype=bool)
+        is_absorbing[self.absorbing] = True
+        transient = numpy.flatnonzero(~is_absorbing)
+        position = numpy.empty(self.num_states, dtype=numpy.int64)
+        position[transient] = numpy.arange(len(transient))
+        position[self.absorbing] = numpy.arange(len(self.absorbing))
+        ell = len(transient)
+        q_parts = ([numpy.arange(ell)], [numpy.arange(ell)], [numpy.ones(ell)])
+        r_parts = ([], [], [])
+        for block in _blocks(self.transitions, chunk):
+            v = block['vertex']
+            prob = numpy.where(block['kind'] == 1, jump[v], q[v])
+            rows = position[block['row']]
+            cols = position[block['col']]
+            to_absorbing = is_absorbing[block['col']]
+            for parts, mask, sign in ((q_parts, ~to_absorbing, -1.0), (r_parts, to_absorbing, 1.0)):
+                parts[0].append(rows[mask])
+                parts[1].append(cols[mask])
+                parts[2].append(sign * prob[mask])
+
+        def to_sparse(parts, shape):
+            if not parts[0]:
+                return scipy.sparse.coo_matrix(shape)
+            return scipy.sparse.coo_matrix((numpy.concatenate(parts[2]),
+                                            (numpy.concatenate(parts[0]), numpy.concatenate(parts[1]))), shape=shape)
+
+        return (transient.tolist(), to_sparse(q_parts, (ell, ell)).tocsc(),
+                to_sparse(r_parts, (ell, len(self.absorbing))).tocsr())
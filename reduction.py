@@ -0,0 +1,133 @@
+"""
+Reduce an absorbing Markov chain before the linear solve, without changing the probabilities of ending up at each
+absorbing state.
+Two exact rules are applied to the transient states:
+A self-loop with probability p at a state is removed by dividing the other outgoing probabilities of the state by 1 - p.
+A state s is eliminated by replacing each pair of transitions u -> s -> w with a transition u -> w whose probability is
+the product of the two (added to any existing transition u -> w). This is done whenever it does not increase the
+number of transitions, which covers states with a single successor (pass-through states) and states with a single
+predecessor.
+The arithmetic is done in the field of rational functions of the sleep probabilities, so every probability stays a
+reduced fraction. Alternatively, only the self-loops of the given chain are removed in that field, and the states are
+eliminated in another domain, such as the truncated power series of stationary_dist_series.py.
+
+External dependencies: none.
+"""
+import sympy
+
+
+def reduce_chain(num_states, transitions, absorbing, keep=(0,), domain=None):
+    """
+    Remove self-loops and eliminate transient states of an absorbing chain, keeping the absorption probabilities.
+    :param num_states: The number of states.
+    :type num_states: A nonnegative integer.
+    :param transitions: The transitions (row, col, prob) between states, as returned by state_space.explore().
+    :type transitions: An iterable of tuples, which is read once.
+    :param absorbing: The indices of the absorbing states.
+    :type absorbing: List of integers.
+    :param keep: The indices of transient states that must not be eliminated, typically the initial states.
+    :type keep: An iterable of integers.
+    :param domain: The domain in which the states are eliminated, or None for the field of rational functions. The
+    self-loops of the given transitions are always removed in the field of rational functions; the probabilities are
+    then converted with domain.from_sympy(), and the elimination uses domain.zero and the arithmetic of its elements.
+    :type domain: An object with zero and from_sympy(), e.g. stationary_dist_series.SeriesRing, or None.
+    :return: The remaining states, the transitions between them and the absorbing states, plus some statistics.
+    :rtype: A tuple with four elements.
+    The first element is the list of the indices of the remaining states, in increasing order; the other elements refer
+    to states by their position in this list.
+    The second element is the list of transitions (row, col, prob); there are no self-loops on transient states. The
+    probabilities are symbolic expressions, or elements of the domain if it is given.
+    The third element is the list of positions of the absorbing states, in the same order as absorbing.
+    The fourth element is a dictionary with the number of transient states and transitions before and after the
+    reduction, and the number of self-loops removed.
+    """
+    absorbing_set = set(absorbing)
+    keep = set(keep)
+    # out[i] and inc[i] are the successors and predecessors of state i, as dictionaries {state: prob}.
+    # The transitions are read once, so they can come from a generator such as out_of_core.DiskChain.iter_transitions();
+    # the (few) distinct probabilities are converted to the field afterwards.
+    out = [dict() for _ in range(num_states)]
+    inc = [dict() for _ in range(num_states)]
+    num_transitions = 0
+    for (i, j, prob) in transitions:
+        out[i][j] = out[i][j] + prob if j in out[i] else prob
+        num_transitions += 1
+    probs = set(p for successors in out for p in successors.values())
+    gens = sorted(set().union(*(sympy.sympify(p).free_symbols for p in probs)), key=sympy.default_sort_key)
+    K = sympy.QQ.frac_field(*gens) if gens else sympy.QQ.frac_field(sympy.Dummy())
+    to_field = {p: K.from_sympy(sympy.sympify(p)) for p in probs}
+    for i in range(num_states):
+        for j, p in out[i].items():
+            out[i][j] = to_field[p]
+            inc[j][i] = out[i][j]
+    stats = {'transient states before': num_states - len(absorbing), 'transitions before': num_transitions,
+             'self-loops removed': 0}
+
+    def remove_self_loop(i):
+        p = out[i].pop(i, None)
+        if p is None:
+            return
+        del inc[i][i]
+        scale = 1 / (1 - p)
+        for j in out[i]:
+            out[i][j] *= scale
+            inc[j][i] = out[i][j]
+        stats['self-loops removed'] += 1
+
+    def eliminate(s):
+        for u, p in inc[s].items():
+            del out[u][s]
+            for w, r in out[s].items():
+                prob = out[u].get(w, K.zero) + p * r
+                if prob:
+                    out[u][w] = prob
+                    inc[w][u] = prob
+                else:
+                    out[u].pop(w, None)
+                    inc[w].pop(u, None)
+        for w in out[s]:
+            del inc[w][s]
+        preds = list(inc[s])
+        out[s] = {}
+        inc[s] = {}
+        for u in preds:
+            remove_self_loop(u)
+
+    transient = [i for i in range(num_states) if i not in absorbing_set]
+    for i in transient:
+        remove_self_loop(i)
+    if domain is not None:
+        # The self-loops that were just removed can have probability 1 at a point, e.g. q = 1, where domain could not
+        # divide by 1 - p; the eliminations below only create self-loops from cycles through the eliminated states.
+        converted = {}
+        for i in range(num_states):
+            for j, p in out[i].items():
+                if p not in converted:
+                    converted[p] = domain.from_sympy(K.to_sympy(p))
+                out[i][j] = converted[p]
+                inc[j][i] = converted[p]
+        K = domain
+
+    removed = set()
+    candidates = [i for i in transient if i not in keep]
+    while candidates:
+        next_candidates = set()
+        for s in candidates:
+            if s in removed:
+                continue
+            (d_in, d_out) = (len(inc[s]), len(out[s]))
+            if (d_in - 1) * (d_out - 1) > 1:
+                continue
+            neighbours = set(inc[s]) | set(out[s])
+            eliminate(s)
+            removed.add(s)
+            next_candidates |= neighbours
+        candidates = sorted(u for u in next_candidates - removed - keep - absorbing_set)
+
+    remaining = [i for i in range(num_states) if i not in removed]
+    position = {old: new for new, old in enumerate(remaining)}
+    new_transitions = [(position[i], position[j], p if domain is not None else K.to_sympy(p))
+                       for i in remaining for j, p in out[i].items()]
+    stats['transient states after'] = stats['transient states before'] - len(removed)
+    stats['transitions after'] = len(new_transitions)
+    return remaining, new_transitions, [position[i] for i in absorbing], stats
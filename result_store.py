@@ -0,0 +1,201 @@
+"""
+Store a stationary distribution in a compact .npz file instead of a pickle of sympy expressions.
+The stable states are stored as packed integer keys (see state_space.py), and the probabilities in the
+shared-denominator form of shared_denominator.py: the numerator of each state and the common denominator are stored as
+sparse polynomials, i.e. an array of exponent vectors and arrays of coefficients, with an array of offsets marking where
+each polynomial starts. Loading the file does not build any sympy objects; ResultStore reads the arrays lazily and
+builds only the states and polynomials that are asked for, and can specialize to one sleep probability q directly on
+the exponent arrays.
+
+The conversion is lossless: ResultStore(path).to_sd() is equal, entry by entry, to the distribution that was saved.
+Running this file converts the pickles in the 'data' folder, including pickles written by older versions of sympy
+(see load_pickle()).
+
+External dependencies: numpy, sympy, shared_denominator.py, state_space.py.
+"""
+from fractions import Fraction
+import glob
+import os
+import pickle
+import numpy
+import sympy
+from sympy.polys.rings import ring
+import shared_denominator
+import state_space
+
+INT64_MAX = numpy.iinfo(numpy.int64).max
+
+
+def load_pickle(path):
+    """
+    Read a stationary distribution (states, probabilities) from a pickle written by stationary_dist.py.
+    Pickles written by older versions of sympy keep the entries of a matrix in the attribute '_mat', which newer
+    versions do not read, so such matrices are rebuilt from it.
+    :param path: The path of the pickle.
+    :type path: A string.
+    :return: The stable states and a row vector of probabilities.
+    :rtype: A tuple with two elements.
+    """
+    with open(path, 'rb') as in_file:
+        (states, dist) = pickle.loads(in_file.read())
+    if '_mat' in getattr(dist, '__dict__', {}):
+        legacy = vars(dist)
+        dist = sympy.Matrix(legacy['rows'], legacy['cols'], list(legacy['_mat']))
+    return states, dist
+
+
+def _coefficient_array(values):
+    "Store integers as int64 if they all fit, and as decimal strings otherwise."
+    if all(abs(v) <= INT64_MAX for v in values):
+        return numpy.array(values, dtype=numpy.int64)
+    return numpy.array([str(v) for v in values], dtype=numpy.str_)
+
+
+def save(path, sd, gens=None):
+    """
+    Save a stationary distribution to an .npz file.
+    :param path: The path of the file.
+    :type path: A string, typically ending in '.npz'.
+    :param sd: The stationary distribution.
+    :type sd: A tuple (states, probabilities), such as the output of stationary_dist(), or a
+    shared_denominator.SharedDenominatorDist.
+    :param gens: The sleep probabilities, as in SharedDenominatorDist.from_sd(). Ignored if sd is a
+    SharedDenominatorDist.
+    :type gens: List of sympy symbols, or None.
+    """
+    if not isinstance(sd, shared_denominator.SharedDenominatorDist):
+        sd = shared_denominator.SharedDenominatorDist.from_sd(sd, gens)
+    n = len(sd.states[0])
+    keys = numpy.array([state_space.encode_state(state, bits=1) for state in sd.states], dtype=numpy.int64)
+    offsets = [0]
+    exponents = []
+    coeff_num = []
+    coeff_den = []
+    for p in sd.numerators + [sd.denominator]:
+        p = sd.ring(p)
+        for monom, coeff in sorted(p.terms()):
+            exponents.append(monom)
+            coeff_num.append(int(coeff.numerator))
+            coeff_den.append(int(coeff.denominator))
+        offsets.append(len(exponents))
+    ngens = sd.ring.ngens
+    numpy.savez(path,
+                n=numpy.array(n), bits=numpy.array(1), keys=keys,
+                gens=numpy.array([str(g) for g in sd.ring.symbols], dtype=numpy.str_),
+                offsets=numpy.array(offsets, dtype=numpy.int64),
+                exponents=numpy.array(exponents, dtype=numpy.int32).reshape(len(exponents), ngens),
+                coeff_num=_coefficient_array(coeff_num), coeff_den=_coefficient_array(coeff_den))
+
+
+class ResultStore:
+    """A stationary distribution saved by save(). Each array is read from the file once, when it is first used, and kept;
+    sympy objects are only built for the entries that are asked for."""
+
+    def __init__(self, path):
+        """
+        :param path: The path of a file written by save().
+        :type path: A string.
+        """
+        self.data = numpy.load(path)
+        self.n = int(self.data['n'])
+        self.bits = int(self.data['bits'])
+        self.gens = sympy.symbols(list(self.data['gens']))
+        self.ring = ring(self.gens, sympy.QQ)[0]
+        self._arrays = {}
+
+    def array(self, name):
+        "Return the array with the given name, reading it from the file the first time."
+        # Indexing the NpzFile reads the whole array again each time, so each array is read once and kept.
+        if name not in self._arrays:
+            self._arrays[name] = self.data[name]
+        return self._arrays[name]
+
+    def __len__(self):
+        return len(self.array('keys'))
+
+    @property
+    def offsets(self):
+        return self.array('offsets')
+
+    def state(self, s):
+        "Return the stable state with index s."
+        return state_space.decode_state(int(self.array('keys')[s]), self.n, self.bits)
+
+    def states(self):
+        "Return the list of stable states."
+        return [state_space.decode_state(int(key), self.n, self.bits) for key in self.array('keys')]
+
+    def _terms(self, s):
+        "Return the exponent vectors and coefficients of the polynomial with index s (len(self) is the denominator)."
+        (start, stop) = (self.offsets[s], self.offsets[s + 1])
+        exponents = self.array('exponents')[start:stop]
+        coeffs = [Fraction(int(a), int(b)) for a, b in zip(self.array('coeff_num')[start:stop],
+                                                           self.array('coeff_den')[start:stop])]
+        return exponents, coeffs
+
+    def _poly(self, s):
+        (exponents, coeffs) = self._terms(s)
+        return self.ring({tuple(int(e) for e in monom): sympy.QQ(c.numerator, c.denominator)
+                          for monom, c in zip(exponents, coeffs)})
+
+    def numerator(self, s):
+        "Return the numerator of the probability of the stable state with index s, as a polynomial in self.ring."
+        return self._poly(s)
+
+    def denominator(self):
+        "Return the common denominator, as a polynomial in self.ring."
+        return self._poly(len(self))
+
+    def probability(self, s):
+        "Return the probability of the stable state with index s, as a symbolic expression."
+        return (self.ring.to_field()(self.numerator(s)) / self.ring.to_field()(self.denominator())).as_expr()
+
+    def to_shared(self):
+        """
+        :return: The whole distribution.
+        :rtype: shared_denominator.SharedDenominatorDist.
+        """
+        return shared_denominator.SharedDenominatorDist(self.states(), [self.numerator(s) for s in range(len(self))],
+                                                        self.denominator())
+
+    def to_sd(self):
+        """
+        :return: The whole distribution in the format of stationary_dist(): the stable states and a row vector of
+        probabilities.
+        :rtype: A tuple with two elements.
+        """
+        return self.to_shared().to_sd()
+
+    def univariate(self, symbol):
+        """
+        Set all the sleep probabilities equal to one symbol, e.g. q. The total degree of every term is computed on the
+        exponent array, so the multivariate polynomials are never built.
+        :return: The specialized distribution, with numerators and denominator in QQ[symbol].
+        :rtype: shared_denominator.SharedDenominatorDist.
+        """
+        R = ring([symbol], sympy.QQ)[0]
+        degrees = self.array('exponents').sum(axis=1)
+        coeff_num = self.array('coeff_num')
+        coeff_den = self.array('coeff_den')
+        polys = []
+        for s in range(len(self) + 1):
+            coeffs = {}
+            for i in range(self.offsets[s], self.offsets[s + 1]):
+                d = int(degrees[i])
+                coeffs[d] = coeffs.get(d, 0) + Fraction(int(coeff_num[i]), int(coeff_den[i]))
+            polys.append(R({(d,): sympy.QQ(c.numerator, c.denominator) for d, c in coeffs.items() if c != 0}))
+        return shared_denominator.SharedDenominatorDist(self.states(), polys[:-1], polys[-1])
+
+
+if __name__ == "__main__":
+    data_path = os.path.join(os.path.dirname(__file__), 'data/')
+    for pickle_path in sorted(glob.glob(data_path + '*.pickle')):
+        sd = load_pickle(pickle_path)
+        gens = sympy.symbols(['q_{}'.format(x) for x in range(len(sd[0][0]))])
+        store_path = pickle_path[:-len('.pickle')] + '.npz'
+        save(store_path, sd, gens)
+        # Check that the conversion is lossless.
+        stored = ResultStore(store_path).to_sd()
+        assert stored[0] == sd[0]
+        assert all(sympy.cancel(stored[1][s] - sd[1][s]) == 0 for s in range(len(sd[0])))
+        print("Converted " + store_path)
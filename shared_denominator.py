@@ -0,0 +1,108 @@
+"""
+Store a stationary distribution as polynomials over one common denominator.
+The probabilities in the output of stationary_dist() share their denominator (up to factors that cancel in some
+entries), so they are stored as numerator polynomials N_s together with the least common multiple D of their
+denominators, in the sparse polynomial ring QQ[q_0, ..., q_{n-1}] of sympy. Sums of probabilities are then sums of
+numerators, and products are products of numerators over a power of D, which avoids the gcd computations that sympy does
+when it adds rational expressions. The results are only converted to expressions (and factored) for output.
+
+External dependencies: sympy.
+"""
+import sympy
+from sympy.polys.rings import ring
+
+
+class SharedDenominatorDist:
+    """A stationary distribution whose probabilities are numerators[s] / denominator for the stable states s.
+    The numerators and the denominator are elements of the polynomial ring self.ring."""
+
+    def __init__(self, states, numerators, denominator):
+        """
+        :param states: The stable states.
+        :type states: List of lists whose elements are 0 or 's', one for each non-sink vertex.
+        :param numerators: The numerators of the probabilities of the stable states.
+        :type numerators: List of polynomials (sympy PolyElement), all in the same ring.
+        :param denominator: The common denominator.
+        :type denominator: A polynomial (sympy PolyElement) in the same ring.
+        """
+        if len(states) != len(numerators):
+            raise ValueError('The number of states does not match the number of entries in the distribution vector.')
+        self.states = states
+        self.numerators = numerators
+        self.denominator = denominator
+        self.ring = denominator.ring
+
+    def __len__(self):
+        return len(self.states)
+
+    @classmethod
+    def from_sd(cls, sd, gens=None):
+        """
+        Convert a stationary distribution (states, probabilities), such as the output of stationary_dist().
+        :param sd: The stationary distribution.
+        :type sd: A tuple with two elements: a list of stable states and a row vector (or list) of symbolic expressions.
+        :param gens: The symbols of the polynomial ring. By default, the free symbols of the probabilities, sorted.
+        :type gens: List of sympy symbols, or None.
+        :return: The distribution over the least common denominator.
+        :rtype: SharedDenominatorDist.
+        """
+        (states, dist) = sd
+        dist = list(dist)
+        if gens is None:
+            gens = sorted(set().union(*(sympy.sympify(p).free_symbols for p in dist)), key=sympy.default_sort_key)
+        R = ring(list(gens) or [sympy.Dummy()], sympy.QQ)[0]
+        K = R.to_field()
+        fracs = [K.from_expr(sympy.sympify(p)) if p != 0 else K.zero for p in dist]
+        denominator = R.one
+        for f in fracs:
+            denominator = denominator.lcm(f.denom)
+        numerators = [f.numer * denominator.exquo(f.denom) for f in fracs]
+        # Make the denominator monic, so that the representation does not depend on the order of the states.
+        lc = denominator.LC
+        return cls(states, [p.quo_ground(lc) for p in numerators], denominator.quo_ground(lc))
+
+    def to_sd(self):
+        """
+        Convert back to a stationary distribution (states, probabilities) like the output of stationary_dist().
+        :return: The stable states and a row vector of reduced fractions.
+        :rtype: A tuple with two elements.
+        """
+        return self.states, sympy.Matrix([[self.expr(p) for p in self.numerators]])
+
+    def expr(self, numerator, power=1):
+        "Return numerator / denominator^power as a symbolic expression, with the common factors cancelled."
+        f = self.ring.to_field()(numerator) / self.ring.to_field()(self.denominator ** power)
+        return f.as_expr()
+
+    def total(self, indices):
+        "Return the numerator of the sum of the probabilities of the states with the given indices."
+        out = self.ring.zero
+        for s in indices:
+            out += self.numerators[s]
+        return out
+
+    def specialize(self, symbol):
+        """
+        Set all the sleep probabilities equal to one symbol, e.g. q.
+        :return: The distribution with numerators and denominator in QQ[symbol].
+        :rtype: SharedDenominatorDist.
+        """
+        R = ring([symbol], sympy.QQ)[0]
+        return SharedDenominatorDist(self.states, [collapse(p, R) for p in self.numerators],
+                                     collapse(self.denominator, R))
+
+
+def collapse(p, R):
+    """
+    Set all the variables of a polynomial equal to the variable of the univariate ring R.
+    :param p: A polynomial.
+    :type p: sympy PolyElement.
+    :param R: A polynomial ring in one variable over QQ.
+    :type R: sympy PolyRing.
+    :return: The polynomial in R.
+    :rtype: sympy PolyElement.
+    """
+    out = R.zero
+    for monom, coeff in p.terms():
+        out += R({(sum(monom),): coeff})
+    return out
@@ -1,5 +1,7 @@
 # HAC, 2020-10-15
 
+import heapq
+import time
 from sympy import *
 from progressbar import progressbar
 
@@ -20,6 +22,25 @@ def generate_progress_callback():
     return cb
 
 
+def _expr_size(e):
+    "The total degrees and numbers of terms of the numerator and denominator of a sympy expression."
+    n, d = fraction(e)
+    return int(total_degree(n)), len(Add.make_args(n)), int(total_degree(d)), len(Add.make_args(d))
+
+
+def _field_size(v):
+    "The total degrees and numbers of terms of the numerator and denominator of an element of a field of fractions."
+    return (max((sum(monom) for monom in v.numer), default=0), len(v.numer),
+            max((sum(monom) for monom in v.denom), default=0), len(v.denom))
+
+
+def _largest_sizes(sizes):
+    "The largest degrees and numbers of terms among some sizes, as keyword arguments for a pivot() method."
+    sizes = list(sizes)
+    keys = ("max numer degree", "max numer terms", "max denom degree", "max denom terms")
+    return {key: max((size[k] for size in sizes), default=0) for k, key in enumerate(keys)}
+
+
 def inv(a, b, progress_callback=None, singular_callback=None):
     """Solve xa = b by doing column operations.
     This function destroys the original matrix a.
@@ -29,6 +50,12 @@ def inv(a, b, progress_callback=None, singular_callback=None):
       progress_callback("backward", i)
       progress_callback("done", i)
     If progress_callback is None, this is displayed by a progressbar() so you can see how things are going.
+    If progress_callback has a pivot() method, like solver_metrics.SolverMetrics, it also calls
+      progress_callback.pivot("expr", i, seconds=..., degree=..., ...)
+    after each pivot step with the time of the step, the calls to cancel(), the column operations, the fill-in and the
+    sizes of the entries of the next row of a and of the pivot column of x, and
+      progress_callback.substitution("expr", seconds, ...)
+    after the back substitution with its time and its calls to cancel(); otherwise none of this is measured.
 
     If a is singular, then:
       if singular_callback is None, the function dies with an Exception()
@@ -40,18 +67,20 @@ def inv(a, b, progress_callback=None, singular_callback=None):
     assert x.cols == a.cols
     if not progress_callback:
         progress_callback = generate_progress_callback()
+    pivot = getattr(progress_callback, "pivot", None)
+    CANCEL = progress_callback.timed("cancel", cancel) if pivot else cancel
 
     def SCALE(column, by):
         "Scale (column) by (by) and reduce fractions."
-        a[:, column] = (by * a[:, column]).applyfunc(cancel)
-        x[:, column] = (by * x[:, column]).applyfunc(cancel)
+        a[:, column] = (by * a[:, column]).applyfunc(CANCEL)
+        x[:, column] = (by * x[:, column]).applyfunc(CANCEL)
 
     def ADD(column_from, column_to, factor):
         if factor == 0:
             return
         "Add (by) * (column_from) to (column_to) and reduce fractions."
-        a[:, column_to] = (a[:, column_to] + a[:, column_from] * factor).applyfunc(cancel)
-        x[:, column_to] = (x[:, column_to] + x[:, column_from] * factor).applyfunc(cancel)
+        a[:, column_to] = (a[:, column_to] + a[:, column_from] * factor).applyfunc(CANCEL)
+        x[:, column_to] = (x[:, column_to] + x[:, column_from] * factor).applyfunc(CANCEL)
 
     def SWAP(column1, column2):
         "Swap (column1) and (column2)."
@@ -71,6 +100,10 @@ def inv(a, b, progress_callback=None, singular_callback=None):
     "Use column operations to make A lower-triangular with pivoting."
     "The pivot element is whichever one has the lowest degree."
     for i in range(a.cols):
+        if pivot:
+            step = time.perf_counter()
+            cancels = (progress_callback.counters["cancel calls"], progress_callback.counters["cancel seconds"])
+            nonzeros = len(a.todok())
         ip = None
         best_degree = None
         for ipivot in range(i, a.cols):
@@ -92,34 +125,407 @@ def inv(a, b, progress_callback=None, singular_callback=None):
             SWAP(i, ip)  # move the pivot to the diagonal
 
         SCALE(i, 1 / a[i, i])
+        operations = 1 + sum(1 for j in range(i + 1, a.cols) if a[i, j] != 0)
         for j in range(i + 1, a.cols):
             ADD(i, j, -a[i, j])
+        if pivot:
+            next_row = [a[i + 1, j] for j in range(i + 1, a.cols)] if i + 1 < a.rows else []
+            pivot("expr", i, seconds=time.perf_counter() - step, degree=int(best_degree), operations=operations,
+                  updates=operations * (a.rows + x.rows), fill=len(a.todok()) - nonzeros,
+                  **{"cancel calls": progress_callback.counters["cancel calls"] - cancels[0],
+                     "cancel seconds": progress_callback.counters["cancel seconds"] - cancels[1]},
+                  **_largest_sizes(_expr_size(e) for e in next_row + list(x[:, i]) if e != 0))
         if progress_callback:
             progress_callback("forward", i, "degree", best_degree)
 
     "A is now upper-triangular; solve for x"
+    if pivot:
+        step = time.perf_counter()
+        cancels = (progress_callback.counters["cancel calls"], progress_callback.counters["cancel seconds"])
     for i in range(a.cols - 1, -1, -1):
         for j in range(i):
-            x[:, j] = (x[:, j] - x[:, i] * a[i, j]).applyfunc(cancel)
+            x[:, j] = (x[:, j] - x[:, i] * a[i, j]).applyfunc(CANCEL)
             # for l in range(x.rows):
             #    x[l, j] = cancel(x[l, j] - x[l, i] * a[i, j])
         if progress_callback:
             progress_callback("backward", i)
+    if pivot:
+        progress_callback.substitution("expr", time.perf_counter() - step,
+                                       **{"cancel calls": progress_callback.counters["cancel calls"] - cancels[0],
+                                          "cancel seconds": progress_callback.counters["cancel seconds"] - cancels[1]})
+
+    if progress_callback:
+        progress_callback("done", -1)
+    return x
+
+
+def min_degree_order(size, pattern):
+    """Returns a fill-reducing ordering of range(size) for the sparsity pattern, as a list.
+    pattern is an iterable of the positions (i, j) of the nonzero entries of a size x size matrix.
+
+    This is the minimum degree ordering of the graph of the symmetrized pattern: repeatedly take the vertex with the
+    fewest neighbours (the lowest index breaks ties), and join its neighbours into a clique, which is the fill-in
+    caused by using it as the next pivot.
+    The vertices are kept in a heap keyed by (degree, index). When the degree of a vertex changes, a new entry is pushed
+    and the old one is skipped when it comes out, so each step costs O(log size) per changed degree."""
+    graph = [set() for _ in range(size)]
+    for (i, j) in pattern:
+        if i != j:
+            graph[i].add(j)
+            graph[j].add(i)
+    order = []
+    eliminated = [False] * size
+    heap = [(len(graph[u]), u) for u in range(size)]
+    heapq.heapify(heap)
+    while heap:
+        (d, v) = heapq.heappop(heap)
+        if eliminated[v] or d != len(graph[v]):
+            continue
+        eliminated[v] = True
+        order.append(v)
+        neighbours = graph[v]
+        for u in neighbours:
+            before = len(graph[u])
+            graph[u].discard(v)
+            graph[u] |= neighbours - {u}
+            if len(graph[u]) != before:
+                heapq.heappush(heap, (len(graph[u]), u))
+        graph[v] = set()
+    return order
+
+
+def rational_function_field(*matrices):
+    """Returns the field QQ(q_0, ..., q_{n-1}) of rational functions in the free symbols q_0, ..., q_{n-1} of the
+    matrices, as a sympy domain."""
+    gens = sorted(set().union(*(m.free_symbols for m in matrices)), key=default_sort_key)
+    return QQ.frac_field(*gens) if gens else QQ.frac_field(Dummy())
+
+
+def inv_field(a, b, progress_callback=None, ordering=None):
+    """Solve xa = b by doing column operations, like inv(), but in the field of rational functions.
+    The entries of a and b must be rational functions of their free symbols q_0, ..., q_{n-1}.
+
+    The entries are converted once to elements of QQ(q_0, ..., q_{n-1}), whose numerators and denominators are sparse
+    polynomials that are kept coprime after every operation. This replaces the cancel() calls on sympy expressions in
+    inv(), which are the expensive part of inv(). The solution is converted back to sympy expressions at the end.
+    See solve_field() for the elimination itself and for ordering.
+
+    (Fraction-free Bareiss elimination in QQ[q_0, ..., q_{n-1}] avoids the gcds, but on the absorbing chains from
+    stationary_dist.py every intermediate entry grows to the size of det(a), and it is several times slower.)
+
+    It calls progress_callback like inv() does, including its pivot() method if it has one.
+    If a is singular, the function dies with an Exception().
+    """
+    assert b.cols == a.cols
+    assert a.rows == a.cols
+    if not progress_callback:
+        progress_callback = generate_progress_callback()
+    pivot = getattr(progress_callback, "pivot", None)
+
+    K = rational_function_field(a, b)
+    a_dok = {k: K.from_sympy(v) for k, v in a.todok().items() if v != 0}
+    bcols = [dict() for _ in range(b.cols)]
+    for (i, j), v in b.todok().items():
+        if v != 0:
+            bcols[j][i] = K.from_sympy(v)
+    xcols = solve_field(K, a.cols, a_dok, bcols, progress_callback, ordering)
+
+    x = SparseMatrix(b.rows, b.cols, {(r, j): K.to_sympy(v) for j in range(b.cols) for r, v in xcols[j].items()})
+    if progress_callback:
+        progress_callback("done", -1)
+    return x
+
+
+def solve_field(K, size, a, b, progress_callback=None, ordering=None):
+    """Solve xa = b by doing column operations in the field K.
+    a is a dictionary {(i, j): entry} of the nonzero entries of a size x size matrix.
+    b is a list of size dictionaries; b[j] is column j of b as a dictionary {row: entry} of its nonzero entries.
+    The entries are elements of K. Returns the columns of x in the same form as b.
+
+    Only the structurally nonzero entries are stored and touched, and the degree of each entry is computed at most
+    once.
+    If ordering is None, the pivot in each row is whichever entry has the lowest degree, as in inv().
+    If ordering is "mindegree", the rows and columns are first permuted symmetrically by min_degree_order(), and the
+    diagonal entry is the pivot whenever it is nonzero, which keeps the fill-in low. This is the right choice for
+    matrices like I - Q for an absorbing chain, whose diagonal pivots never vanish.
+
+    It calls progress_callback("forward", i, "degree", d) and progress_callback("backward", i) as it goes.
+    If progress_callback has a pivot() method, like solver_metrics.SolverMetrics, it also calls
+      progress_callback.pivot("field", i, seconds=..., degree=..., ...)
+    after each pivot step with the time of the step, the column operations, the entry updates, the fill-in and the sizes
+    of the updated entries, and progress_callback.substitution("field", seconds) after the back substitution; otherwise
+    none of this is measured. (The field arithmetic cancels every result, so there are no separate cancel() calls.)
+    If a is singular, the function dies with an Exception().
+    """
+    zero = K.zero
+    pivot = getattr(progress_callback, "pivot", None)
+    if ordering is None:
+        perm = list(range(size))
+    elif ordering == "mindegree":
+        perm = min_degree_order(size, a)
+    else:
+        raise ValueError("unknown ordering %r" % ordering)
+    position = {old: new for new, old in enumerate(perm)}
+
+    "The columns of a and x after the permutation, each as a dictionary {row: entry} of the nonzero entries."
+    "arows[i] is the set of columns j with a[i, j] != 0; adeg caches the degrees of the entries of a."
+    acols = [dict() for _ in range(size)]
+    adeg = [dict() for _ in range(size)]
+    arows = [set() for _ in range(size)]
+    for (i, j), v in a.items():
+        acols[position[j]][position[i]] = v
+        arows[position[i]].add(position[j])
+    xcols = [dict(b[perm[j]]) for j in range(size)]
+
+    def SCALE(column, by):
+        "Scale (column) by (by)."
+        acols[column] = {r: v * by for r, v in acols[column].items()}
+        adeg[column] = {}
+        xcols[column] = {r: v * by for r, v in xcols[column].items()}
+
+    def ADD_TO(cols, column_from, column_to, factor, rows=None):
+        "Add (factor) * (column_from) to (column_to) in cols, and keep track of the nonzero entries in rows."
+        to = cols[column_to]
+        for r, v in cols[column_from].items():
+            w = to.get(r, zero) + v * factor
+            if w:
+                if rows is not None and r not in to:
+                    rows[r].add(column_to)
+                to[r] = w
+            else:
+                to.pop(r, None)
+                if rows is not None:
+                    rows[r].discard(column_to)
+
+    def ADD(column_from, column_to, factor):
+        "Add (factor) * (column_from) to (column_to)."
+        ADD_TO(acols, column_from, column_to, factor, arows)
+        adeg[column_to] = {}
+        ADD_TO(xcols, column_from, column_to, factor)
+
+    def SWAP(column1, column2):
+        "Swap (column1) and (column2)."
+        if column1 == column2:
+            return
+        for r in acols[column1]:
+            arows[r].discard(column1)
+        for r in acols[column2]:
+            arows[r].discard(column2)
+        acols[column1], acols[column2] = acols[column2], acols[column1]
+        adeg[column1], adeg[column2] = adeg[column2], adeg[column1]
+        xcols[column1], xcols[column2] = xcols[column2], xcols[column1]
+        for r in acols[column1]:
+            arows[r].add(column1)
+        for r in acols[column2]:
+            arows[r].add(column2)
+
+    def DEGREE(i, j):
+        "The total degree of the numerator of a[i, j]."
+        d = adeg[j].get(i)
+        if d is None:
+            d = max((sum(monom) for monom in acols[j][i].numer), default=0)
+            adeg[j][i] = d
+        return d
+
+    "Use column operations to make A lower-triangular with pivoting."
+    for i in range(size):
+        if pivot:
+            step = time.perf_counter()
+        candidates = [j for j in arows[i] if j >= i]
+        if not candidates:
+            # all of the entries a[i, j] for j >= i are zero, so we can't pivot.
+            raise Exception("singular matrix")
+        if ordering is not None and i in acols[i]:
+            ip = i
+        else:
+            ip = min(candidates, key=lambda j: (DEGREE(i, j), j))
+        best_degree = DEGREE(i, ip)
+        SWAP(i, ip)  # move the pivot to the diagonal
+
+        SCALE(i, 1 / acols[i][i])
+        targets = [j for j in sorted(arows[i]) if j > i]
+        if pivot:
+            nonzeros = sum(len(acols[j]) + len(xcols[j]) for j in targets)
+        for j in targets:
+            ADD(i, j, -acols[j][i])
+        if pivot:
+            column = len(acols[i]) + len(xcols[i])
+            pivot("field", i, seconds=time.perf_counter() - step, degree=best_degree, operations=1 + len(targets),
+                  updates=column * (1 + len(targets)),
+                  fill=sum(len(acols[j]) + len(xcols[j]) for j in targets) - nonzeros,
+                  **_largest_sizes(_field_size(v) for j in targets for v in (*acols[j].values(), *xcols[j].values())))
+        if progress_callback:
+            progress_callback("forward", i, "degree", best_degree)
+
+    "A is now upper-triangular; solve for x"
+    if pivot:
+        step = time.perf_counter()
+    for i in range(size - 1, -1, -1):
+        for j in sorted(arows[i]):
+            if j < i:
+                ADD_TO(xcols, i, j, -acols[j][i])
+        if progress_callback:
+            progress_callback("backward", i)
+    if pivot:
+        progress_callback.substitution("field", time.perf_counter() - step)
+
+    x = [None] * size
+    for j in range(size):
+        x[perm[j]] = xcols[j]
+    return x
+
+
+def strongly_connected_components(size, edges):
+    """Returns the strongly connected components of the directed graph on range(size) with the given edges (i, j).
+    This is Tarjan's algorithm, without recursion. The components are lists of vertices, and they are returned in
+    topological order: every edge goes from a component to itself or to a later component."""
+    graph = [[] for _ in range(size)]
+    for (i, j) in edges:
+        if i != j:
+            graph[i].append(j)
+    index = [None] * size
+    low = [0] * size
+    on_stack = [False] * size
+    stack = []
+    components = []
+    counter = 0
+    for root in range(size):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, k = work.pop()
+            if k == 0:
+                index[v] = low[v] = counter
+                counter += 1
+                stack.append(v)
+                on_stack[v] = True
+            if k < len(graph[v]):
+                work.append((v, k + 1))
+                w = graph[v][k]
+                if index[w] is None:
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+                continue
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                components.append(sorted(component))
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[v])
+    components.reverse()
+    return components
+
+
+def inv_blocks(a, b, progress_callback=None, ordering=None):
+    """Solve xa = b like inv_field(), one strongly connected block at a time.
+    The entries of a and b must be rational functions of their free symbols q_0, ..., q_{n-1}.
+
+    Column j of xa = b only involves x[:, i] for the i with a[i, j] != 0, so the strongly connected components of the
+    graph with an edge i -> j for every such (i, j) put a in block triangular form. The blocks are solved with
+    solve_field() in topological order; the columns of x that a block needs from earlier blocks are already known and
+    are moved to the right-hand side. For I - Q of an absorbing chain, the blocks are the communicating classes of the
+    transient states, which are much smaller than the whole chain.
+
+    It calls progress_callback("block", k, "size", s) for the kth block, which has s columns, and
+    progress_callback("done", -1) at the end. If progress_callback is None, this is displayed by a progressbar().
+    If progress_callback has a pivot() method, it is also passed on to solve_field() for each block of more than one
+    column, and it is called with progress_callback.pivot("field", 0, seconds=..., degree=..., ...) for the single
+    pivot of each block of one column.
+    ordering is used by solve_field() inside each block.
+    If a is singular, the function dies with an Exception().
+    """
+    assert b.cols == a.cols
+    assert a.rows == a.cols
+    size = a.cols
+    if not progress_callback:
+        progress_callback = generate_progress_callback()
+    pivot = getattr(progress_callback, "pivot", None)
 
+    K = rational_function_field(a, b)
+    zero = K.zero
+    a_dok = {k: K.from_sympy(v) for k, v in a.todok().items() if v != 0}
+    arows = [dict() for _ in range(size)]
+    for (i, j), v in a_dok.items():
+        arows[i][j] = v
+    rhs = [dict() for _ in range(size)]
+    for (i, j), v in b.todok().items():
+        if v != 0:
+            rhs[j][i] = K.from_sympy(v)
+
+    xcols = [None] * size
+    for k, component in enumerate(strongly_connected_components(size, a_dok)):
+        if progress_callback:
+            progress_callback("block", k, "size", len(component))
+        if len(component) == 1:
+            if pivot:
+                step = time.perf_counter()
+            j = component[0]
+            if j not in arows[j]:
+                raise Exception("singular matrix")
+            diagonal = arows[j][j]
+            block_x = [{r: v / diagonal for r, v in rhs[j].items()}]
+            if pivot:
+                pivot("field", 0, seconds=time.perf_counter() - step,
+                      degree=max((sum(monom) for monom in diagonal.numer), default=0), operations=1,
+                      updates=1 + len(block_x[0]), fill=0,
+                      **_largest_sizes(_field_size(v) for v in block_x[0].values()))
+        else:
+            local = {old: new for new, old in enumerate(component)}
+            block_a = {(local[i], local[j]): v for i in component for j, v in arows[i].items() if j in local}
+            block_b = [rhs[j] for j in component]
+            block_x = solve_field(K, len(component), block_a, block_b,
+                                  progress_callback if pivot else None, ordering)
+        for i, x_i in zip(component, block_x):
+            xcols[i] = x_i
+            # move the contribution of x[:, i] to the later blocks to the right-hand side
+            for j, v in arows[i].items():
+                if xcols[j] is None:
+                    to = rhs[j]
+                    for r, w in x_i.items():
+                        u = to.get(r, zero) - w * v
+                        if u:
+                            to[r] = u
+                        else:
+                            to.pop(r, None)
+
+    x = SparseMatrix(b.rows, b.cols, {(r, j): K.to_sympy(v) for j in range(size) for r, v in xcols[j].items()})
     if progress_callback:
         progress_callback("done", -1)
     return x
 
 
-def inverse(A, indices_from, indices_to):
+def inverse(A, indices_from, indices_to, method="expr", ordering=None, progress_callback=None):
     """Returns A^{-1}[indices_from, indices_to] as SparseMatrix.
-    This function destroys the original matrix A."""
+    This function destroys the original matrix A.
+
+    method selects the elimination engine:
+      "expr" uses inv(), which works on sympy expressions;
+      "field" uses inv_field(), which works in the field of rational functions and is much faster;
+      "blocks" uses inv_blocks(), which is like "field" but solves one strongly connected block of A at a time.
+    ordering is passed on to inv_field() or inv_blocks(); "mindegree" reorders A to keep the fill-in low. The "expr"
+    engine ignores it.
+    progress_callback is passed on to the engine; e.g. solver_metrics.SolverMetrics records the time of each pivot."""
     assert A.rows == A.cols
     size = A.rows
 
     select = lambda what: {(j, what[j]): 1 for j in range(len(what))}
     b = SparseMatrix(len(indices_from), size, select(indices_from))
-    x = inv(A, b)
+    if method == "expr":
+        x = inv(A, b, progress_callback=progress_callback)
+    elif method == "field":
+        x = inv_field(A, b, progress_callback=progress_callback, ordering=ordering)
+    elif method == "blocks":
+        x = inv_blocks(A, b, progress_callback=progress_callback, ordering=ordering)
+    else:
+        raise ValueError("unknown method %r" % method)
 
     t = zeros(len(indices_from), len(indices_to))
     for i in range(len(indices_from)):
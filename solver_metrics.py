@@ -0,0 +1,184 @@
+"""
+Record where the time goes in the eliminations of solver.py, as a structured log with one JSON object per line.
+A SolverMetrics object is a progress callback for solver.inv(), solver.inv_field(), solver.inv_blocks() and
+solver.inverse(), and it passes the events on to another progress callback (by default the progress bar of solver.py).
+The eliminations also look for its pivot() method: if the progress callback has one, they measure each pivot step and
+call it with the measurements (and substitution() after the back substitution), and otherwise they measure nothing,
+so the instrumentation costs nothing when it is not used.
+
+The records are dictionaries with an 'event' key:
+  'pivot': one pivot step of the forward elimination: the engine, the column, the block (for solver.inv_blocks()),
+    the wall time of the step, the degree of the pivot, the number of column operations and of entry updates, the
+    fill-in (the net number of new nonzero entries), the calls to sympy.cancel() with their total time (for
+    solver.inv()), and the largest degrees and numbers of terms of the numerators and denominators of the entries
+    that were updated;
+  'block': the start of a strongly connected block in solver.inv_blocks();
+  'substitution': the wall time of a back substitution, and its calls to sympy.cancel() (for solver.inv());
+  'profile': the functions where the sampling profiler found the solver most often (see StackSampler);
+  'summary': the totals at the end of the elimination.
+
+External dependencies: solver.py (for the default progress bar).
+"""
+import collections
+import json
+import sys
+import threading
+import time
+
+
+class StackSampler:
+    "A sampling profiler: a background thread that looks at the innermost frames of one thread at a fixed interval."
+
+    def __init__(self, interval=0.01, depth=3):
+        """
+        :param interval: The time between two samples, in seconds.
+        :type interval: A positive number.
+        :param depth: The number of innermost frames that are recorded for each sample.
+        :type depth: A positive integer.
+        """
+        self.interval = interval
+        self.depth = depth
+        self.counts = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        "Start sampling the calling thread."
+        target = threading.get_ident()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(self.interval):
+                frame = sys._current_frames().get(target)
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                if stack:
+                    self.counts[' < '.join(stack)] += 1
+                    self.samples += 1
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop sampling."
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def top(self, k=20):
+        "The k most frequent stacks, as a list of [stack, number of samples]."
+        return [[stack, count] for stack, count in self.counts.most_common(k)]
+
+
+class SolverMetrics:
+    "A progress callback that writes the measurements of the eliminations of solver.py as JSON lines."
+
+    def __init__(self, out=None, progress_callback=None, sampler=None, display=True):
+        """
+        :param out: Where to write the records: the path of a file (which is overwritten), a file object, or None to
+        only keep them in the list self.records.
+        :type out: A string, a file object or None.
+        :param progress_callback: The progress callback that receives the events as well. By default, the progress bar
+        of solver.py if display is True.
+        :type progress_callback: A function or None.
+        :param sampler: A sampling profiler that runs from the first event to the end of the elimination.
+        :type sampler: StackSampler or None.
+        :param display: Whether to display the progress bar when progress_callback is None.
+        :type display: Boolean.
+        """
+        if progress_callback is None and display:
+            import solver
+            progress_callback = solver.generate_progress_callback()
+        self.progress_callback = progress_callback
+        self.sampler = sampler
+        self.records = []
+        self.block = None
+        self.totals = collections.Counter()
+        self.counters = collections.Counter()
+        self.maxima = collections.Counter()
+        self._owns_file = isinstance(out, str)
+        self._file = open(out, 'w') if self._owns_file else out
+        self._started = None
+
+    def emit(self, event, **fields):
+        "Add a record and write it as one line of JSON."
+        record = dict(event=event, **fields)
+        self.records.append(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+
+    def _start(self):
+        if self._started is None:
+            self._started = time.perf_counter()
+            if self.sampler is not None:
+                self.sampler.start()
+
+    def timed(self, name, function):
+        """
+        Wrap a function so that its calls and their total time are added to self.counters[name + ' calls'] and
+        self.counters[name + ' seconds'].
+        """
+        totals = self.counters
+
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                totals[name + ' seconds'] += time.perf_counter() - t
+                totals[name + ' calls'] += 1
+        return wrapper
+
+    def pivot(self, engine, column, **fields):
+        "Record one pivot step; called by the eliminations of solver.py."
+        self._start()
+        for key, value in fields.items():
+            if key.startswith('max '):
+                self.maxima[key] = max(self.maxima[key], value)
+            elif key == 'seconds':
+                self.totals['pivot seconds'] += value
+            elif key != 'degree':
+                self.totals[key] += value
+        self.totals['pivots'] += 1
+        self.emit('pivot', engine=engine, column=column, block=self.block, **fields)
+
+    def substitution(self, engine, seconds, **fields):
+        "Record one back substitution; called by the eliminations of solver.py."
+        self.totals['substitution seconds'] += seconds
+        for key, value in fields.items():
+            self.totals[key] += value
+        self.emit('substitution', engine=engine, block=self.block, seconds=seconds, **fields)
+
+    def __call__(self, what, col, *others):
+        self._start()
+        if what == "block":
+            self.block = col
+            self.emit('block', block=col, **dict(zip(others[::2], others[1::2])))
+        elif what == "done":
+            self.finish()
+        if self.progress_callback:
+            self.progress_callback(what, col, *others)
+
+    def finish(self):
+        "Write the profile and the summary, and close the file if it was opened here."
+        now = time.perf_counter()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.emit('profile', samples=self.sampler.samples, top=self.sampler.top())
+        self.emit('summary', **{'elapsed seconds': now - (self._started or now)}, **self.totals, **self.maxima)
+        if self._owns_file:
+            self._file.close()
+            self._file = None
+        elif self._file is not None:
+            self._file.flush()
+
+
+def load(path):
+    "Read the records written by SolverMetrics."
+    with open(path) as in_file:
+        return [json.loads(line) for line in in_file if line.strip()]
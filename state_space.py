@@ -0,0 +1,407 @@
+"""
+Explore the state space of the ARW on a connected simple graph with one sink vertex.
+Each state is packed into a single integer key, so that looking up a state is a dictionary access, and the transitions
+are collected as a list of (row, col, prob) triples, so that memory grows with the number of transitions rather than
+with the square of the number of states. explore_parallel() spreads the breadth-first search over several processes.
+
+A state is a list with one entry per non-sink vertex. Each entry is 0 (no particle), 's' (a sleeping particle) or a
+positive integer (the number of active particles). In the packed key, vertex v occupies the bits
+[bits * v, bits * (v + 1)) and holds the code 0 for 0, 1 for 's' and k + 1 for k active particles.
+
+External dependencies: none.
+"""
+from collections import deque
+import multiprocessing
+
+SLEEPING = 's'
+
+
+def encode_state(state, bits=2):
+    """
+    Pack a state into an integer key.
+    :param state: A state of the ARW.
+    :type state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    :param bits: The number of bits used for each vertex.
+    :type bits: A positive integer. With the default of 2 bits, a vertex can hold at most 2 active particles.
+    :return: The packed key of the state.
+    :rtype: A nonnegative integer.
+    """
+    mask = (1 << bits) - 1
+    key = 0
+    for v in range(len(state) - 1, -1, -1):
+        if state[v] == SLEEPING:
+            code = 1
+        elif state[v] == 0:
+            code = 0
+        else:
+            code = state[v] + 1
+        if code > mask:
+            raise ValueError('Vertex {} holds more particles than fit in {} bits.'.format(v, bits))
+        key = (key << bits) | code
+    return key
+
+
+def decode_state(key, n, bits=2):
+    """
+    Unpack an integer key into a state.
+    :param key: The packed key of a state, as returned by encode_state().
+    :type key: A nonnegative integer.
+    :param n: The number of non-sink vertices.
+    :type n: A positive integer.
+    :param bits: The number of bits used for each vertex.
+    :type bits: A positive integer.
+    :return: The state.
+    :rtype: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    """
+    mask = (1 << bits) - 1
+    state = []
+    for v in range(n):
+        code = (key >> (bits * v)) & mask
+        if code == 0:
+            state.append(0)
+        elif code == 1:
+            state.append(SLEEPING)
+        else:
+            state.append(code - 1)
+    return state
+
+
+class StateRegistry:
+    "A list of packed states together with a hash index from each key to its position in the list."
+
+    def __init__(self, n, bits=2):
+        self.n = n
+        self.bits = bits
+        self.keys = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_key(self, key):
+        """
+        Register a packed state if it has not been seen before.
+        :return: The index of the state and whether it is new.
+        :rtype: A tuple (integer, boolean).
+        """
+        idx = self.index.get(key)
+        if idx is not None:
+            return idx, False
+        idx = len(self.keys)
+        self.keys.append(key)
+        self.index[key] = idx
+        return idx, True
+
+    def add(self, state):
+        "Register a state given as a list; see add_key()."
+        return self.add_key(encode_state(state, self.bits))
+
+    def find(self, state):
+        "Return the index of a state given as a list, or None if it has not been registered."
+        return self.index.get(encode_state(state, self.bits))
+
+    def state(self, idx):
+        "Return the state with index idx as a list."
+        return decode_state(self.keys[idx], self.n, self.bits)
+
+    def states(self, indices=None):
+        "Return the states with the given indices (by default, all of them) as lists."
+        if indices is None:
+            indices = range(len(self.keys))
+        return [self.state(i) for i in indices]
+
+
+def firing_vertex(key, n, bits=2):
+    """
+    Pick the vertex to fire in a packed state.
+    Fire the first vertex with at least 2 active particles; otherwise, fire the first vertex with 1 active particle.
+    :return: The vertex to fire, or None if the state is absorbing.
+    :rtype: An integer or None.
+    """
+    mask = (1 << bits) - 1
+    first_single = None
+    for v in range(n):
+        code = (key >> (bits * v)) & mask
+        if code >= 3:
+            return v
+        if code == 2 and first_single is None:
+            first_single = v
+    return first_single
+
+
+def successors(key, v, a, bits=2):
+    """
+    List the transitions out of a packed state when vertex v fires.
+    :param key: The packed state.
+    :type key: A nonnegative integer.
+    :param v: The vertex to fire, as returned by firing_vertex().
+    :type v: An integer.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param bits: The number of bits used for each vertex.
+    :type bits: A positive integer.
+    :return: The transitions, in the order in which the original exploration visits them. Each transition is a tuple
+    (new_key, kind) where kind is 'stay' (the particle tries to fall asleep on an occupied vertex), 'sleep' (the
+    particle falls asleep) or 'jump' (the particle jumps to a neighbor, possibly the sink).
+    The probability of 'stay' and 'sleep' is the sleep probability of v; the probability of 'jump' is
+    (1 - sleep probability) / deg(v).
+    :rtype: A list of tuples.
+    """
+    n = len(a) - 1
+    mask = (1 << bits) - 1
+    shift = bits * v
+    code = (key >> shift) & mask
+    out = []
+    if code >= 3:
+        out.append((key, 'stay'))
+        base = key - (1 << shift)
+    else:
+        out.append((key - (1 << shift), 'sleep'))
+        base = key - (2 << shift)
+    for i in a[v]:
+        if i == n:
+            out.append((base, 'jump'))
+            continue
+        shift_i = bits * i
+        code_i = (base >> shift_i) & mask
+        # An empty vertex or a sleeping particle becomes code 2 or 3; otherwise, one more active particle.
+        step = 2 if code_i <= 1 else 1
+        if code_i + step > mask:
+            raise ValueError('Vertex {} holds more particles than fit in {} bits.'.format(i, bits))
+        out.append((base + (step << shift_i), 'jump'))
+    return out
+
+
+def explore(a, sleep_probs, initial_state=None, bits=2, canonical=None, initial_states=None):
+    """
+    Explore all states of the ARW that are reachable from an initial state (or from several), in breadth-first order.
+    :param a: Adjacency list of the graph.
+    :type a: List of lists of integers. The vth list (counting from 0) contains the neighbors of vertex v. The last
+    vertex is assumed to be the sink vertex.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex.
+    :type sleep_probs: List of symbolic expressions (or numbers), one for each non-sink vertex.
+    :param initial_state: The initial state. By default, one active particle at each non-sink vertex.
+    :type initial_state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    :param bits: The number of bits used for each vertex in the packed states.
+    :type bits: A positive integer.
+    :param canonical: A function that maps each packed state to the representative of its class, such as
+    symmetry.canonical_form(). If it is given, only representatives are registered and explored, and transitions go to
+    the representatives of the successors.
+    :type canonical: A function from integers to integers, or None.
+    :param initial_states: Several initial states, explored together instead of initial_state. Their union state space
+    is explored once.
+    :type initial_states: List of states like initial_state, or None.
+    :return: The states, the transitions between them and the absorbing states.
+    :rtype: A tuple with three elements.
+    The first element is a StateRegistry; the initial state has index 0. With initial_states, the distinct initial
+    states have indices 0, 1, ... in the order in which they are given (use StateRegistry.find() to look them up).
+    The second element is a list of transitions (row, col, prob), where row and col are indices in the registry.
+    The third element is a list of indices of the absorbing states, in the order in which they were found.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    n = len(a) - 1
+    if initial_states is None:
+        initial_states = [[1] * n if initial_state is None else initial_state]
+    elif initial_state is not None:
+        raise ValueError('Give either initial_state or initial_states, not both.')
+    jump_probs = [(1 - sleep_probs[v]) / len(a[v]) for v in range(n)]
+    probs = {'stay': sleep_probs, 'sleep': sleep_probs, 'jump': jump_probs}
+
+    registry = StateRegistry(n, bits)
+    queue = deque()
+    for state in initial_states:
+        key = encode_state(state, bits)
+        if canonical is not None:
+            key = canonical(key)
+        idx, new = registry.add_key(key)
+        if new:
+            queue.append(idx)
+    transitions = []
+    absorbing = []
+    while queue:
+        idx = queue.popleft()
+        key = registry.keys[idx]
+        v = firing_vertex(key, n, bits)
+        if v is None:
+            absorbing.append(idx)
+            continue
+        for new_key, kind in successors(key, v, a, bits):
+            if canonical is not None:
+                new_key = canonical(new_key)
+            new_idx, new = registry.add_key(new_key)
+            if new:
+                queue.append(new_idx)
+            transitions.append((idx, new_idx, probs[kind][v]))
+    return registry, transitions, absorbing
+
+
+def _owner(key, processes):
+    "The worker process that owns a packed state, by a multiplicative hash of its key."
+    return ((key * 0x9E3779B97F4A7C15) >> 32) % processes
+
+
+def _explore_worker(conn, a, bits):
+    """
+    The loop of a worker process of explore_parallel(). The worker owns the states whose keys hash to it: it remembers
+    their indices, and it expands them when they are in the frontier.
+    """
+    n = len(a) - 1
+    index = {}
+    while True:
+        (command, batch) = conn.recv()
+        if command == 'expand':
+            out = []
+            for key in batch:
+                v = firing_vertex(key, n, bits)
+                out.append(None if v is None else (v, successors(key, v, a, bits)))
+            conn.send(out)
+        elif command == 'lookup':
+            conn.send([index.get(key, -1) for key in batch])
+        elif command == 'register':
+            for key, idx in batch:
+                index[key] = idx
+        else:
+            conn.close()
+            return
+
+
+def explore_parallel(a, sleep_probs, processes, initial_state=None, bits=2, canonical=None, initial_states=None):
+    """
+    Explore the states of the ARW like explore(), with a breadth-first search that proceeds one level at a time and
+    spreads the work over several processes. The states are partitioned by a hash of their keys, and each worker
+    process expands the states of the frontier that it owns (in one batch per level) and deduplicates the successors
+    against the states that it owns. The results are merged in the order of the frontier, so the states are numbered
+    exactly as explore() numbers them, and the transitions and absorbing states are the same and in the same order.
+    :param processes: The number of worker processes.
+    :type processes: A positive integer.
+    :param a, sleep_probs, initial_state, bits, canonical, initial_states: See explore(). The function canonical is
+    applied in this process, so it need not be picklable.
+    :return: The states, the transitions between them and the absorbing states, as for explore().
+    :rtype: A tuple with three elements.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    n = len(a) - 1
+    if initial_states is None:
+        initial_states = [[1] * n if initial_state is None else initial_state]
+    elif initial_state is not None:
+        raise ValueError('Give either initial_state or initial_states, not both.')
+    jump_probs = [(1 - sleep_probs[v]) / len(a[v]) for v in range(n)]
+    probs = {'stay': sleep_probs, 'sleep': sleep_probs, 'jump': jump_probs}
+
+    conns = []
+    workers = []
+    for _ in range(processes):
+        parent, child = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=_explore_worker, args=(child, a, bits), daemon=True)
+        worker.start()
+        conns.append(parent)
+        workers.append(worker)
+
+    def by_owner(items, key_of=lambda key: key):
+        "Split the items into one batch for each worker, by the owner of their keys."
+        parts = [[] for _ in range(processes)]
+        for item in items:
+            parts[_owner(key_of(item), processes)].append(item)
+        return parts
+
+    def register(pairs):
+        parts = by_owner(pairs, lambda pair: pair[0])
+        for w in range(processes):
+            if parts[w]:
+                conns[w].send(('register', parts[w]))
+
+    def ask(command, keys):
+        parts = by_owner(keys)
+        for w in range(processes):
+            if parts[w]:
+                conns[w].send((command, parts[w]))
+        replies = {}
+        for w in range(processes):
+            if parts[w]:
+                replies.update(zip(parts[w], conns[w].recv()))
+        return replies
+
+    registry = StateRegistry(n, bits)
+    transitions = []
+    absorbing = []
+    try:
+        frontier = []
+        for state in initial_states:
+            key = encode_state(state, bits)
+            if canonical is not None:
+                key = canonical(key)
+            idx, new = registry.add_key(key)
+            if new:
+                frontier.append(idx)
+        register([(registry.keys[idx], idx) for idx in frontier])
+        while frontier:
+            expanded = ask('expand', [registry.keys[idx] for idx in frontier])
+            pending = []
+            for idx in frontier:
+                result = expanded[registry.keys[idx]]
+                if result is None:
+                    absorbing.append(idx)
+                    continue
+                (v, succ) = result
+                for new_key, kind in succ:
+                    if canonical is not None:
+                        new_key = canonical(new_key)
+                    pending.append((idx, new_key, probs[kind][v]))
+            known = ask('lookup', set(new_key for (_, new_key, _) in pending))
+            level = {}
+            frontier = []
+            for (idx, new_key, prob) in pending:
+                new_idx = known[new_key]
+                if new_idx < 0:
+                    new_idx = level.get(new_key)
+                    if new_idx is None:
+                        new_idx = len(registry.keys)
+                        registry.keys.append(new_key)
+                        level[new_key] = new_idx
+                        frontier.append(new_idx)
+                transitions.append((idx, new_idx, prob))
+            register(level.items())
+        for conn in conns:
+            conn.send(('stop', None))
+    finally:
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+    registry.index = {key: idx for idx, key in enumerate(registry.keys)}
+    return registry, transitions, absorbing
+
+
+def absorbing_system(num_states, transitions, absorbing):
+    """
+    Split the transitions of an absorbing chain into the transient and absorbing parts, as sparse matrices.
+    If Q is the transition matrix between transient states and R is the transition matrix from transient states to
+    absorbing states, then the probabilities of ending up at each absorbing state are given by (I - Q)^{-1} R.
+    :param num_states: The number of states.
+    :type num_states: A nonnegative integer.
+    :param transitions: The transitions (row, col, prob) between states, as returned by explore().
+    :type transitions: List of tuples.
+    :param absorbing: The indices of the absorbing states, as returned by explore().
+    :type absorbing: List of integers.
+    :return: The transient states and the matrices I - Q and R.
+    :rtype: A tuple with three elements.
+    The first element is a list of the indices of the transient states; the kth transient state corresponds to the kth
+    row and column of I - Q and to the kth row of R. Column k of R corresponds to absorbing[k].
+    The second element is I - Q and the third element is R, each as a dictionary {(row, col): prob} of nonzero entries.
+    """
+    absorb_pos = {j: k for k, j in enumerate(absorbing)}
+    transient = [i for i in range(num_states) if i not in absorb_pos]
+    trans_pos = {j: k for k, j in enumerate(transient)}
+    i_minus_q = {(k, k): 1 for k in range(len(transient))}
+    r = {}
+    for (i, j, prob) in transitions:
+        row = trans_pos[i]
+        if j in absorb_pos:
+            col = absorb_pos[j]
+            r[row, col] = r.get((row, col), 0) + prob
+        else:
+            col = trans_pos[j]
+            i_minus_q[row, col] = i_minus_q.get((row, col), 0) - prob
+    return transient, i_minus_q, r
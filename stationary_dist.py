@@ -6,19 +6,169 @@ Another plaintext file ends in '-distribution-latex.txt' and contains the LaTeX
 correspond to the stable states.
 The last plaintext file ends in '-distribution.txt' and contains a pretty version of the probabilities that
 correspond to the stable states.
+stationary_dists() computes the distributions for several initial states (by default, all the transient states) with
+one exploration and one elimination.
 
-External dependencies: solver.py.
+External dependencies: solver.py, state_space.py, reduction.py, symmetry.py, modular.py, result_store.py,
+graph_cache.py, out_of_core.py, solver_metrics.py, shared_denominator.py, factored_output.py.
 """
 import sympy
-from collections import deque
-import copy
 import solver
+import state_space
+import reduction
+import symmetry
+import modular
+import result_store
+import solver_metrics
+import shared_denominator
+import factored_output
+import multiprocessing
+import out_of_core as out_of_core_module
 import time
 import pickle
 import os
 
 
-def stationary_dist(a, sleep_probs):
+def specialize(sleep_probs, params=None):
+    """
+    Apply a parameter map to the sleep probabilities, so that the exploration and the elimination work in the smaller
+    ring of the remaining parameters.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex.
+    :type sleep_probs: List of symbolic expressions (or numbers).
+    :param params: The parameter map. A dictionary is substituted into each sleep probability, e.g.
+    {q_0: q, q_1: q, q_2: q} (all the sleep probabilities equal), {q_0: p, q_1: p, q_2: q} (groups of vertices that
+    share a rate) or {q_2: sympy.Rational(1, 2)} (a rate fixed to a rational number). A single symbol q is short for
+    setting every sleep probability to q.
+    :type params: A dictionary, a sympy symbol or None.
+    :return: The specialized sleep probabilities.
+    :rtype: List.
+    """
+    if params is None:
+        return list(sleep_probs)
+    if isinstance(params, sympy.Symbol):
+        return [params] * len(sleep_probs)
+    return [sympy.sympify(q).subs(params) for q in sleep_probs]
+
+
+def solve_chain(num_states, m, t_absorb_idx, sources, sleep_probs, method="field", ordering="mindegree",
+                reduce=True, progress_callback=None, processes=None):
+    """
+    Compute the probabilities of ending up at each absorbing state of the chain explored by state_space.explore(),
+    starting from each of the given states, with a single elimination.
+    :param num_states: The number of states.
+    :type num_states: A nonnegative integer.
+    :param m: The transitions (row, col, prob) between states.
+    :type m: List of tuples.
+    :param t_absorb_idx: The indices of the absorbing states.
+    :type t_absorb_idx: List of integers.
+    :param sources: The indices of the initial states. They are kept by the reduction.
+    :type sources: List of integers.
+    :param sleep_probs, method, ordering, reduce, progress_callback: See stationary_dist().
+    :param processes: The number of worker processes for the evaluations of the "modular" method, or None.
+    :type processes: A positive integer or None.
+    :return: The remaining states, the absorbing states and the probabilities.
+    :rtype: A tuple with three elements.
+    The first element maps the states of the reduced chain to their indices in the original chain.
+    The second element lists the absorbing states, as positions in the first element.
+    The third element is a matrix with one row for each source and one column for each absorbing state.
+    """
+    # t_idx maps the states in m and t_absorb_idx to their indices in the original chain.
+    t_idx = list(range(num_states))
+    if reduce:
+        t_idx, m, t_absorb_idx, stats = reduction.reduce_chain(num_states, m, t_absorb_idx, keep=sources)
+        print("Reduction removed " + str(stats['transient states before'] - stats['transient states after']) +
+              " of " + str(stats['transient states before']) + " transient states and " +
+              str(stats['self-loops removed']) + " self-loops")
+    position = {old: new for new, old in enumerate(t_idx)}
+
+    # From m and t_absorb_idx, we can calculate the probabilities of ending up at each absorbing state.
+    # mat is I - m_trans_trans, where m_trans_trans is the transition matrix between transient states, and
+    # m_trans_absorb is the transition matrix from transient states to absorbing states. Both are kept sparse.
+    trans_idx, i_minus_q, r = state_space.absorbing_system(len(t_idx), m, t_absorb_idx)
+    ell = len(trans_idx)
+    mat = sympy.SparseMatrix(ell, ell, i_minus_q)
+    m_trans_absorb = sympy.SparseMatrix(ell, len(t_absorb_idx), r)
+    trans_pos = {j: k for k, j in enumerate(trans_idx)}
+    absorb_pos = {j: k for k, j in enumerate(t_absorb_idx)}
+    rows = [trans_pos[position[i]] for i in sources if position[i] in trans_pos]
+
+    t0 = time.process_time()
+    print("Time to compute transition matrix: " + str(t0))
+
+    # The probabilities of ending up at each absorbing state are given by the row vectors
+    # ((I - m_trans_trans)^T \ e_i)^T * m_trans_absorb for the sources i, which share one elimination.
+    # The linear solve is the most time-consuming part of the program.
+    if not rows:
+        solved = sympy.zeros(0, len(t_absorb_idx))
+    elif method == "modular":
+        gens = sorted(set().union(*(sympy.sympify(q).free_symbols for q in sleep_probs)), key=sympy.default_sort_key)
+        solved = sympy.Matrix(modular.absorption_probabilities(ell, i_minus_q, r, gens, sources=rows,
+                                                                 processes=processes))
+    else:
+        # We use solver() (which seems to be faster than sympy.linsolve() and sympy.solve()):
+        solved = sympy.Matrix(solver.inverse(mat, rows, list(range(ell)), method=method, ordering=ordering,
+                                             progress_callback=progress_callback) * m_trans_absorb)
+
+    t1 = time.process_time() - t0
+    print("Time to compute final answer: " + str(t1))
+
+    # A source that is already absorbing stays where it is.
+    dist = sympy.zeros(len(sources), len(t_absorb_idx))
+    k = 0
+    for row, i in enumerate(sources):
+        if position[i] in absorb_pos:
+            dist[row, absorb_pos[position[i]]] = 1
+        else:
+            dist[row, :] = solved[k, :]
+            k += 1
+    return t_idx, t_absorb_idx, dist
+
+
+def stationary_dists(a, sleep_probs, initial_states=None, method="field", ordering="mindegree", reduce=True,
+                     params=None, progress_callback=None):
+    """
+    Compute the stationary distributions of the ARW on a connected simple graph with one sink vertex, for several
+    initial states at once. The union of the state spaces reachable from the initial states is explored once, and all
+    the distributions come from one elimination.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex, as in stationary_dist().
+    :type sleep_probs: List.
+    :param initial_states: The initial states. By default, every transient state that is reachable from one active
+    particle at each non-sink vertex (in which case the reduction of the chain is skipped, since it would keep every
+    state anyway).
+    :type initial_states: List of lists whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    The packed states get enough bits per vertex for all the particles of the most crowded initial state.
+    :param method, ordering, reduce, params, progress_callback: See stationary_dist().
+    :return: The initial states, the stable states reachable from any of them, and the probabilities.
+    :rtype: A tuple with three elements.
+    The first element is the list of initial states, in the order of the rows of the third element.
+    The second element is a list of stable states, in the order of the columns of the third element.
+    The third element is a matrix of symbolic expressions with one row for each initial state; the row is the
+    probability of ending up at each stable state.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    sleep_probs = specialize(sleep_probs, params)
+    if initial_states is None:
+        t, m, t_absorb_idx = state_space.explore(a, sleep_probs)
+        absorbing = set(t_absorb_idx)
+        sources = [i for i in range(len(t)) if i not in absorbing]
+        reduce = False
+    else:
+        # A vertex can end up holding every particle, so the packed states need room for the largest total.
+        total = max(sum(1 if x == 's' else x for x in state) for state in initial_states)
+        bits = max(2, (total + 1).bit_length())
+        t, m, t_absorb_idx = state_space.explore(a, sleep_probs, bits=bits, initial_states=initial_states)
+        sources = sorted(set(t.find(state) for state in initial_states))
+    t_idx, t_absorb_idx, dist = solve_chain(len(t), m, t_absorb_idx, sources, sleep_probs, method, ordering, reduce,
+                                            progress_callback)
+    return t.states(sources), t.states([t_idx[i] for i in t_absorb_idx]), dist
+
+
+def stationary_dist(a, sleep_probs, method="field", ordering="mindegree", reduce=True,
+                    symmetric=False, params=None, processes=None, out_of_core=None, memory_budget=2 ** 28,
+                    progress_callback=None):
     """
     Compute the stationary distribution of the ARW on a connected simple graph with one sink vertex.
     The initial state of the ARW consists of one active particle at each non-sink vertex.
@@ -28,6 +178,41 @@ def stationary_dist(a, sleep_probs):
     :param sleep_probs: The sleep probabilities at each non-sink vertex.
     :type sleep_probs: List. The elements of the list are symbolic variables representing the sleep probabilities. The
     size of the list should be exactly one fewer than the number of vertices of the graph.
+    :param method: The elimination engine used by solver.inverse(), or "modular".
+    :type method: A string: "field" (arithmetic in the field of rational functions), "blocks" (like "field", one
+    strongly connected block of transient states at a time), "expr" (arithmetic on sympy expressions) or "modular"
+    (evaluation modulo primes and interpolation with modular.absorption_probabilities(); ordering is ignored).
+    :param ordering: The pivot ordering used by solver.inverse() with the "field" engine.
+    :type ordering: None (the pivot with the lowest degree in each row) or "mindegree" (a fill-reducing ordering).
+    :param reduce: Whether to remove self-loops and eliminate transient states with reduction.reduce_chain() before the
+    linear solve.
+    :type reduce: Boolean.
+    :param symmetric: Whether to explore and solve only one representative of each orbit of states under the
+    automorphisms of the graph that fix the sink vertex and the sleep probabilities (see symmetry.py). This only helps
+    when some sleep probabilities are equal, e.g. all equal to q. The stable states are then listed orbit by orbit,
+    which is not the order of the states when symmetric is False.
+    :type symmetric: Boolean.
+    :param params: A parameter map that is applied to the sleep probabilities before the exploration, so that the
+    transition probabilities, and the ring in which the elimination works, only involve the remaining parameters.
+    This is much faster than substituting into the multivariate result. See specialize().
+    :type params: A dictionary, a sympy symbol or None.
+    :param processes: The number of worker processes for the exploration of the state space with
+    state_space.explore_parallel() and for the evaluations of the "modular" method, or None to do everything in this
+    process. The states, transitions and probabilities are the same.
+    :type processes: A positive integer or None.
+    :param out_of_core: A folder in which to explore the state space on disk with out_of_core.explore_out_of_core(),
+    or None to explore in memory. The transitions are streamed from the disk into the reduction (or into the matrices
+    of the solve). This cannot be combined with symmetric or processes, and the stable states are in the order of
+    out_of_core.DiskChain. Only the exploration is bounded by memory_budget: the reduction and the symbolic solve keep
+    the (reduced) chain in memory, with a rational function for each transition.
+    :type out_of_core: A string or None.
+    :param memory_budget: The approximate number of bytes of records that the exploration on disk holds in memory at
+    once; see out_of_core.explore_out_of_core().
+    :type memory_budget: A positive integer.
+    :param progress_callback: The progress callback of the linear solve (see solver.inv()), e.g. a
+    solver_metrics.SolverMetrics to record the time and the growth of the entries at each pivot. By default, a progress
+    bar. It is not used by the "modular" method.
+    :type progress_callback: A function or None.
     :return: A subset of the absorbing states and the probability of ending up at each one.
     :rtype: A tuple with two elements.
     The first element is a list of stable states. Each element of this list is a list whose elements are either 0 or
@@ -37,185 +222,33 @@ def stationary_dist(a, sleep_probs):
     """
     if len(a) - 1 != len(sleep_probs):
         raise ValueError('There should be exactly one sink vertex.')
+    sleep_probs = specialize(sleep_probs, params)
 
-    # n is the number of non-sink vertices
-    n = len(a) - 1
-    # deg is a list of degrees of the non-sink vertices
-    deg = [len(a[v]) for v in range(n)]
-
-    # t is a list of states in the transition matrix.
-    # Initialize t with the state where all non-sink vertices have 1 active particle.
-    t = [[1] * n]
-    # print(t)
-    t_absorb_idx = []  # list of indices of t that correspond to absorbing states
-    # m is a Markov transition matrix between states, implemented as a list of lists in row-major order.
-    m = [[0]]
-    # q is a queue of current states to check.
-    # Initialize q with the state where non-sink vertices have 1 active particle.
-    # Each state in q includes at the end its index in t.
-    init_state_q = [1] * n
-    init_state_q.append(0)
-    q = deque([init_state_q])
-    while q:
-        state = q.popleft()
-        # Pick the vertex v to fire.
-        # Fire the (only) vertex with 2 active particles; otherwise, fire the first vertex with 1 active particle.
-        v = 0
-        while v < n:
-            if state[v] == 2:
-                break
-            v += 1
-        if v == n:
-            v = 0
-            while v < n:
-                if state[v] == 1:
-                    break
-                v += 1
-        if v == n:
-            # The state is absorbing.
-            t_absorb_idx.append(state[n])
-            m[state[n]][state[n]] = 1
-        else:
-            if state[v] == 2:
-                # The vertex v has 2 active particles.
-                temp_state = copy.copy(state)
-                t_idx = temp_state.pop()
-
-                # Consider the active particle trying to fall asleep (which leaves the state unchanged).
-                m[t_idx][t_idx] = sleep_probs[v]
-
-                temp_state[v] = 1
-                # Consider the active particle at v jumping to a neighbor.
-                for i in a[v]:
-                    if i != n:
-                        # The active particle at v jumps to a non-sink vertex.
-                        temp_state_i_old = temp_state[i]
-                        if temp_state[i] == 's':
-                            temp_state[i] = 2
-                        else:
-                            temp_state[i] += 1
-                        try:
-                            # Check if we transition to a state that we have seen before (in t).
-                            new_idx = t.index(temp_state)
-                        except ValueError:
-                            # We transition to a new state.
-                            new_state = copy.copy(temp_state)
-                            t.append(new_state)
-                            new_idx = len(t) - 1
-                            new_state_q = copy.copy(new_state)
-                            new_state_q.append(new_idx)
-                            q.append(new_state_q)
-                            for row in m:
-                                row.append(0)
-                            m.append([0] * len(t))
-                        m[t_idx][new_idx] = (1 - sleep_probs[v]) / deg[v]
-                        temp_state[i] = temp_state_i_old
-                    else:
-                        # The active particle at v jumps to the sink.
-                        try:
-                            new_idx = t.index(temp_state)
-                        except ValueError:
-                            new_state = copy.copy(temp_state)
-                            t.append(new_state)
-                            new_idx = len(t) - 1
-                            new_state_q = copy.copy(new_state)
-                            new_state_q.append(new_idx)
-                            q.append(new_state_q)
-                            for row in m:
-                                row.append(0)
-                            m.append([0] * len(t))
-                        m[t_idx][new_idx] = (1 - sleep_probs[v]) / deg[v]
-
-            if state[v] == 1:
-                # The vertex v has 1 active particle.
-                temp_state = copy.copy(state)
-                t_idx = temp_state.pop()
-
-                # Consider the active particle at v falling asleep.
-                temp_state[v] = 's'
-                try:
-                    new_idx = t.index(temp_state)
-                except ValueError:
-                    new_state = copy.copy(temp_state)
-                    t.append(new_state)
-                    new_idx = len(t) - 1
-                    new_state_q = copy.copy(new_state)
-                    new_state_q.append(new_idx)
-                    q.append(new_state_q)
-                    for row in m:
-                        row.append(0)
-                    m.append([0] * len(t))
-                m[t_idx][new_idx] = sleep_probs[v]
-
-                temp_state[v] = 0
-                # Consider the active particle at v jumping to a neighbor.
-                for i in a[v]:
-                    if i != n:
-                        temp_state_i_old = temp_state[i]
-                        if temp_state[i] == 's':
-                            temp_state[i] = 2
-                        else:
-                            temp_state[i] += 1
-                        try:
-                            new_idx = t.index(temp_state)
-                        except ValueError:
-                            new_state = copy.copy(temp_state)
-                            t.append(new_state)
-                            new_idx = len(t) - 1
-                            new_state_q = copy.copy(new_state)
-                            new_state_q.append(new_idx)
-                            q.append(new_state_q)
-                            for row in m:
-                                row.append(0)
-                            m.append([0] * len(t))
-                        m[t_idx][new_idx] = (1 - sleep_probs[v]) / deg[v]
-                        temp_state[i] = temp_state_i_old
-                    else:
-                        try:
-                            new_idx = t.index(temp_state)
-                        except ValueError:
-                            new_state = copy.copy(temp_state)
-                            t.append(new_state)
-                            new_idx = len(t) - 1
-                            new_state_q = copy.copy(new_state)
-                            new_state_q.append(new_idx)
-                            q.append(new_state_q)
-                            for row in m:
-                                row.append(0)
-                            m.append([0] * len(t))
-                        m[t_idx][new_idx] = (1 - sleep_probs[v]) / deg[v]
-
-    # From m, t, and t_absorb_idx, we can calculate the probabilities of ending up at each absorbing state.
-    # the transition matrix between transient states
-    m_trans_trans = \
-        sympy.Matrix([[row[j] for j in range(len(m)) if j not in t_absorb_idx]
-                      for row in [m[i] for i in range(len(m)) if i not in t_absorb_idx]])
-    # the transition matrix from transient states to absorbing states
-    m_trans_absorb = \
-        sympy.Matrix([[row[j] for j in t_absorb_idx]
-                      for row in [m[i] for i in range(len(m)) if i not in t_absorb_idx]])
-
-    t0 = time.process_time()
-    print("Time to compute transition matrix: " + str(t0))
+    # t is the registry of states, m is the list of transitions (row, col, prob) between them, and t_absorb_idx is
+    # the list of indices of t that correspond to absorbing states. The initial state has index 0.
+    canonical = None
+    if symmetric:
+        group = symmetry.automorphisms(a, sleep_probs)
+        print("Number of automorphisms: " + str(len(group)))
+        canonical = symmetry.canonical_form(group)
+    if out_of_core is not None:
+        if symmetric or processes:
+            raise ValueError('The exploration on disk cannot be combined with symmetric or processes.')
+        t = out_of_core_module.explore_out_of_core(a, out_of_core, memory_budget=memory_budget)
+        # The transitions are streamed from the disk into the reduction (or into the matrices, without it).
+        m = t.iter_transitions(sleep_probs)
+        t_absorb_idx = t.absorbing.tolist()
+    elif processes:
+        t, m, t_absorb_idx = state_space.explore_parallel(a, sleep_probs, processes, canonical=canonical)
+    else:
+        t, m, t_absorb_idx = state_space.explore(a, sleep_probs, canonical=canonical)
+    t_idx, t_absorb_idx, dist = solve_chain(len(t), m, t_absorb_idx, [0], sleep_probs, method, ordering, reduce,
+                                            progress_callback, processes)
 
-    # The probabilities of ending up at each absorbing state are given by the row vector
-    # ((I - m_trans_trans)^T \ e1)^T * m_trans_absorb
-    # The linear solve is the most time-consuming part of the program.
-    # We use solver() (which seems to be faster than sympy.linsolve() and sympy.solve()):
-    ell = len(t) - len(t_absorb_idx)
-    mat = sympy.SparseMatrix(ell, ell, {})
-    for i in range(ell):
-        mat[i, i] = 1
-    for i in range(ell):
-        for j in range(ell):
-            if m_trans_trans[i, j] != 0:
-                mat[i, j] -= m_trans_trans[i, j]
-    dist = solver.inverse(mat, [0], list(range(ell))) * m_trans_absorb
-
-    t1 = time.process_time() - t0
-    print("Time to compute final answer: " + str(t1))
-
-    return [t[i] for i in t_absorb_idx], dist
+    if symmetric:
+        states, probs = symmetry.expand(t, [t_idx[i] for i in t_absorb_idx], dist, group)
+        return states, sympy.Matrix([probs])
+    return t.states([t_idx[i] for i in t_absorb_idx]), dist
 
 
 if __name__ == "__main__":
@@ -229,20 +262,34 @@ if __name__ == "__main__":
     # a = [[1, 3], [0, 2], [1, 3], [0, 2]]  # 4-cycle
     # a = [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]  # 4-clique
     sleep_probs = sympy.symbols(['q_{}'.format(x) for x in range(len(a)-1)])
+    params = None  # Or e.g. sympy.symbols('q') for the univariate distribution; see specialize().
+
+    use_cache = True  # Reuse the results (or partial work) of isomorphic graphs from the 'data/cache' folder.
+    log_solver = False  # Write the time and the growth of the entries at each pivot to data/<graph>-solver.jsonl.
 
-    sd = stationary_dist(a, sleep_probs)
     out_path = os.path.join(os.path.dirname(__file__), 'data/')
+    progress_callback = None
+    if log_solver:
+        progress_callback = solver_metrics.SolverMetrics(out_path + graph_name + '-solver.jsonl',
+                                                         sampler=solver_metrics.StackSampler())
+    if use_cache:
+        # graph_cache.py imports this module, so it is imported here rather than at the top.
+        import graph_cache
+        sd = graph_cache.cached_stationary_dist(a, sleep_probs, params=params, progress_callback=progress_callback)
+    else:
+        sd = stationary_dist(a, sleep_probs, params=params, progress_callback=progress_callback)
     with open(out_path + graph_name + '.pickle', 'wb') as out_file:
         out_file.write(pickle.dumps(sd))
+    # With a parameter map, the result store takes the remaining parameters as its variables.
+    result_store.save(out_path + graph_name + '.npz', sd, sleep_probs if params is None else None)
     with open(out_path + graph_name + '-states.txt', 'w') as out_file:
         for state in sd[0]:
             out_file.write(str(state) + "\n")
     with open(out_path + graph_name + '-distribution-latex.txt', 'w') as out_file:
         for prob in sd[1]:
             out_file.write(sympy.latex(prob) + "\n")
-    with open(out_path + graph_name + '-distribution.txt', 'w') as out_file:
-        for prob in sd[1]:
-            num, denom = sympy.fraction(sympy.factor(prob))
-            out_file.write(sympy.pretty(num) + "\n")
-            out_file.write("/\n")
-            out_file.write(sympy.pretty(denom) + "\n\n\n\n\n")
+    # Factor and render the probabilities in worker processes, over their common denominator.
+    shared = shared_denominator.SharedDenominatorDist.from_sd(sd, sleep_probs if params is None else None)
+    with factored_output.FactorCache(multiprocessing.cpu_count()) as cache:
+        factored_output.write_pretty(out_path + graph_name + '-distribution.txt',
+                                     factored_output.factored(cache, shared, shared.numerators), cache)
@@ -1,15 +1,21 @@
 """
-Read in a pickle from the 'data' folder containing the stationary distribution for the ARW on a connected simple graph
-with one sink vertex.
+Read in a result store or a pickle from the 'data' folder containing the stationary distribution for the ARW on a
+connected simple graph with one sink vertex.
 Analyze the stationary distribution in terms of joint intensities (marginals) and pair correlations.
 Output the results to the 'data' folder in pretty plaintext files.
 
-External dependencies: a pickle, typically from stationary_dist.py
-The pickle contains a list of stable states and a list of probabilities for each state.
+External dependencies: a result store (.npz) or a pickle, typically from stationary_dist.py, result_store.py,
+shared_denominator.py and factored_output.py.
+Either one contains a list of stable states and a list of probabilities for each state.
+The probabilities are converted to polynomials over a common denominator (see shared_denominator.py), so the sums and
+products below are polynomial arithmetic, and the results are only factored when they are written out.
 """
 import sympy
-import pickle
+import shared_denominator
+import result_store
+import factored_output
 from itertools import combinations
+import multiprocessing
 import os
 
 
@@ -27,13 +33,18 @@ def joint_intensities(k, sd):
     (It is not required that 's' indicate sleeping particles, as long as it is different from 0.)
     The second element is a row vector of symbolic expressions representing probabilities that correspond to the stable
     states.
+    Alternatively, sd is a shared_denominator.SharedDenominatorDist.
     :return: The k-point joint intensities.
     :rtype: A list with n choose k elements, where n is the number of non-sink vertices. Each element of the list
     is a symbolic expression representing the probability that a specific k-vertex subset of the non-sink vertices has
     all sleeping particles. The subsets are ordered in alphabetical order according to the ordering of the non-sink
     vertices in the list of stable states in sd.
+    If sd is a SharedDenominatorDist, each element is instead the numerator of the probability over sd.denominator.
     """
-    (states, dist) = sd
+    if isinstance(sd, shared_denominator.SharedDenominatorDist):
+        (states, dist) = (sd.states, sd.numerators)
+    else:
+        (states, dist) = sd
     if len(states) != len(dist):
         raise ValueError('The number of states does not match the number of entries in the distribution vector.')
     t = len(states)  # number of states
@@ -54,9 +65,58 @@ def joint_intensities(k, sd):
     return joint_int
 
 
+def subset_mask(subset):
+    """
+    Encode a set of non-sink vertices as a bitmask, in which vertex v is bit v.
+    :param subset: A set of non-sink vertices.
+    :type subset: An iterable of nonnegative integers.
+    :return: The bitmask of the subset.
+    :rtype: A nonnegative integer.
+    """
+    mask = 0
+    for v in subset:
+        mask |= 1 << v
+    return mask
+
+
+def all_joint_intensities(sd):
+    """
+    Compute the joint intensities of all subsets of the non-sink vertices at once. Each stable state is encoded as the
+    bitmask of its occupied vertices, the probabilities are added up by bitmask, and a superset-sum (zeta) transform
+    over the n bits then gives, for every subset, the total probability of the states that contain it. This takes
+    O(t + n 2^n) additions instead of a pass over the t states for each subset.
+    :param sd: The stationary distribution, as in joint_intensities().
+    :type sd: A tuple with two elements, or a shared_denominator.SharedDenominatorDist.
+    :return: The joint intensities, indexed by subset_mask(). Entry 0 is the total probability, and the k-point joint
+    intensity of the subset c is entry subset_mask(c).
+    If sd is a SharedDenominatorDist, each element is instead the numerator of the probability over sd.denominator.
+    :rtype: A list with 2^n elements, where n is the number of non-sink vertices.
+    """
+    if isinstance(sd, shared_denominator.SharedDenominatorDist):
+        (states, dist) = (sd.states, sd.numerators)
+    else:
+        (states, dist) = sd
+    if len(states) != len(dist):
+        raise ValueError('The number of states does not match the number of entries in the distribution vector.')
+    t = len(states)  # number of states
+    n = len(states[0])  # number of non-sink vertices
+    joint_int = [0] * (1 << n)
+    for s in range(t):
+        joint_int[subset_mask(v for v in range(n) if states[s][v] != 0)] += dist[s]
+    for v in range(n):
+        bit = 1 << v
+        for mask in range(1 << n):
+            if not mask & bit:
+                joint_int[mask] += joint_int[mask | bit]
+    return joint_int
+
+
 def my_pretty(frac):
     """
     Write a symbolic rational function as a pretty string that can be printed.
+    This is kept as public API for rendering single expressions, e.g. in an interactive session. The __main__ block
+    renders whole outputs with factored_output.write_pretty(), which writes the same format without calling
+    sympy.factor() on each entry.
     :param frac: A rational function.
     :type frac: A symbolic rational function.
     :return: A pretty version of the input.
@@ -68,46 +128,39 @@ def my_pretty(frac):
 
 if __name__ == "__main__":
     graph_name = "4-clique"  # Change the name as necessary
+    processes = multiprocessing.cpu_count()  # The worker processes that factor and render the output, or None
     in_path = os.path.join(os.path.dirname(__file__), 'data/')
-    with open(in_path + graph_name + '.pickle', 'rb') as in_file:
-        sd = pickle.loads(in_file.read())
-    (states, dist) = sd
+    # Read the compact result store if there is one, and the pickle otherwise.
+    if os.path.exists(in_path + graph_name + '.npz'):
+        sd = result_store.ResultStore(in_path + graph_name + '.npz').to_shared()
+    else:
+        sd = result_store.load_pickle(in_path + graph_name + '.pickle')
+        sd = shared_denominator.SharedDenominatorDist.from_sd(
+            sd, sympy.symbols(['q_{}'.format(x) for x in range(len(sd[0][0]))]))
+    states = sd.states
+    q = sympy.symbols('q')
 
     out_path = os.path.join(os.path.dirname(__file__), 'data/')
 
-    # Output the stationary distribution when all sleep rates are the same.
-    univar = {k: sympy.symbols('q') for k in sympy.symbols(['q_{}'.format(x) for x in range(len(states[0]))])}
-    dist_univar = dist.subs(univar)
-    with open(out_path + graph_name + '-distribution-univar.txt', 'w') as out_file:
-        for prob in dist_univar:
-            out_file.write(my_pretty(prob))
-
     # Output the one-point joint intensities (marginals) and pair correlations.
-    marginals = joint_intensities(1, sd)
-    with open(out_path + graph_name + '-marginals.txt', 'w') as out_file:
-        for marginal in marginals:
-            marginal = sympy.factor(marginal)
-            out_file.write(my_pretty(marginal))
-    joints = joint_intensities(2, sd)
-    correlations = [None] * len(joints)
-    with open(out_path + graph_name + '-correlations.txt', 'w') as out_file:
-        k = 0
-        for i in range(len(states[0])):
-            for j in range(i + 1, len(states[0])):
-                correlations[k] = sympy.factor(joints[k] - marginals[i] * marginals[j])
-                out_file.write(my_pretty(correlations[k]))
-                print("Correlations: finished entry " + str(k))
-                k += 1
-    # Output the one-point joint intensities (marginals) and pair correlations when all sleep rates are the same.
-    marginals_univar = [None] * len(marginals)
-    for i in range(len(marginals)):
-        marginals_univar[i] = marginals[i].subs(univar)
-    with open(out_path + graph_name + '-marginals-univar.txt', 'w') as out_file:
-        for marginal in marginals_univar:
-            out_file.write(my_pretty(marginal))
-    correlations_univar = [None] * len(correlations)
-    for i in range(len(correlations)):
-        correlations_univar[i] = correlations[i].subs(univar)
-    with open(out_path + graph_name + '-correlations-univar.txt', 'w') as out_file:
-        for correlation in correlations_univar:
-            out_file.write(my_pretty(correlation))
+    # The correlations are (joint * denominator - marginal * marginal) / denominator^2.
+    joint_int = all_joint_intensities(sd)
+    marginals = [joint_int[subset_mask([i])] for i in range(len(states[0]))]
+    correlations = []
+    for (i, j) in combinations(range(len(states[0])), 2):
+        correlations.append(joint_int[subset_mask([i, j])] * sd.denominator - marginals[i] * marginals[j])
+
+    # The outputs are factored once; the univariate outputs (all sleep rates the same) reuse the factorizations.
+    with factored_output.FactorCache(processes) as cache:
+        dist_factored = factored_output.factored(cache, sd, sd.numerators)
+        marginals_factored = factored_output.factored(cache, sd, marginals)
+        correlations_factored = factored_output.factored(cache, sd, correlations, 2)
+        factored_output.write_pretty(out_path + graph_name + '-distribution-univar.txt',
+                                     factored_output.specialized(cache, dist_factored, q), cache)
+        factored_output.write_pretty(out_path + graph_name + '-marginals.txt', marginals_factored, cache)
+        factored_output.write_pretty(out_path + graph_name + '-correlations.txt', correlations_factored, cache,
+                                     "Correlations")
+        factored_output.write_pretty(out_path + graph_name + '-marginals-univar.txt',
+                                     factored_output.specialized(cache, marginals_factored, q), cache)
+        factored_output.write_pretty(out_path + graph_name + '-correlations-univar.txt',
+                                     factored_output.specialized(cache, correlations_factored, q), cache)
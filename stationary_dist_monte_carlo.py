@@ -0,0 +1,227 @@
+"""
+Estimate the stationary distribution for the ARW on a connected simple graph with one sink vertex by simulation, for
+graphs whose state space is beyond the reach of stationary_dist.py.
+Many independent realizations are run together as rows of numpy arrays: the number of active particles and whether
+there is a sleeping particle, at each non-sink vertex. The graph, the sink vertex, the sleep probabilities and the
+firing rule are those of state_space.py: the first vertex with at least 2 active particles fires, otherwise the first
+vertex with 1 active particle. A 'stay' step (a particle that tries to fall asleep on an occupied vertex) does not
+change the state, so it is skipped, and a vertex with at least 2 active particles always sends a particle to a
+neighbor.
+With firing="parallel", every vertex with active particles fires at once in each step: first all the particles that
+jump, then the sleep attempts (which only succeed on a vertex that still has exactly 1 active particle). This is a legal
+order of firings, so by the abelian property of the ARW the final distribution is the same, and it takes far fewer steps
+on large graphs.
+The estimates come with the half-widths of normal-approximation confidence intervals.
+
+External dependencies: numpy, sympy, result_store.py (only to compare with an exact result).
+"""
+import multiprocessing
+import os
+import numpy
+import sympy
+import result_store
+
+
+def _simulate_chunk(args):
+    "Run replicas realizations with one random generator; the unit of work sent to the process pool."
+    (a, sleep_probs, replicas, seed, initial_state, firing) = args
+    rng = numpy.random.default_rng(seed)
+    n = len(a) - 1
+    q = numpy.array([float(p) for p in sleep_probs])
+    deg = numpy.array([len(a[v]) for v in range(n)])
+    nbrs = numpy.full((n, max(deg)), n, dtype=numpy.int64)
+    for v in range(n):
+        nbrs[v, :deg[v]] = a[v]
+
+    start_active = numpy.array([s if s != 's' else 0 for s in initial_state], dtype=numpy.int64)
+    start_sleeping = numpy.array([s == 's' for s in initial_state], dtype=bool)
+    active = numpy.tile(start_active, (replicas, 1))
+    sleeping = numpy.tile(start_sleeping, (replicas, 1))
+    rows = numpy.arange(replicas)
+    if firing == "parallel":
+        while rows.size:
+            rows = rows[(active[rows] >= 1).any(axis=1)]
+            act = active[rows]
+            occupied = act >= 1
+            tries_sleep = occupied & (rng.random(act.shape) < q)
+            jumps = occupied & ~tries_sleep
+            w = nbrs[numpy.arange(n), (rng.random(act.shape) * deg).astype(numpy.int64)]
+            act -= jumps
+            (r, v) = numpy.nonzero(jumps & (w < n))
+            arrivals = numpy.bincount(r * n + w[r, v], minlength=act.size).reshape(act.shape)
+            slept = sleeping[rows]
+            woke = slept & (arrivals > 0)
+            act += arrivals + woke
+            slept &= ~woke
+            falls = tries_sleep & (act == 1)
+            act[falls] = 0
+            slept |= falls
+            active[rows] = act
+            sleeping[rows] = slept
+        return sleeping
+    while rows.size:
+        act = active[rows]
+        has1 = act >= 1
+        running = has1.any(axis=1)
+        rows, act, has1 = rows[running], act[running], has1[running]
+        if not rows.size:
+            break
+        has2 = act >= 2
+        v = numpy.where(has2.any(axis=1), has2.argmax(axis=1), has1.argmax(axis=1))
+        fall = (act[numpy.arange(len(rows)), v] == 1) & (rng.random(len(rows)) < q[v])
+        # A single active particle falls asleep.
+        active[rows[fall], v[fall]] = 0
+        sleeping[rows[fall], v[fall]] = True
+        # Otherwise, a particle jumps to a uniform neighbor, possibly the sink, and wakes a sleeping particle there.
+        jump_rows, jump_v = rows[~fall], v[~fall]
+        active[jump_rows, jump_v] -= 1
+        w = nbrs[jump_v, (rng.random(len(jump_rows)) * deg[jump_v]).astype(numpy.int64)]
+        inside = w < n
+        jump_rows, w = jump_rows[inside], w[inside]
+        active[jump_rows, w] += 1 + sleeping[jump_rows, w]
+        sleeping[jump_rows, w] = False
+    return sleeping
+
+
+def simulate(a, sleep_probs, replicas, initial_state=None, seed=0, processes=None, chunk_size=4096,
+             firing="sequential"):
+    """
+    Run independent realizations of the ARW until they stabilize.
+    :param a: Adjacency list of the graph.
+    :type a: List of lists of integers. The vth list (counting from 0) contains the neighbors of vertex v. The last
+    vertex is assumed to be the sink vertex.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex.
+    :type sleep_probs: List of numbers in [0, 1).
+    :param replicas: The number of realizations.
+    :type replicas: A positive integer.
+    :param initial_state: The initial state. By default, one active particle at each non-sink vertex.
+    :type initial_state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    :param seed: The seed of the random numbers. The result depends on it and on chunk_size, not on processes.
+    :type seed: An integer.
+    :param processes: The number of worker processes, or None to simulate in this process.
+    :type processes: A positive integer or None.
+    :param chunk_size: The number of realizations that are run together as one array.
+    :type chunk_size: A positive integer.
+    :param firing: The order of the firings: "sequential" (the firing rule of state_space.py, one firing per step) or
+    "parallel" (every vertex with active particles fires in each step; much faster for large graphs).
+    :type firing: A string.
+    :return: The stable states that were reached, one row for each realization; entry v is True if there is a
+    sleeping particle at vertex v.
+    :rtype: A boolean numpy array of shape (replicas, n), where n is the number of non-sink vertices.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    if firing not in ("sequential", "parallel"):
+        raise ValueError('Unknown firing order: ' + str(firing))
+    if initial_state is None:
+        initial_state = [1] * (len(a) - 1)
+    sizes = [min(chunk_size, replicas - k) for k in range(0, replicas, chunk_size)]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(sizes))
+    chunks = [(a, list(sleep_probs), size, s, initial_state, firing) for size, s in zip(sizes, seeds)]
+    if processes is None or len(chunks) == 1:
+        parts = [_simulate_chunk(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            parts = pool.map(_simulate_chunk, chunks)
+    return numpy.concatenate(parts) if parts else numpy.zeros((0, len(a) - 1), dtype=bool)
+
+
+def empirical_distribution(final, z=1.96):
+    """
+    Compute the empirical frequencies of the stable states.
+    :param final: The stable states reached by the realizations, as returned by simulate().
+    :type final: A boolean numpy array.
+    :param z: The quantile of the standard normal distribution for the confidence intervals (1.96 for 95%).
+    :type z: A positive number.
+    :return: The stable states that were reached, their frequencies and the half-widths of the confidence intervals.
+    :rtype: A tuple with three elements: a list of stable states (lists whose elements are 0 or 's') and two numpy
+    arrays.
+    """
+    rows, counts = numpy.unique(final, axis=0, return_counts=True)
+    freqs = counts / len(final)
+    states = [['s' if x else 0 for x in row] for row in rows.tolist()]
+    return states, freqs, z * numpy.sqrt(freqs * (1 - freqs) / len(final))
+
+
+def empirical_marginals(final, z=1.96):
+    """
+    Compute the empirical probability that each non-sink vertex has a sleeping particle.
+    :return: The marginals and the half-widths of the confidence intervals.
+    :rtype: A tuple of two numpy arrays of shape (n,).
+    """
+    p = final.mean(axis=0)
+    return p, z * numpy.sqrt(p * (1 - p) / len(final))
+
+
+def empirical_correlations(final, z=1.96):
+    """
+    Compute the empirical pair correlations P(i and j have sleeping particles) - P(i) P(j) of the non-sink vertices.
+    The standard error of each correlation is that of the mean of (X_i - P(i)) (X_j - P(j)), computed for all pairs
+    at once with matrix products.
+    :return: The correlations and the half-widths of the confidence intervals.
+    :rtype: A tuple of two numpy arrays of shape (n, n).
+    """
+    x = final.astype(float)
+    d = x - x.mean(axis=0)
+    cov = d.T @ d / len(x)
+    second = (d * d).T @ (d * d) / len(x)
+    return cov, z * numpy.sqrt(numpy.maximum(second - cov * cov, 0) / len(x))
+
+
+def empirical_survivors(final, z=1.96):
+    """
+    Compute the empirical distribution of the number of surviving (sleeping) particles.
+    :return: The probabilities that exactly k particles survive and that at least k particles survive, for
+    k = 0, ..., n, each with the half-widths of the confidence intervals.
+    :rtype: A tuple of four numpy arrays of shape (n + 1,).
+    """
+    counts = numpy.bincount(final.sum(axis=1), minlength=final.shape[1] + 1)
+    exact = counts / len(final)
+    tails = numpy.cumsum(exact[::-1])[::-1]
+    return (exact, z * numpy.sqrt(exact * (1 - exact) / len(final)),
+            tails, z * numpy.sqrt(tails * (1 - tails) / len(final)))
+
+
+def compare_exact(final, store, sleep_probs, z=1.96):
+    """
+    Compare the empirical frequencies of the stable states with an exact stationary distribution.
+    :param final: The stable states reached by the realizations, as returned by simulate().
+    :type final: A boolean numpy array.
+    :param store: The exact distribution, typically from the 'data' folder.
+    :type store: result_store.ResultStore.
+    :param sleep_probs: The sleep probabilities used by the simulation.
+    :type sleep_probs: List of numbers.
+    :param z: See empirical_distribution().
+    :type z: A positive number.
+    :return: For each stable state, the exact probability, the frequency and the half-width of the confidence interval.
+    :rtype: A list of tuples (state, exact, frequency, half-width).
+    """
+    point = dict(zip(store.gens, [sympy.nsimplify(p) for p in sleep_probs]))
+    states, freqs, half = empirical_distribution(final, z)
+    found = {tuple(state): (f, h) for state, f, h in zip(states, freqs, half)}
+    out = []
+    for s in range(len(store)):
+        state = store.state(s)
+        exact = float(store.probability(s).subs(point))
+        (f, h) = found.get(tuple(state), (0.0, 0.0))
+        out.append((state, exact, f, h))
+    return out
+
+
+if __name__ == "__main__":
+    graph_name = "4-clique"  # Change the name as necessary
+    a = [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]
+    sleep_probs = [0.5] * (len(a) - 1)
+
+    final = simulate(a, sleep_probs, 10 ** 5, processes=multiprocessing.cpu_count())
+    in_path = os.path.join(os.path.dirname(__file__), 'data/')
+    if os.path.exists(in_path + graph_name + '.npz'):
+        # Compare with the exact distribution.
+        for state, exact, freq, half in compare_exact(final, result_store.ResultStore(in_path + graph_name + '.npz'),
+                                                      sleep_probs):
+            print(state, exact, str(freq) + " +- " + str(half))
+    marginals, half = empirical_marginals(final)
+    print("Marginals: " + str(marginals) + " +- " + str(half))
+    exact, half, tails, tails_half = empirical_survivors(final)
+    print("Exact survivors: " + str(exact) + " +- " + str(half))
+    print("Survivors: " + str(tails) + " +- " + str(tails_half))
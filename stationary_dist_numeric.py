@@ -0,0 +1,203 @@
+"""
+Compute the stationary distribution for the ARW on a connected simple graph with one sink vertex, for numeric values of
+the sleep probabilities.
+This uses the same states and transitions as stationary_dist.py, but the linear solve is done in floating point with
+a sparse LU factorization, which takes milliseconds where the symbolic solve takes hours.
+For sweeps over many values of the sleep probabilities, SweepSystem does the exploration, the sparsity analysis and
+the ordering once, and only the numeric factorization at each point.
+
+External dependencies: numpy, scipy, sympy, state_space.py, out_of_core.py.
+"""
+import multiprocessing
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+import sympy
+import state_space
+import out_of_core as out_of_core_module
+
+
+def sparse_system(num_states, transitions, absorbing):
+    """
+    Build the matrices I - Q and R of an absorbing chain with numeric transition probabilities as scipy.sparse matrices.
+    See state_space.absorbing_system().
+    :return: The transient states, I - Q (in CSC format) and R (in CSR format).
+    :rtype: A tuple with three elements.
+    """
+    transient, i_minus_q, r = state_space.absorbing_system(num_states, transitions, absorbing)
+    ell = len(transient)
+
+    def to_sparse(entries, shape):
+        rows = numpy.fromiter((i for (i, _) in entries), dtype=numpy.int64, count=len(entries))
+        cols = numpy.fromiter((j for (_, j) in entries), dtype=numpy.int64, count=len(entries))
+        vals = numpy.fromiter((float(v) for v in entries.values()), dtype=float, count=len(entries))
+        return scipy.sparse.coo_matrix((vals, (rows, cols)), shape=shape)
+
+    return transient, to_sparse(i_minus_q, (ell, ell)).tocsc(), to_sparse(r, (ell, len(absorbing))).tocsr()
+
+
+def stationary_dist_numeric(a, sleep_probs, initial_state=None, out_of_core=None, memory_budget=2 ** 28):
+    """
+    Compute the stationary distribution of the ARW on a connected simple graph with one sink vertex, for numeric sleep
+    probabilities.
+    :param a: Adjacency list of the graph.
+    :type a: List of lists of integers. The vth list (counting from 0) contains the neighbors of vertex v. The last
+    vertex is assumed to be the sink vertex.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex.
+    :type sleep_probs: List of numbers in [0, 1). The size of the list should be exactly one fewer than the number of
+    vertices of the graph.
+    :param initial_state: The initial state. By default, one active particle at each non-sink vertex.
+    :type initial_state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+    :param out_of_core: A folder in which to explore the state space on disk with out_of_core.explore_out_of_core(),
+    or None to explore in memory.
+    :type out_of_core: A string or None.
+    :param memory_budget: The memory budget of the exploration on disk, in bytes.
+    :type memory_budget: A positive integer.
+    :return: The stable states and the probability of ending up at each one.
+    :rtype: A tuple with two elements.
+    The first element is a list of stable states, in the same order as in stationary_dist() from stationary_dist.py
+    (in the order of out_of_core.DiskChain if out_of_core is given).
+    The second element is a 1-dimensional numpy array of probabilities that correspond to the stable states.
+    """
+    sleep_probs = [float(p) for p in sleep_probs]
+    if out_of_core is not None:
+        t = out_of_core_module.explore_out_of_core(a, out_of_core, initial_state, memory_budget=memory_budget)
+        t_absorb_idx = t.absorbing.tolist()
+        transient, i_minus_q, r = t.numeric_system(sleep_probs)
+    else:
+        t, m, t_absorb_idx = state_space.explore(a, sleep_probs, initial_state)
+        transient, i_minus_q, r = sparse_system(len(t), m, t_absorb_idx)
+    if not transient:
+        # The initial state is already stable.
+        return t.states(t_absorb_idx), numpy.ones(1)
+
+    # The probabilities of ending up at each absorbing state are given by the row vector x * R, where x solves
+    # x (I - Q) = e1, i.e. (I - Q)^T x^T = e1.
+    lu = scipy.sparse.linalg.splu(i_minus_q.T.tocsc())
+    e1 = numpy.zeros(len(transient))
+    e1[0] = 1.0
+    x = lu.solve(e1)
+    return t.states(t_absorb_idx), r.T @ x
+
+
+def affine_coefficients(entries, syms):
+    """
+    Write expressions that are affine in the symbols as arrays of coefficients.
+    :param entries: The expressions.
+    :type entries: List of symbolic expressions (or numbers), each of total degree at most 1 in syms.
+    :param syms: The symbols.
+    :type syms: List of sympy symbols.
+    :return: The constant terms, with shape (len(entries),), and the coefficients of the symbols, with shape
+    (len(syms), len(entries)).
+    :rtype: A tuple of two numpy arrays.
+    """
+    const = numpy.zeros(len(entries))
+    coef = numpy.zeros((len(syms), len(entries)))
+    for k, e in enumerate(entries):
+        poly = sympy.Poly(e, *syms)
+        if poly.total_degree() > 1:
+            raise ValueError('The entry {} is not affine in the sleep probabilities.'.format(e))
+        const[k] = float(poly.coeff_monomial(1))
+        for v, sym in enumerate(syms):
+            coef[v, k] = float(poly.coeff_monomial(sym))
+    return const, coef
+
+
+class SweepSystem:
+    """The absorbing system of the ARW on a graph, prepared for solving at many values of the sleep probabilities.
+    Every entry of I - Q and R is an affine function of the sleep probabilities, so the sparsity pattern is the same at
+    every point; it is analyzed, and a fill-reducing column ordering for the LU factorization is computed, once."""
+
+    def __init__(self, a, initial_state=None):
+        """
+        :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+        :type a: List of lists of integers.
+        :param initial_state: The initial state. By default, one active particle at each non-sink vertex.
+        :type initial_state: List whose elements are 0, 's' or a positive integer, one for each non-sink vertex.
+        """
+        self.n = len(a) - 1
+        syms = sympy.symbols(['q_{}'.format(x) for x in range(self.n)])
+        t, m, t_absorb_idx = state_space.explore(a, syms, initial_state)
+        self.states = t.states(t_absorb_idx)
+        transient, i_minus_q, r = state_space.absorbing_system(len(t), m, t_absorb_idx)
+        self.ell = len(transient)
+        self.num_stable = len(t_absorb_idx)
+
+        # The matrix to factor is (I - Q)^T, with its columns permuted by a COLAMD ordering computed at q = 1/2.
+        # Its nonzero entries are stored column by column; entry k is (I - Q)^T[rows[k], cols[k]].
+        keys = list(i_minus_q)
+        rows = numpy.array([j for (_, j) in keys], dtype=numpy.int64)
+        cols = numpy.array([i for (i, _) in keys], dtype=numpy.int64)
+        const, coef = affine_coefficients([i_minus_q[k] for k in keys], syms)
+        if self.ell:
+            probe = scipy.sparse.csc_matrix((const + 0.5 * coef.sum(axis=0), (rows, cols)), shape=(self.ell, self.ell))
+            self.perm_c = scipy.sparse.linalg.splu(probe, permc_spec='COLAMD').perm_c
+        else:
+            self.perm_c = numpy.zeros(0, dtype=numpy.int64)
+        position = numpy.empty(self.ell, dtype=numpy.int64)
+        position[self.perm_c] = numpy.arange(self.ell)
+        new_cols = position[cols]
+        order = numpy.lexsort((rows, new_cols))
+        self.a_indices = rows[order]
+        self.a_indptr = numpy.searchsorted(new_cols[order], numpy.arange(self.ell + 1))
+        self.a_const = const[order]
+        self.a_coef = coef[:, order]
+
+        r_keys = list(r)
+        self.r_rows = numpy.array([i for (i, _) in r_keys], dtype=numpy.int64)
+        self.r_cols = numpy.array([j for (_, j) in r_keys], dtype=numpy.int64)
+        self.r_const, self.r_coef = affine_coefficients([r[k] for k in r_keys], syms)
+
+    def solve(self, q_grid):
+        """
+        Compute the stationary distribution at each point of a grid of sleep probabilities, in this process.
+        :param q_grid: The sleep probabilities, one row per point and one column per non-sink vertex.
+        :type q_grid: A 2-dimensional array.
+        :return: The probabilities of the stable states, one row per point, in the order of self.states.
+        :rtype: A 2-dimensional numpy array.
+        """
+        q_grid = numpy.atleast_2d(numpy.asarray(q_grid, dtype=float))
+        if q_grid.shape[1] != self.n:
+            raise ValueError('There should be one sleep probability for each non-sink vertex.')
+        out = numpy.zeros((q_grid.shape[0], self.num_stable))
+        if not self.ell:
+            out[:, 0] = 1.0
+            return out
+        a_data = self.a_const + q_grid @ self.a_coef
+        r_data = self.r_const + q_grid @ self.r_coef
+        e1 = numpy.zeros(self.ell)
+        e1[0] = 1.0
+        x = numpy.empty(self.ell)
+        for p in range(q_grid.shape[0]):
+            mat = scipy.sparse.csc_matrix((a_data[p], self.a_indices, self.a_indptr), shape=(self.ell, self.ell))
+            y = scipy.sparse.linalg.splu(mat, permc_spec='NATURAL').solve(e1)
+            x[self.perm_c] = y
+            numpy.add.at(out[p], self.r_cols, x[self.r_rows] * r_data[p])
+        return out
+
+    def sweep(self, q_grid, processes=None, chunk_size=256):
+        """
+        Compute the stationary distribution at each point of a grid of sleep probabilities, optionally spreading the
+        points over a pool of processes.
+        :param q_grid: The sleep probabilities, one row per point and one column per non-sink vertex.
+        :type q_grid: A 2-dimensional array.
+        :param processes: The number of worker processes, or None to solve in this process.
+        :type processes: A positive integer or None.
+        :param chunk_size: The number of points sent to a worker at a time.
+        :type chunk_size: A positive integer.
+        :return: The probabilities of the stable states, one row per point, in the order of self.states.
+        :rtype: A 2-dimensional numpy array.
+        """
+        q_grid = numpy.atleast_2d(numpy.asarray(q_grid, dtype=float))
+        if processes is None or q_grid.shape[0] <= chunk_size:
+            return self.solve(q_grid)
+        chunks = [q_grid[k:k + chunk_size] for k in range(0, q_grid.shape[0], chunk_size)]
+        with multiprocessing.Pool(processes) as pool:
+            return numpy.vstack(pool.map(self.solve, chunks))
+
+
+if __name__ == "__main__":
+    a = [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]  # 4-clique
+    sd = stationary_dist_numeric(a, [0.5] * (len(a) - 1))
+    for state, prob in zip(*sd):
+        print(state, prob)
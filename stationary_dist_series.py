@@ -0,0 +1,295 @@
+"""
+Compute the low-order behaviour of the stationary distribution for the ARW on a connected simple graph with one sink
+vertex near a point of the sleep probabilities, typically q = 0 (no sleeping) or q = 1 (always sleeping), as truncated
+multivariate power series in t_i = q_i - point.
+This uses the same states and transitions as stationary_dist.py, but the reduction of the chain and the linear solve
+are done over truncated power series instead of rational functions: only the self-loops of the explored chain are
+removed exactly (see reduction.reduce_chain()), then every transition probability is expanded around the point, and
+the eliminations of the reduction and of solver.solve_field() work in the ring of series up to a chosen total degree.
+The number of terms of a series is at most the number of monomials of that degree, so the cost grows with the order of
+the truncation instead of with the degree of the rational functions.
+The elimination needs the pivots, i.e. the probabilities of not returning to the eliminated states, to be nonzero at
+the point; this fails (with a ValueError) when some transient states are never left at the point.
+The marginals and the survivor probabilities are sums of the series of the stable states (see stationary_dist_joints.py
+and stationary_dist_survivors.py), and the correlations are truncated products.
+
+External dependencies: sympy, solver.py, state_space.py, reduction.py, stationary_dist.py, stationary_dist_joints.py,
+stationary_dist_survivors.py.
+"""
+from itertools import combinations
+import os
+import time
+import sympy
+from sympy.polys.rings import ring
+import solver
+import state_space
+import reduction
+import stationary_dist as sd_module
+import stationary_dist_joints
+import stationary_dist_survivors
+
+
+class SeriesRing:
+    """The truncated power series in t_0, ..., t_{g-1} over QQ up to a total degree, where t_i = gens[i] - point.
+    It has the zero and the elements that solver.solve_field() needs from a field."""
+
+    def __init__(self, gens, order, point=0):
+        """
+        :param gens: The sleep probabilities (symbols) that the series are expanded in.
+        :type gens: List of sympy symbols.
+        :param order: The largest total degree that is kept.
+        :type order: A nonnegative integer.
+        :param point: The point of the expansion, the same for all the sleep probabilities.
+        :type point: A number.
+        """
+        if order < 0:
+            raise ValueError('The order of the series should be nonnegative.')
+        self.gens = list(gens)
+        self.order = order
+        self.point = sympy.nsimplify(point)
+        self.ring = ring(self.gens or [sympy.Dummy()], sympy.QQ)[0]
+        self.zero = Series(self, self.ring.zero)
+        self.one = Series(self, self.ring.one)
+
+    def truncate(self, p):
+        "Drop the terms of a polynomial in t whose total degree is larger than the order."
+        return self.ring({monom: coeff for monom, coeff in p.items() if sum(monom) <= self.order})
+
+    def from_poly(self, p):
+        "The series of a polynomial in the sleep probabilities (a PolyElement in the same variables as self.ring)."
+        if self.point != 0:
+            p = p.compose([(x, x + self.ring.domain.convert(self.point)) for x in self.ring.gens])
+        return Series(self, self.truncate(p))
+
+    def from_fraction(self, f):
+        "The series of a rational function of the sleep probabilities (an element of a field of fractions)."
+        numer = self.from_poly(self.ring(f.numer.as_expr(*self.ring.symbols)))
+        if f.denom == 1:
+            return numer
+        return numer * (1 / self.from_poly(self.ring(f.denom.as_expr(*self.ring.symbols))))
+
+    def from_sympy(self, expr):
+        "The series of a symbolic rational function of the sleep probabilities."
+        field = self.ring.to_field()
+        return self.from_fraction(field.from_expr(sympy.sympify(expr)))
+
+
+class Series:
+    "A truncated power series; an element of a SeriesRing."
+    __slots__ = ('domain', 'poly')
+
+    def __init__(self, domain, poly):
+        self.domain = domain
+        self.poly = poly
+
+    def _lift(self, other):
+        if isinstance(other, Series):
+            return other.poly
+        return self.domain.ring(other)
+
+    def __bool__(self):
+        return bool(self.poly)
+
+    def __eq__(self, other):
+        return self.poly == self._lift(other)
+
+    def __hash__(self):
+        return hash(self.poly)
+
+    def __add__(self, other):
+        return Series(self.domain, self.poly + self._lift(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Series(self.domain, self.poly - self._lift(other))
+
+    def __rsub__(self, other):
+        return Series(self.domain, self._lift(other) - self.poly)
+
+    def __neg__(self):
+        return Series(self.domain, -self.poly)
+
+    def __mul__(self, other):
+        if not isinstance(other, Series):
+            return Series(self.domain, self.poly * self._lift(other))
+        # Multiply only the pairs of terms whose total degree stays within the order.
+        order = self.domain.order
+        terms = sorted(((sum(monom), monom, coeff) for monom, coeff in other.poly.items()), key=lambda term: term[0])
+        out = {}
+        for monom, coeff in self.poly.items():
+            d = sum(monom)
+            for e, monom2, coeff2 in terms:
+                if d + e > order:
+                    break
+                m = tuple(x + y for x, y in zip(monom, monom2))
+                out[m] = out.get(m, 0) + coeff * coeff2
+        return Series(self.domain, self.domain.ring({m: c for m, c in out.items() if c}))
+
+    __rmul__ = __mul__
+
+    def inverse(self):
+        "The inverse series; the constant term must not vanish."
+        c = self.poly.coeff(1)
+        if not c:
+            raise ValueError('A pivot of the elimination vanishes at the point of the expansion.')
+        # 1 / (c (1 + r)) = (1 - r (1 - r (1 - ...))) / c, with one factor of r for each degree.
+        r = Series(self.domain, (self.poly - c).quo_ground(c))
+        out = self.domain.one
+        for _ in range(self.domain.order):
+            out = self.domain.one - r * out
+        return Series(self.domain, out.poly.quo_ground(c))
+
+    def __truediv__(self, other):
+        if not isinstance(other, Series):
+            return Series(self.domain, self.poly.quo_ground(self.domain.ring.domain.convert(other)))
+        return self * other.inverse()
+
+    def __rtruediv__(self, other):
+        return self.inverse() * other
+
+    @property
+    def numer(self):
+        "The terms, as the numerator of a series with denominator 1; used by solver.solve_field() to compare pivots."
+        return self.poly
+
+    def coefficients(self):
+        """
+        The coefficients of the series, by increasing total degree.
+        :return: The coefficient of t_0^e_0 ... t_{g-1}^e_{g-1} for each exponent vector (e_0, ..., e_{g-1}).
+        :rtype: A dictionary {exponents: rational number}.
+        """
+        terms = sorted(self.poly.items(), key=lambda term: (sum(term[0]), tuple(-e for e in term[0])))
+        return {monom: sympy.QQ.to_sympy(coeff) for monom, coeff in terms}
+
+    def as_expr(self):
+        """The series as a symbolic sum of powers of q_i - point, by increasing total degree.
+        The differences q_i - point are kept as sympy.UnevaluatedExpr, so that they are not expanded; call doit() to
+        expand them."""
+        point = self.domain.point
+        shifted = [sympy.UnevaluatedExpr(g - point) if point != 0 else g for g in self.domain.gens]
+        terms = [coeff * sympy.Mul(*[x ** e for x, e in zip(shifted, monom)])
+                 for monom, coeff in self.coefficients().items()]
+        return sympy.Add(*terms, evaluate=False) if len(terms) > 1 else (terms[0] if terms else sympy.Integer(0))
+
+    def __repr__(self):
+        return 'Series(' + str(self.as_expr()) + ')'
+
+
+def stationary_dist_series(a, sleep_probs, order, point=0, reduce=True, params=None, processes=None):
+    """
+    Compute the stationary distribution of the ARW as truncated power series around a point of the sleep
+    probabilities. The initial state consists of one active particle at each non-sink vertex.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex, as in stationary_dist.stationary_dist().
+    :type sleep_probs: List.
+    :param order: The largest total degree of the series.
+    :type order: A nonnegative integer.
+    :param point: The point of the expansion, e.g. 0 or 1; the series are in the powers of q_i - point.
+    :type point: A number.
+    :param reduce: Whether to reduce the chain with reduction.reduce_chain() first, eliminating the states over the
+    series. The reduction removes the self-loops of the explored chain exactly; without it, the solve fails around
+    q = 1, where a vertex with several active particles keeps them forever.
+    :type reduce: Boolean.
+    :param params, processes: See stationary_dist.stationary_dist().
+    :return: The stable states and the series of the probability of ending up at each one.
+    :rtype: A tuple with two elements: a list of stable states and a list of Series.
+    """
+    if len(a) - 1 != len(sleep_probs):
+        raise ValueError('There should be exactly one sink vertex.')
+    sleep_probs = sd_module.specialize(sleep_probs, params)
+    gens = sorted(set().union(*(sympy.sympify(q).free_symbols for q in sleep_probs)), key=sympy.default_sort_key)
+    S = SeriesRing(gens, order, point)
+
+    if processes:
+        t, m, t_absorb_idx = state_space.explore_parallel(a, sleep_probs, processes)
+    else:
+        t, m, t_absorb_idx = state_space.explore(a, sleep_probs)
+    t_idx = list(range(len(t)))
+    if reduce:
+        t_idx, m, t_absorb_idx, _ = reduction.reduce_chain(len(t), m, t_absorb_idx, domain=S)
+    states = t.states([t_idx[i] for i in t_absorb_idx])
+    # The initial state has index 0 in the original chain and is kept by the reduction.
+    start = t_idx.index(0)
+    if start in t_absorb_idx:
+        return states, [S.one if i == start else S.zero for i in t_absorb_idx]
+
+    trans_idx, i_minus_q, r = state_space.absorbing_system(len(t_idx), m, t_absorb_idx)
+    ell = len(trans_idx)
+    series = {}
+
+    def expand(prob):
+        "The series of a probability of I - Q or R: a Series after the reduction, and a number or expression otherwise."
+        if isinstance(prob, Series):
+            return prob
+        if prob not in series:
+            series[prob] = S.from_sympy(prob)
+        return series[prob]
+
+    a_series = {k: expand(v) for k, v in i_minus_q.items() if v != 0}
+    # Solve x (I - Q) = e_0, the row of (I - Q)^{-1} for the initial state, over the series.
+    b = [dict() for _ in range(ell)]
+    b[trans_idx.index(start)][0] = S.one
+    x = solver.solve_field(S, ell, a_series, b, None, "mindegree")
+    dist = [S.zero for _ in t_absorb_idx]
+    for (i, k), v in r.items():
+        if 0 in x[i]:
+            dist[k] += x[i][0] * expand(v)
+    return states, dist
+
+
+def _lift(dist, values):
+    "Turn the sums over no states (the integer 0) into series, like the sums over some states."
+    return [v if isinstance(v, Series) else dist[0].domain.zero + v for v in values]
+
+
+def series_correlations(states, dist):
+    """
+    Compute the truncated series of the marginals and of the pair correlations P(i and j have sleeping particles)
+    - P(i) P(j) of the non-sink vertices.
+    :param states, dist: The output of stationary_dist_series().
+    :return: The marginals and the correlations, in the order of itertools.combinations().
+    :rtype: A tuple of two lists of Series.
+    """
+    marginals = _lift(dist, stationary_dist_joints.joint_intensities(1, (states, dist)))
+    pairs = _lift(dist, stationary_dist_joints.joint_intensities(2, (states, dist)))
+    n = len(states[0])
+    return marginals, [p - marginals[i] * marginals[j] for p, (i, j) in zip(pairs, combinations(range(n), 2))]
+
+
+def series_survivors(states, dist):
+    """
+    Compute the truncated series of the probabilities that exactly k and at least k particles survive.
+    :param states, dist: The output of stationary_dist_series().
+    :return: The probabilities for k = 0, ..., n.
+    :rtype: A tuple of two lists of Series.
+    """
+    hist = _lift(dist, stationary_dist_survivors.survivor_histogram((states, dist)))
+    return hist, _lift(dist, stationary_dist_survivors.survivor_tails(hist))
+
+
+if __name__ == "__main__":
+    graph_name = "4-clique"  # Change the name as necessary
+    a = [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]
+    sleep_probs = sympy.symbols(['q_{}'.format(x) for x in range(len(a) - 1)])
+    order = 3
+    point = 0  # Or 1 for the behaviour when the particles almost always fall asleep.
+
+    t0 = time.process_time()
+    states, dist = stationary_dist_series(a, sleep_probs, order, point)
+    print("Time to compute the series: " + str(time.process_time() - t0))
+    marginals, correlations = series_correlations(states, dist)
+    hist, tails = series_survivors(states, dist)
+
+    out_path = os.path.join(os.path.dirname(__file__), 'data/')
+    with open(out_path + graph_name + '-series-at-{}-order-{}.txt'.format(point, order), 'w') as out_file:
+        for title, rows in [("Distribution", zip(states, dist)),
+                            ("Marginals", enumerate(marginals)),
+                            ("Correlations", zip(combinations(range(len(states[0])), 2), correlations)),
+                            ("Exact survivors", enumerate(hist)),
+                            ("Survivors", enumerate(tails))]:
+            out_file.write(title + "\n")
+            for label, s in rows:
+                out_file.write(str(label) + ": " + str(s.as_expr()) + "\n")
+            out_file.write("\n")
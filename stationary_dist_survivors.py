@@ -1,15 +1,21 @@
 """
-Read in a pickle from the 'data' folder containing the stationary distribution for the ARW on a connected simple graph
-with one sink vertex.
+Read in a result store or a pickle from the 'data' folder containing the stationary distribution for the ARW on a
+connected simple graph with one sink vertex.
 Analyze the stationary distribution in terms of the probability of least k particles surviving and exactly k particles
-surviving.
+surviving, and in terms of the generating function and the moments of the number of surviving particles.
 Output the results to the 'data' folder in pretty plaintext files.
 
-External dependencies: a pickle, typically from stationary_dist.py
-The pickle contains a list of stable states and a list of probabilities for each state.
+External dependencies: a result store (.npz) or a pickle, typically from stationary_dist.py, result_store.py,
+shared_denominator.py and factored_output.py.
+Either one contains a list of stable states and a list of probabilities for each state.
+The probabilities are converted to polynomials over a common denominator (see shared_denominator.py), so the sums and
+products below are polynomial arithmetic, and the results are only factored when they are written out.
 """
 import sympy
-import pickle
+import shared_denominator
+import result_store
+import factored_output
+import multiprocessing
 import os
 
 
@@ -27,10 +33,15 @@ def survivors(k, sd):
     (It is not required that 's' indicate sleeping particles, as long as it is different from 0.)
     The second element is a row vector of symbolic expressions representing probabilities that correspond to the stable
     states.
-    :return: The probability that at least k particles survive.
+    Alternatively, sd is a shared_denominator.SharedDenominatorDist.
+    :return: The probability that at least k particles survive (its numerator over sd.denominator, if sd is a
+    SharedDenominatorDist).
     :rtype: A probability, determined from the stationary distribution sd.
     """
-    (states, dist) = sd
+    if isinstance(sd, shared_denominator.SharedDenominatorDist):
+        (states, dist) = (sd.states, sd.numerators)
+    else:
+        (states, dist) = sd
     if len(states) != len(dist):
         raise ValueError('The number of states does not match the number of entries in the distribution vector.')
     t = len(states)  # number of states
@@ -58,10 +69,15 @@ def exact_survivors(k, sd):
     (It is not required that 's' indicate sleeping particles, as long as it is different from 0.)
     The second element is a row vector of symbolic expressions representing probabilities that correspond to the stable
     states.
-    :return: The probability that exactly k particles survive.
+    Alternatively, sd is a shared_denominator.SharedDenominatorDist.
+    :return: The probability that exactly k particles survive (its numerator over sd.denominator, if sd is a
+    SharedDenominatorDist).
     :rtype: A probability, determined from the stationary distribution sd.
     """
-    (states, dist) = sd
+    if isinstance(sd, shared_denominator.SharedDenominatorDist):
+        (states, dist) = (sd.states, sd.numerators)
+    else:
+        (states, dist) = sd
     if len(states) != len(dist):
         raise ValueError('The number of states does not match the number of entries in the distribution vector.')
     t = len(states)  # number of states
@@ -75,6 +91,82 @@ def exact_survivors(k, sd):
     return prob
 
 
+def survivor_histogram(sd):
+    """
+    Compute the distribution of the number of surviving particles from the stationary distribution sd in one pass over
+    the stable states.
+    :param sd: The stationary distribution, as in survivors().
+    :type sd: A tuple with two elements, or a shared_denominator.SharedDenominatorDist.
+    :return: The probability that exactly k particles survive, for k = 0, ..., n, where n is the number of non-sink
+    vertices (its numerator over sd.denominator, if sd is a SharedDenominatorDist).
+    :rtype: A list with n + 1 elements.
+    """
+    if isinstance(sd, shared_denominator.SharedDenominatorDist):
+        (states, dist) = (sd.states, sd.numerators)
+    else:
+        (states, dist) = sd
+    if len(states) != len(dist):
+        raise ValueError('The number of states does not match the number of entries in the distribution vector.')
+    t = len(states)  # number of states
+    n = len(states[0])  # number of non-sink vertices
+
+    hist = [0] * (n + 1)
+    for s in range(t):
+        hist[n - states[s].count(0)] += dist[s]
+    return hist
+
+
+def survivor_tails(hist):
+    """
+    Compute the probability that at least k particles survive from the output of survivor_histogram(), by summing
+    cumulatively from k = n down to k = 0.
+    :param hist: The probabilities that exactly k particles survive, for k = 0, ..., n.
+    :type hist: A list.
+    :return: The probabilities that at least k particles survive, for k = 0, ..., n.
+    :rtype: A list with the same length as hist.
+    """
+    tails = [0] * len(hist)
+    total = 0
+    for k in range(len(hist) - 1, -1, -1):
+        total += hist[k]
+        tails[k] = total
+    return tails
+
+
+def survivor_pgf(hist, z):
+    """
+    Compute the probability generating function of the number of surviving particles, sum_k P(k survive) z^k.
+    :param hist: The probabilities that exactly k particles survive, as returned by survivor_histogram().
+    :type hist: A list of symbolic expressions or polynomials (sympy PolyElement).
+    :param z: The variable of the generating function.
+    :type z: A sympy symbol.
+    :return: The generating function (its numerator over sd.denominator, if hist was computed from a
+    SharedDenominatorDist).
+    :rtype: A symbolic expression.
+    """
+    return sum((sympy.sympify(p.as_expr() if hasattr(p, 'as_expr') else p) * z ** k for k, p in enumerate(hist)),
+               sympy.Integer(0))
+
+
+def survivor_moments(hist, order):
+    """
+    Compute the raw moments E[K^m] of the number K of surviving particles, for m = 0, ..., order.
+    :param hist: The probabilities that exactly k particles survive, as returned by survivor_histogram().
+    :type hist: A list.
+    :param order: The highest moment.
+    :type order: A nonnegative integer.
+    :return: The moments (their numerators over sd.denominator, if hist was computed from a SharedDenominatorDist).
+    :rtype: A list with order + 1 elements.
+    """
+    moments = []
+    for m in range(order + 1):
+        moment = 0
+        for k, p in enumerate(hist):
+            moment += k ** m * p
+        moments.append(moment)
+    return moments
+
+
 def my_pretty(frac):
     """
     Write a symbolic rational function as a pretty string that can be printed.
@@ -89,32 +181,49 @@ def my_pretty(frac):
 
 if __name__ == "__main__":
     graph_name = "4-clique"  # Change the name as necessary
+    processes = multiprocessing.cpu_count()  # The worker processes that factor and render the output, or None
     in_path = os.path.join(os.path.dirname(__file__), 'data/')
-    with open(in_path + graph_name + '.pickle', 'rb') as in_file:
-        sd = pickle.loads(in_file.read())
-    (states, dist) = sd
+    # Read the compact result store if there is one, and the pickle otherwise.
+    if os.path.exists(in_path + graph_name + '.npz'):
+        store = result_store.ResultStore(in_path + graph_name + '.npz')
+        sd = store.to_shared()
+        sd_univar = store.univariate(sympy.symbols('q'))
+    else:
+        sd = result_store.load_pickle(in_path + graph_name + '.pickle')
+        sd = shared_denominator.SharedDenominatorDist.from_sd(
+            sd, sympy.symbols(['q_{}'.format(x) for x in range(len(sd[0][0]))]))
+        sd_univar = sd.specialize(sympy.symbols('q'))
+    states = sd.states
 
     out_path = os.path.join(os.path.dirname(__file__), 'data/')
 
     # Output the probability that at least k particles survive and the probability that exactly k particles survive.
-    survivor_probs = [None] * (len(states[0]) + 1)
-    with open(out_path + graph_name + '-survivors.txt', 'w') as out_file:
-        for k in range(len(states[0]), -1, -1):
-            survivor_probs[k] = sympy.factor(survivors(k, sd))
-            out_file.write(my_pretty(survivor_probs[k]))
-            print("Survivors: " + str(k))
-    exact_survivor_probs = [None] * (len(states[0]) + 1)
-    with open(out_path + graph_name + '-exact-survivors.txt', 'w') as out_file:
-        for k in range(len(states[0]), -1, -1):
-            exact_survivor_probs[k] = sympy.factor(exact_survivors(k, sd))
-            out_file.write(my_pretty(exact_survivor_probs[k]))
-            print("Exact survivors: " + str(k))
-    univar = {k: sympy.symbols('q') for k in sympy.symbols(['q_{}'.format(x) for x in range(len(states[0]))])}
-    with open(out_path + graph_name + '-survivors-univar.txt', 'w') as out_file:
-        for k in range(len(states[0]) + 1):
-            out_file.write(my_pretty(survivor_probs[k].subs(univar)))
-            print("Survivors (univariate): " + str(k))
-    with open(out_path + graph_name + '-exact-survivors-univar.txt', 'w') as out_file:
-        for k in range(len(states[0]) + 1):
-            out_file.write(my_pretty(exact_survivor_probs[k].subs(univar)))
-            print("Exact survivors (univariate): " + str(k))
+    # Both are read off one histogram of the number of survivors.
+    # The outputs are factored once; the univariate outputs (all sleep rates the same) reuse the factorizations.
+    hist = survivor_histogram(sd)
+    tails = survivor_tails(hist)
+    with factored_output.FactorCache(processes) as cache:
+        tails_factored = factored_output.factored(cache, sd, tails)
+        hist_factored = factored_output.factored(cache, sd, hist)
+        factored_output.write_pretty(out_path + graph_name + '-survivors.txt', tails_factored[::-1], cache,
+                                     "Survivors")
+        factored_output.write_pretty(out_path + graph_name + '-exact-survivors.txt', hist_factored[::-1], cache,
+                                     "Exact survivors")
+        factored_output.write_pretty(out_path + graph_name + '-survivors-univar.txt',
+                                     factored_output.specialized(cache, tails_factored, sympy.symbols('q')), cache,
+                                     "Survivors (univariate)")
+        factored_output.write_pretty(out_path + graph_name + '-exact-survivors-univar.txt',
+                                     factored_output.specialized(cache, hist_factored, sympy.symbols('q')), cache,
+                                     "Exact survivors (univariate)")
+        # Output the generating function, the mean and the variance of the number of survivors when all sleep rates are
+        # the same. The variance is (E[K^2] * denominator - E[K]^2) / denominator^2.
+        hist_univar = survivor_histogram(sd_univar)
+        (_, mean, second) = survivor_moments(hist_univar, 2)
+        moments_factored = (factored_output.factored(cache, sd_univar, [mean]) +
+                            factored_output.factored(cache, sd_univar, [second * sd_univar.denominator - mean * mean],
+                                                     2))
+        with open(out_path + graph_name + '-survivor-moments-univar.txt', 'w') as out_file:
+            out_file.write(my_pretty(survivor_pgf(hist_univar, sympy.symbols('z')) / sd_univar.denominator.as_expr()))
+            for text in factored_output.render_all(moments_factored, cache):
+                out_file.write(text)
+        print("Survivor moments (univariate)")
@@ -0,0 +1,118 @@
+"""
+Use the automorphisms of a graph to shrink the state space of the ARW.
+An automorphism of the graph that fixes the sink vertex and the sleep probabilities maps the final distribution from a
+state to the final distribution from the image of the state, by the abelian property of the ARW, even though the firing
+rule in state_space.py is not symmetric. So the chain can be explored on orbit representatives, and if the initial
+state is fixed by the automorphisms (as one active particle at each non-sink vertex is), every stable state in an orbit
+has the same probability.
+
+External dependencies: state_space.py.
+"""
+import state_space
+
+
+def automorphisms(a, sleep_probs=None):
+    """
+    Compute the automorphisms of a graph that fix the sink vertex (and the sleep probabilities, if they are given).
+    This is a backtracking search that assigns the vertices one at a time and checks the edges to the vertices already
+    assigned, which is fast for the graph sizes whose ARW state space is explorable.
+    :param a: Adjacency list of the graph. The last vertex is the sink vertex.
+    :type a: List of lists of integers.
+    :param sleep_probs: The sleep probabilities at each non-sink vertex. An automorphism must map each vertex to a
+    vertex with the same sleep probability.
+    :type sleep_probs: List of symbolic expressions (or numbers), or None.
+    :return: The automorphisms, starting with the identity. Each automorphism is a tuple p of length n, the number of
+    non-sink vertices, and maps the vertex v to p[v].
+    :rtype: A list of tuples.
+    """
+    n = len(a) - 1
+    adj = [set(nbrs) for nbrs in a]
+    sink_nbrs = adj[n]
+
+    def compatible(v, w):
+        if len(adj[v]) != len(adj[w]) or ((v in sink_nbrs) != (w in sink_nbrs)):
+            return False
+        return sleep_probs is None or sleep_probs[v] == sleep_probs[w]
+
+    group = []
+    image = [None] * n
+    used = [False] * n
+
+    def extend(v):
+        if v == n:
+            group.append(tuple(image))
+            return
+        for w in range(n):
+            if used[w] or not compatible(v, w):
+                continue
+            if all((u in adj[v]) == (image[u] in adj[w]) for u in range(v)):
+                image[v] = w
+                used[w] = True
+                extend(v + 1)
+                used[w] = False
+        image[v] = None
+
+    extend(0)
+    return group
+
+
+def permute_key(key, p, bits=2):
+    "Apply the vertex permutation p to a packed state: the contents of vertex v move to vertex p[v]."
+    mask = (1 << bits) - 1
+    out = 0
+    for v in range(len(p)):
+        out |= ((key >> (bits * v)) & mask) << (bits * p[v])
+    return out
+
+
+def canonical_form(group, bits=2):
+    """
+    Make a function that maps a packed state to the representative of its orbit, namely the smallest packed key in the
+    orbit. The representatives are cached.
+    :param group: The automorphisms, as returned by automorphisms().
+    :type group: A list of tuples.
+    :param bits: The number of bits used for each vertex in the packed states.
+    :type bits: A positive integer.
+    :return: The function.
+    :rtype: A function from integers to integers.
+    """
+    cache = {}
+
+    def canonical(key):
+        rep = cache.get(key)
+        if rep is None:
+            rep = min(permute_key(key, p, bits) for p in group)
+            cache[key] = rep
+        return rep
+
+    return canonical
+
+
+def orbit(key, group, bits=2):
+    "Return the orbit of a packed state under the automorphisms, as a sorted list of packed keys."
+    return sorted(set(permute_key(key, p, bits) for p in group))
+
+
+def expand(registry, absorbing, dist, group):
+    """
+    Expand a distribution on orbit representatives of stable states into a distribution on all stable states.
+    Each state in the orbit of a representative gets an equal share of its probability.
+    :param registry: The registry of packed states, as returned by state_space.explore().
+    :type registry: state_space.StateRegistry.
+    :param absorbing: The indices in registry of the representatives of the stable states.
+    :type absorbing: List of integers.
+    :param dist: The probabilities of the representatives (of their whole orbits).
+    :type dist: A row vector (or list) of symbolic expressions.
+    :param group: The automorphisms that were used to pick the representatives.
+    :type group: A list of tuples.
+    :return: The stable states, ordered by representative and then by packed key, and their probabilities.
+    :rtype: A tuple with two elements: a list of states (as lists) and a list of symbolic expressions.
+    """
+    states = []
+    probs = []
+    for k, idx in enumerate(absorbing):
+        keys = orbit(registry.keys[idx], group, registry.bits)
+        for key in keys:
+            states.append(state_space.decode_state(key, registry.n, registry.bits))
+            probs.append(dist[k] / len(keys))
+    return states, probs